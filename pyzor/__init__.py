@@ -62,3 +62,17 @@ class AuthorizationError(CommError):
     requested action."""
 
     pass
+
+
+class RateLimitError(CommError):
+    """The client or the user sent more requests than allowed by the rate
+    limits of the server."""
+
+    code = 429
+
+
+class BusyError(CommError):
+    """The server has too many pending requests, and did not handle this
+    one."""
+
+    code = 503
@@ -3,11 +3,20 @@
 Note that accounts are not necessary (on the client or server), as an
 "anonymous" account always exists."""
 
+import re
 import time
 import hashlib
 
 import pyzor
 
+# The Sig header line of a serialized request.
+_SIG_LINE_RE = re.compile(rb"^sig:[^\r\n]*(?:\r\n|\r|\n)?", re.I | re.M)
+# A request serialized the way the pyzor client does it: plain ASCII
+# "Name: value" header lines, followed by blank lines.
+_CANONICAL_RE = re.compile(
+    rb"(?:[\x21-\x39\x3b-\x7e]+: (?:[\x21-\x7e][\x20-\x7e]*)?\n)+\n*\Z"
+)
+
 
 def sign_msg(hashed_key, timestamp, msg, hash_=hashlib.sha1):
     """Converts the key, timestamp (epoch seconds), and msg into a digest.
@@ -19,8 +28,15 @@ def sign_msg(hashed_key, timestamp, msg, hash_=hashlib.sha1):
     H is the hash function (currently SHA1)
     """
     msg = msg.as_string().strip().encode("utf8")
+    return sign_bytes(hashed_key, timestamp, msg, hash_)
+
+
+def sign_bytes(hashed_key, timestamp, data, hash_=hashlib.sha1):
+    """The same as sign_msg, but for a message that is already serialized
+    (without the "Sig" header).
+    """
     digest = hash_()
-    digest.update(hash_(msg).digest())
+    digest.update(hash_(data.strip()).digest())
     digest.update((":%d:%s" % (timestamp, hashed_key)).encode("utf8"))
     return digest.hexdigest().lower()
 
@@ -60,6 +76,33 @@ def verify_signature(msg, user_key):
         raise pyzor.SignatureError("Invalid signature.")
 
 
+def is_canonical(data):
+    """Whether the request was serialized the same way the pyzor client
+    does it, in which case the `data` is exactly what the request was
+    signed over, see verify_raw_signature.
+    """
+    return _CANONICAL_RE.match(data) is not None
+
+
+def verify_raw_signature(msg, data, hashed_key):
+    """Verify the signature of a message received by the server, without
+    serializing the message again: the signature is computed over the
+    `data` the message was parsed from, without the "Sig" header line.
+    `hashed_key` is the user key already hashed with hash_key.
+
+    This only matches the result of verify_signature if the message was
+    serialized the same way the pyzor client does it (see is_canonical),
+    otherwise verify_signature must be used instead.
+    """
+    timestamp = int(msg["Time"])
+    provided_signature = msg["Sig"]
+    if abs(time.time() - timestamp) > pyzor.MAX_TIMESTAMP_DIFFERENCE:
+        raise pyzor.SignatureError("Timestamp not within allowed range.")
+    correct_signature = sign_bytes(hashed_key, timestamp, _SIG_LINE_RE.sub(b"", data))
+    if correct_signature != provided_signature:
+        raise pyzor.SignatureError("Invalid signature.")
+
+
 class Account(object):
     def __init__(self, username, salt, key):
         self.username = username
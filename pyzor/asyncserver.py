@@ -0,0 +1,494 @@
+"""Asyncio version of the pyzord server.
+
+All the datagrams are handled concurrently in a single event loop, without
+a thread or a process per request. The requests are parsed, authenticated
+and authorized exactly like in pyzor.server, only the database calls are
+awaited.
+
+Natively asynchronous engines (see pyzor.engines.common.AsyncBaseEngine)
+are used directly, the other engines are wrapped in an ExecutorEngine that
+runs the blocking calls in a thread pool.
+"""
+
+import io
+import time
+import socket
+import signal
+import asyncio
+import logging
+import concurrent.futures
+
+import pyzor.config
+import pyzor.message
+import pyzor.metrics
+import pyzor.server
+import pyzor.engines.common
+
+
+class ExecutorEngine(pyzor.engines.common.AsyncBaseEngine):
+    """Adapts a blocking engine to the asynchronous interface by running
+    its calls in a thread pool.
+
+    Engines that are not thread-safe should be used with a single worker.
+    """
+
+    # Engines that don't handle reports in one step are still incremented
+    # with a single call to the executor.
+    handles_one_step = True
+
+    def __init__(self, engine, loop, max_workers=None):
+        self.engine = engine
+        self.loop = loop
+        self.absolute_source = getattr(engine, "absolute_source", True)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    def _run(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    def get(self, key):
+        return self._run(self.engine.__getitem__, key)
+
+    def set(self, key, value):
+        return self._run(self.engine.__setitem__, key, value)
+
+    def delete(self, key):
+        return self._run(self.engine.__delitem__, key)
+
+    def report(self, keys):
+        return self._run(self._increment, keys, False)
+
+    def whitelist(self, keys):
+        return self._run(self._increment, keys, True)
+
+    def _increment(self, keys, whitelist):
+        if getattr(self.engine, "handles_one_step", False):
+            if whitelist:
+                self.engine.whitelist(keys)
+            else:
+                self.engine.report(keys)
+            return
+        for key in keys:
+            # Not read from the cache, see BaseEngine.get_fresh.
+            (record,) = pyzor.engines.common.fresh_records(self.engine, [key])
+            if record is None:
+                record = pyzor.engines.common.Record()
+            if whitelist:
+                record.wl_increment()
+            else:
+                record.r_increment()
+            self.engine[key] = record
+
+    async def flush(self, force=False):
+        """Write the buffered increments, if the engine is buffered (see
+        pyzor.engines.buffer).
+        """
+        flush = getattr(self.engine, "flush", None)
+        if flush is not None:
+            await self._run(flush, force)
+
+    async def close(self):
+        await self.flush(True)
+        self.executor.shutdown(wait=True)
+
+
+class AsyncSingleflight(pyzor.server.Singleflight):
+    """Share the result of the coroutines awaited with the same key at the
+    same time, like pyzor.server.Singleflight does for the threads.
+    """
+
+    async def do(self, key, func, *args):
+        """Returns await func(*args), or the result of the call already in
+        progress for `key`.
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            future = self._calls[key] = asyncio.ensure_future(func(*args))
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        # The call goes on for the others if this request is cancelled.
+        return await asyncio.shield(future)
+
+
+class AsyncRequestHandler(pyzor.server.RequestHandler):
+    """Handle a single pyzord request in the event loop."""
+
+    def __init__(self, packet, client_address, server):
+        self.response = pyzor.message.Headers()
+        self.packet = packet
+        self.client_address = client_address
+        self.server = server
+        self.rfile = io.BytesIO(packet)
+
+    async def handle(self):
+        """Handle a pyzord operation, cleanly handling any errors. Returns
+        the encoded response.
+        """
+        self.start_response()
+        try:
+            user, opcode, digests = self.read_request()
+            dispatch = self.dispatches[opcode]
+            if dispatch and (digests or opcode == "stats"):
+                await dispatch(self, digests)
+            self.end_phase("engine")
+            self.log_usage(user, opcode, digests)
+            self.end_phase("log")
+        except Exception as e:
+            self.handle_exception(e)
+        return self.finish_response()
+
+    async def get_record(self, digest):
+        """Get the record from the database, or a blank one if there is no
+        matching record.
+        """
+        try:
+            return await self.server.database.get(digest)
+        except KeyError:
+            return pyzor.engines.common.Record()
+
+    async def lookup_record(self, digest):
+        """Get the record of a check or info request, see
+        pyzor.server.RequestHandler.lookup_record.
+        """
+        try:
+            if self.server.lookups is not None:
+                return await self.server.lookups.do(
+                    digest, self.server.database.get, digest
+                )
+            return await self.server.database.get(digest)
+        except KeyError:
+            return pyzor.engines.common.Record()
+
+    async def handle_pong(self, digests):
+        pyzor.server.RequestHandler.handle_pong(self, digests)
+
+    async def handle_check(self, digests):
+        digest = digests[0]
+        record = await self.lookup_record(digest)
+        self.server.log.debug("Request to check digest %s", digest)
+        self.set_counts(record)
+
+    async def handle_report(self, digests):
+        self.server.log.debug("Request to report digests %s", digests)
+        if self.server.one_step:
+            await self.server.database.report(digests)
+        else:
+            for digest in digests:
+                record = await self.get_record(digest)
+                record.r_increment()
+                await self.server.database.set(digest, record)
+        self.forward(digests)
+
+    async def handle_whitelist(self, digests):
+        self.server.log.debug("Request to whitelist digests %s", digests)
+        if self.server.one_step:
+            await self.server.database.whitelist(digests)
+        else:
+            for digest in digests:
+                record = await self.get_record(digest)
+                record.wl_increment()
+                await self.server.database.set(digest, record)
+        self.forward(digests, True)
+
+    async def handle_info(self, digests):
+        digest = digests[0]
+        record = await self.lookup_record(digest)
+        self.server.log.debug("Request for information about digest %s", digest)
+        self.set_info(record)
+
+    async def handle_stats(self, digests):
+        pyzor.server.RequestHandler.handle_stats(self, digests)
+
+    dispatches = {
+        "ping": None,
+        "pong": handle_pong,
+        "info": handle_info,
+        "check": handle_check,
+        "report": handle_report,
+        "whitelist": handle_whitelist,
+        "stats": handle_stats,
+    }
+
+
+class AsyncRejectedRequestHandler(AsyncRequestHandler):
+    """Answer a request that was not admitted by the server with an error,
+    see pyzor.server.RejectedRequestHandler.
+    """
+
+    errors = pyzor.server.RejectedRequestHandler.errors
+
+    def __init__(self, packet, client_address, server, reason):
+        AsyncRequestHandler.__init__(self, packet, client_address, server)
+        self.reason = reason
+
+    _really_handle = pyzor.server.RejectedRequestHandler._really_handle
+    handle_error = pyzor.server.RejectedRequestHandler.handle_error
+
+    def reject(self):
+        """Returns the encoded error response."""
+        self.start_response()
+        try:
+            self._really_handle()
+        except Exception as e:
+            self.handle_exception(e)
+        return self.finish_response()
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.process_request(data, addr)
+
+    def error_received(self, exc):
+        self.server.log.warning("Error on the server socket: %s", exc)
+
+
+class AsyncServer(object):
+    """The asyncio pyzord server. Handles all incoming UDP requests
+    concurrently in a single thread.
+
+    If the database is not natively asynchronous, its calls are made in a
+    pool of `max_workers` threads.
+
+    The rate limits and `max_pending` are the same as for
+    pyzor.server.Server, the pending requests are the ones being handled
+    by the event loop. Like the socketserver servers, it writes the
+    buffered increments and updates the metrics regularly, see
+    service_actions().
+    """
+
+    handler_class = AsyncRequestHandler
+    # See pyzor.server.Server.
+    slow_request_time = 0
+    profiler = None
+    receive_buffer = 0
+    send_buffer = 0
+    report_socket = True
+    coalesce_reads = False
+    hot_digests = None
+    prewarm_cache = False
+    max_packet_size = pyzor.server.Server.max_packet_size
+    metrics_interval = pyzor.server.Server.metrics_interval
+
+    def __init__(
+        self,
+        address,
+        database,
+        passwd_fn,
+        access_fn,
+        forwarder=None,
+        max_workers=None,
+        limits_fn=None,
+        max_pending=0,
+    ):
+        self.log = logging.getLogger("pyzord")
+        self.usage_log = logging.getLogger("pyzord-usage")
+        self.loop = asyncio.new_event_loop()
+        if not isinstance(database, pyzor.engines.common.AsyncBaseEngine):
+            if self.prewarm_cache and self.hot_digests is not None:
+                self.hot_digests.prewarm(database)
+            database = ExecutorEngine(database, self.loop, max_workers)
+        self.metrics = pyzor.metrics.Metrics()
+        self._socket_drops = None
+        self._next_metrics = 0
+        self.lookups = AsyncSingleflight() if self.coalesce_reads else None
+        self.database = pyzor.metrics.MeasuredAsyncEngine(database, self.metrics)
+        self.one_step = getattr(self.database, "handles_one_step", False)
+
+        # Handle configuration files
+        self.passwd_fn = passwd_fn
+        self.access_fn = access_fn
+        self.limits_fn = limits_fn
+        self.accounts = {}
+        self.hashed_keys = {}
+        self.acl = {}
+        self.limiter = None
+        self.load_config()
+
+        self.forwarder = forwarder
+        self.max_pending = max_pending
+
+        self.log.debug("Listening on %s", address)
+        if ":" in address[0]:
+            self.address_family = socket.AF_INET6
+        else:
+            self.address_family = socket.AF_INET
+        self.socket = socket.socket(self.address_family, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        try:
+            self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        except (AttributeError, socket.error) as e:
+            self.log.debug("Unable to set IPV6_V6ONLY to false %s", e)
+        pyzor.server.set_buffer_sizes(
+            self.socket, self.receive_buffer, self.send_buffer
+        )
+        self.socket.bind(address)
+        self.server_address = self.socket.getsockname()
+
+        self.transport = None
+        self._pending = set()
+        self._stopped = self.loop.create_future()
+
+        # Finally, set signals
+        self.loop.add_signal_handler(signal.SIGUSR1, self.reload_handler)
+        self.loop.add_signal_handler(signal.SIGUSR2, self.profile_handler)
+        self.loop.add_signal_handler(signal.SIGTERM, self.shutdown_handler)
+
+    def load_config(self):
+        """Reads the configuration files and loads the accounts, ACLs and
+        rate limits.
+        """
+        accounts = pyzor.config.load_passwd_file(self.passwd_fn)
+        self.hashed_keys = pyzor.server.hash_keys(accounts)
+        self.accounts = accounts
+        self.acl = pyzor.config.load_access_file(self.access_fn, self.accounts)
+        self.limiter = pyzor.server.load_limiter(self.limits_fn)
+
+    def update_metrics(self):
+        """Copy the statistics of the forwarder, the usage log, the database,
+        the coalesced lookups, the socket and the rate limits to the metrics.
+        """
+        pyzor.server.Server.update_metrics(self)
+
+    def serve_forever(self, poll_interval=0.5):
+        """Handle requests until shutdown() is called, and run the
+        service_actions() every `poll_interval` seconds.
+        """
+        self.loop.run_until_complete(self._serve(poll_interval))
+
+    async def _serve(self, poll_interval):
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _DatagramProtocol(self), sock=self.socket
+        )
+        service = self.loop.create_task(self._service(poll_interval))
+        await self._stopped
+        service.cancel()
+        # Answer the requests that are already being handled.
+        if self._pending:
+            await asyncio.wait(self._pending)
+        self.transport.close()
+
+    async def _service(self, poll_interval):
+        while True:
+            await asyncio.sleep(poll_interval)
+            try:
+                await self.service_actions()
+            except Exception:
+                self.log.error("Error in the service actions", exc_info=True)
+
+    async def service_actions(self):
+        """Write the buffered increments and update the metrics, like
+        pyzor.server.Server.service_actions().
+        """
+        flush = getattr(self.database, "flush", None)
+        if flush is not None:
+            await flush()
+        if time.time() >= self._next_metrics:
+            self._next_metrics = time.time() + self.metrics_interval
+            self.update_metrics()
+
+    def process_request(self, packet, client_address):
+        """Start handling a request, unless the client address is over its
+        rate limit or there are too many pending requests.
+        """
+        if self.limiter is not None and not self.limiter.allow_address(
+            client_address[0]
+        ):
+            self.reject_request(packet, client_address, "address")
+            return
+        if self.max_pending and len(self._pending) >= self.max_pending:
+            self.reject_request(packet, client_address, "busy")
+            return
+        task = self.loop.create_task(self.handle_request(packet, client_address))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def handle_request(self, packet, client_address):
+        start = pyzor.metrics.clock()
+        self.metrics.request_started()
+        handler = None
+        try:
+            handler = self.handler_class(packet, client_address, self)
+            response = await handler.handle()
+            self.transport.sendto(response, client_address)
+        except Exception:
+            self.handle_error(packet, client_address)
+        finally:
+            if handler is None:
+                opcode = code = None
+            else:
+                handler.end_phase("response")
+                opcode, code = handler.requested_op, handler.response["Code"]
+            duration = pyzor.metrics.clock() - start
+            self.metrics.request_finished(opcode, code, duration)
+            if handler is not None:
+                handler.record_phases(duration)
+
+    def reject_request(self, packet, client_address, reason):
+        """Answer the request with the error for the rejection `reason`,
+        without handling it.
+        """
+        start = pyzor.metrics.clock()
+        self.metrics.request_rejected(reason)
+        self.metrics.request_started()
+        handler = AsyncRejectedRequestHandler(packet, client_address, self, reason)
+        try:
+            self.transport.sendto(handler.reject(), client_address)
+        except Exception:
+            self.handle_error(packet, client_address)
+        finally:
+            self.metrics.request_finished(
+                handler.requested_op,
+                handler.response["Code"],
+                pyzor.metrics.clock() - start,
+            )
+
+    def _stop(self):
+        if not self._stopped.done():
+            self._stopped.set_result(None)
+
+    def shutdown(self):
+        """Stop the serve_forever loop. Unlike the other servers this
+        doesn't wait for the loop to stop and can be called from any thread.
+        """
+        self.loop.call_soon_threadsafe(self._stop)
+
+    def server_close(self):
+        """Clean-up the server."""
+        if self.transport is not None:
+            self.transport.close()
+        else:
+            self.socket.close()
+        self.loop.run_until_complete(self.database.close())
+        self.loop.close()
+        if self.hot_digests is not None:
+            self.hot_digests.save()
+
+    def shutdown_handler(self, *args, **kwargs):
+        """Handler for the SIGTERM signal. This should be used to kill the
+        daemon and ensure proper clean-up.
+        """
+        self.log.info("SIGTERM received. Shutting down.")
+        self._stop()
+
+    def reload_handler(self, *args, **kwargs):
+        """Handler for the SIGUSR1 signal. This should be used to reload
+        the configuration files.
+        """
+        self.log.info("SIGUSR1 received. Reloading configuration.")
+        self.loop.run_in_executor(None, self.load_config)
+
+    def profile_handler(self, *args, **kwargs):
+        """Handler for the SIGUSR2 signal. This should be used to profile
+        the server, see pyzor.profiling.
+        """
+        self.log.info("SIGUSR2 received. Profiling.")
+        pyzor.server.Server.start_profiler(self)
+
+    def handle_error(self, request, client_address):
+        self.log.error(
+            "Error while processing request from: %s", client_address, exc_info=True
+        )
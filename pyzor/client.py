@@ -21,9 +21,11 @@ To get a digest (of an email.message.Message object, or similar):
 
 >>> digest = pyzor.digest.DataDigester(msg).value
 
-To query a server (where address is a (host, port) pair):
+To query a server (where address is a (host, port) pair, or a (path, 0)
+pair for the Unix socket of a server running on the same host):
 
 >>> client.ping(address)
+>>> client.stats(address)
 >>> client.info(digest, address)
 >>> client.report(digest, address)
 >>> client.whitelist(digest, address)
@@ -52,24 +54,72 @@ All responses will have:
 `info` responses will also have:
 - '[WL-]Entered' timestamp when message was first whitelisted/blacklisted
 - '[WL-]Updated' timestamp when message was last whitelisted/blacklisted
+
+`stats` responses will have a 'Stat' header for each metric of the server.
 """
 
 import time
 import email
+import errno
+import bisect
+import select
+import hashlib
 import socket
 import logging
 import functools
+import itertools
 import collections
 
 import pyzor.digest
 import pyzor.account
 import pyzor.message
+import pyzor.stream
 
 import pyzor.hacks.py26
 
 pyzor.hacks.py26.hack_email()
 
 
+def is_unix_address(address):
+    """Whether the address is a Unix socket of a pyzord server running on
+    this host. Its host is the path of the socket, and its port is 0.
+    """
+    return address[0].startswith("/")
+
+
+def format_address(address):
+    """Returns the address as written in the servers file."""
+    if is_unix_address(address):
+        return "unix:%s" % address[0]
+    return "%s:%s" % address
+
+
+def _unix_socket():
+    """Returns a datagram socket for sending requests to a Unix socket. It's
+    bound to an unnamed address in the abstract namespace, which is only
+    supported by Linux, so that the server can send the response back
+    without write access to a file of the client.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.bind("")
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def _peer(sockaddr):
+    """Returns the part of the socket address that identifies the server
+    that answers a request. The responses received on a Unix socket are
+    only paired with their request by the thread id, since the server may
+    spell the path of its socket differently.
+    """
+    if isinstance(sockaddr, tuple):
+        return sockaddr[:2]
+    return socket.AF_UNIX
+
+
 class Client(object):
     timeout = 5
     max_packet_size = 8192
@@ -94,6 +144,13 @@ class Client(object):
         sock.close()
         return response
 
+    def stats(self, address=("public.pyzor.org", 24441)):
+        msg = pyzor.message.StatsRequest()
+        sock = self.send(msg, address)
+        response = self.read_response(sock, msg.get_thread())
+        sock.close()
+        return response
+
     def pong(self, digest, address=("public.pyzor.org", 24441)):
         msg = pyzor.message.PongRequest(digest)
         sock = self.send(msg, address)
@@ -130,15 +187,38 @@ class Client(object):
         return response
 
     def _mock_check(self, digests, address=None):
+        return self._local_response(0, 0)
+
+    def snapshot_check(self, digest, snapshot):
+        """Check the digest against a local pyzor.index.DigestSnapshot,
+        instead of a server. Digests missing from the snapshot have no
+        reports or whitelists.
+        """
+        counts = snapshot.get(digest)
+        if counts is None:
+            return self._local_response(0, 0)
+        return self._local_response(*counts)
+
+    @staticmethod
+    def _local_response(r_count, wl_count):
         msg = (
-            "Code: %s\nDiag: OK\nPV: %s\nThread: 1024\nCount: 0\n"
-            "WL-Count: 0" % (pyzor.message.Response.ok_code, pyzor.proto_version)
+            "Code: %s\nDiag: OK\nPV: %s\nThread: 1024\nCount: %d\n"
+            "WL-Count: %d"
+            % (pyzor.message.Response.ok_code, pyzor.proto_version, r_count, wl_count)
         ).encode("ascii")
         return email.message_from_bytes(msg, _class=pyzor.message.Response)
 
     def send(self, msg, address=("public.pyzor.org", 24441)):
         address = (address[0], int(address[1]))
         msg.init_for_sending()
+        self.sign(msg, address)
+        self.log.debug("sending: %r", msg.as_string())
+        return self._send(msg, address)
+
+    def sign(self, msg, address):
+        """Add the authentication headers for the account used with this
+        address. The message must already be initialised for sending.
+        """
         try:
             account = self.accounts[address]
         except KeyError:
@@ -149,11 +229,20 @@ class Client(object):
         msg["Sig"] = pyzor.account.sign_msg(
             pyzor.account.hash_key(account.key, account.username), timestamp, msg
         )
-        self.log.debug("sending: %r", msg.as_string())
-        return self._send(msg, address)
 
     @staticmethod
     def _send(msg, addr):
+        if is_unix_address(addr):
+            try:
+                sock = _unix_socket()
+            except socket.error as ex:
+                raise pyzor.CommError("Unable to send to %s: %s" % (addr[0], ex))
+            try:
+                sock.sendto(msg.as_string().encode("utf8"), 0, addr[0])
+            except socket.error as ex:
+                sock.close()
+                raise pyzor.CommError("Unable to send to %s: %s" % (addr[0], ex))
+            return sock
         sock = None
         for res in socket.getaddrinfo(
             addr[0], addr[1], 0, socket.SOCK_DGRAM, socket.IPPROTO_UDP
@@ -190,6 +279,9 @@ class Client(object):
             raise pyzor.CommError("Socket error while reading response: %s" % ex)
 
         self.log.debug("received: %r/%r", packet, address)
+        return self._parse_response(packet, expected_id)
+
+    def _parse_response(self, packet, expected_id):
         msg = email.message_from_bytes(packet, _class=pyzor.message.Response)
         msg.ensure_complete()
         try:
@@ -267,6 +359,441 @@ class BatchClient(Client):
         self.force()
 
 
+class HashRing(object):
+    """Consistent hashing of digests over a farm of servers, where each
+    server owns a part of the keyspace.
+
+    Every server is placed on the ring `vnodes` times (multiplied by its
+    weight) and a digest belongs to the first `replicas` distinct servers
+    found clockwise from its position.
+    """
+
+    def __init__(self, servers, replicas=1, vnodes=100, weights=None):
+        if weights is None:
+            weights = {}
+        self.servers = list(servers)
+        self.replicas = max(1, min(replicas, len(self.servers)))
+        points = []
+        for server in self.servers:
+            weight = weights.get(server, 1)
+            for i in range(max(1, int(round(vnodes * weight)))):
+                point = self._hash("%s:%s#%d" % (server[0], server[1], i))
+                points.append((point, server))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._owners = [server for _, server in points]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode("utf8")).hexdigest()[:16], 16)
+
+    def get_servers(self, digest):
+        """Return the list of servers that own this digest."""
+        servers = []
+        if not self._points:
+            return servers
+        start = bisect.bisect(self._points, self._hash(digest))
+        for i in range(len(self._owners)):
+            server = self._owners[(start + i) % len(self._owners)]
+            if server not in servers:
+                servers.append(server)
+                if len(servers) == self.replicas:
+                    break
+        return servers
+
+
+class _PipelineEntry(object):
+    """A request sent through the PipelinedClient."""
+
+    def __init__(self, msg, address):
+        self.msg = msg
+        self.address = address
+        self.key = None
+        self.deadline = None
+        self.response = None
+
+    @property
+    def done(self):
+        return self.response is not None
+
+
+class PipelinedClient(Client):
+    """Like the normal Client but it keeps up to `window` requests in flight
+    at the same time, across messages and servers, instead of waiting for
+    every response before sending the next request.
+    """
+
+    requests = {
+        "pong": pyzor.message.PongRequest,
+        "info": pyzor.message.InfoRequest,
+        "check": pyzor.message.CheckRequest,
+        "report": pyzor.message.ReportRequest,
+        "whitelist": pyzor.message.WhitelistRequest,
+    }
+
+    def __init__(self, accounts=None, timeout=None, spec=None, window=50, ring=None):
+        Client.__init__(self, accounts=accounts, timeout=timeout, spec=spec)
+        self.window = max(1, window)
+        self.ring = ring
+        self._addresses = {}
+
+    def pipeline_digests(self, op, digests, servers, batch_size=1):
+        """Send each digest from the `digests` iterable to every server, or
+        only to the servers owning it if the client has a HashRing. Up to
+        `batch_size` digests are packed in every request (this only makes
+        sense for the report and whitelist operations).
+
+        Yields (digest, results) tuples in input order, where `results` is
+        a list of (server, response) pairs. See `pipeline` for the possible
+        response values.
+        """
+        request = self.requests[op]
+        if issubclass(request, pyzor.message.SimpleDigestSpecBasedRequest):
+            request = functools.partial(request, spec=self.spec)
+        batches = collections.deque()
+
+        def requests():
+            digests_iter = (digest for digest in digests if digest)
+            while True:
+                batch = list(itertools.islice(digests_iter, batch_size))
+                if not batch:
+                    return
+                targets = collections.OrderedDict()
+                for digest in batch:
+                    if self.ring is not None:
+                        owners = self.ring.get_servers(digest)
+                    else:
+                        owners = servers
+                    for server in owners:
+                        targets.setdefault(server, []).append(digest)
+                batches.append((batch, len(targets)))
+                for server, group in targets.items():
+                    msg = request()
+                    for digest in group:
+                        msg.add_digest(digest)
+                    yield msg, server
+
+        results = []
+        for msg, server, response in self.pipeline(requests()):
+            results.append((set(msg.get_all("Op-Digest")), server, response))
+            batch, count = batches[0]
+            if len(results) == count:
+                batches.popleft()
+                for digest in batch:
+                    yield digest, [
+                        (server, response)
+                        for group, server, response in results
+                        if digest in group
+                    ]
+                results = []
+
+    def pipeline(self, requests):
+        """Send every (msg, address) pair from the `requests` iterable and
+        yield (msg, address, response) tuples in the same order.
+
+        If the request failed, the response is the pyzor.CommError that
+        describes the failure instead.
+        """
+        requests = iter(requests)
+        pending = collections.deque()
+        in_flight = collections.OrderedDict()
+        sockets = {}
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(in_flight) < self.window:
+                    try:
+                        msg, address = next(requests)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    entry = _PipelineEntry(msg, address)
+                    pending.append(entry)
+                    self._pipeline_send(entry, in_flight, sockets)
+                while pending and pending[0].done:
+                    entry = pending.popleft()
+                    yield entry.msg, entry.address, entry.response
+                if in_flight:
+                    self._pipeline_read(in_flight, sockets)
+                elif exhausted and not pending:
+                    return
+        finally:
+            for sock in sockets.values():
+                sock.close()
+
+    def _resolve(self, address):
+        """Return the (family, sockaddr) pair for this address."""
+        try:
+            return self._addresses[address]
+        except KeyError:
+            pass
+        if is_unix_address(address):
+            self._addresses[address] = socket.AF_UNIX, address[0]
+            return socket.AF_UNIX, address[0]
+        try:
+            res = socket.getaddrinfo(
+                address[0], address[1], 0, socket.SOCK_DGRAM, socket.IPPROTO_UDP
+            )
+        except socket.error as ex:
+            raise pyzor.CommError("Unable to resolve %s:%s: %s" % (address + (ex,)))
+        af, _, _, _, sa = res[0]
+        self._addresses[address] = af, sa
+        return af, sa
+
+    def _pipeline_send(self, entry, in_flight, sockets):
+        address = (entry.address[0], int(entry.address[1]))
+        msg = entry.msg
+        try:
+            af, sa = self._resolve(address)
+            try:
+                sock = sockets[af]
+            except KeyError:
+                try:
+                    if af == socket.AF_UNIX:
+                        sock = _unix_socket()
+                    else:
+                        sock = socket.socket(af, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+                except socket.error as ex:
+                    raise pyzor.CommError(
+                        "Unable to send to %s: %s" % (format_address(address), ex)
+                    )
+                sock.setblocking(False)
+                sockets[af] = sock
+            msg.init_for_sending()
+            # The thread id must be unique among the requests waiting for
+            # a response from the same server.
+            thread = msg.get_thread()
+            while (_peer(sa), thread) in in_flight:
+                thread = pyzor.message.ThreadId.generate()
+                msg.replace_header("Thread", str(thread))
+            self.sign(msg, address)
+            self.log.debug("sending: %r", msg.as_string())
+            try:
+                sock.sendto(msg.as_string().encode("utf8"), 0, sa)
+            except socket.error as ex:
+                raise pyzor.CommError(
+                    "Unable to send to %s: %s" % (format_address(address), ex)
+                )
+        except pyzor.CommError as ex:
+            entry.response = ex
+            return
+        entry.key = (_peer(sa), thread)
+        entry.deadline = time.time() + self.timeout
+        in_flight[entry.key] = entry
+
+    def _pipeline_read(self, in_flight, sockets):
+        # The requests are kept in the order they were sent, so the first
+        # one is always the first to time out.
+        first = next(iter(in_flight.values()))
+        wait = max(0, first.deadline - time.time())
+        try:
+            readable = select.select(list(sockets.values()), [], [], wait)[0]
+        except (OSError, select.error) as ex:
+            if ex.args[0] != errno.EINTR:
+                raise
+            readable = []
+        for sock in readable:
+            self._pipeline_drain(sock, in_flight)
+        now = time.time()
+        while in_flight:
+            entry = next(iter(in_flight.values()))
+            if entry.deadline > now:
+                break
+            del in_flight[entry.key]
+            entry.response = pyzor.TimeoutError("Reading response timed-out.")
+
+    def _pipeline_drain(self, sock, in_flight):
+        while True:
+            try:
+                packet, address = sock.recvfrom(self.max_packet_size)
+            except socket.error as ex:
+                if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                # Errors like ECONNREFUSED cannot be attributed to a request
+                # on an unconnected socket, these will time out.
+                self.log.debug("Socket error while reading responses: %s", ex)
+                return
+            self.log.debug("received: %r/%r", packet, address)
+            msg = email.message_from_bytes(packet, _class=pyzor.message.Response)
+            try:
+                thread = msg.get_thread()
+            except (KeyError, TypeError, ValueError):
+                self.log.warn("no valid thread id received from %s", address)
+                continue
+            try:
+                entry = in_flight.pop((_peer(address), thread))
+            except KeyError:
+                self.log.warn("received unexpected thread id %d", thread)
+                continue
+            try:
+                msg.ensure_complete()
+            except pyzor.ProtocolError as ex:
+                entry.response = ex
+            else:
+                entry.response = msg
+
+
+class _StreamConnection(object):
+    """A stream connection kept open to a pyzord server by the StreamClient.
+    The responses are sent back in the order of the requests.
+    """
+
+    def __init__(self, address, timeout):
+        self.address = address
+        try:
+            if is_unix_address(address):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(timeout)
+                try:
+                    sock.connect(address[0])
+                except socket.error:
+                    sock.close()
+                    raise
+            else:
+                sock = socket.create_connection(address, timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.timeout:
+            raise pyzor.TimeoutError("Connecting to %s:%s timed-out." % address)
+        except socket.error as ex:
+            raise pyzor.CommError("Unable to connect to %s:%s: %s" % (address + (ex,)))
+        self.sock = sock
+        self.rfile = sock.makefile("rb")
+        # The requests waiting for a response, oldest first.
+        self.pending = collections.deque()
+        self.closed = False
+
+    def send(self, data, request=None):
+        try:
+            self.sock.sendall(pyzor.stream.pack(data))
+        except socket.error as ex:
+            self.abort()
+            raise pyzor.CommError(
+                "Unable to send to %s:%s: %s" % (self.address + (ex,))
+            )
+        self.pending.append(request)
+
+    def read(self, timeout):
+        """Returns the next response, and the request it answers."""
+        self.sock.settimeout(max(timeout, 0.001))
+        try:
+            packet = pyzor.stream.read_message(self.rfile)
+        except socket.timeout:
+            self.abort()
+            raise pyzor.TimeoutError("Reading response timed-out.")
+        except socket.error as ex:
+            self.abort()
+            raise pyzor.CommError("Socket error while reading response: %s" % ex)
+        except pyzor.ProtocolError:
+            self.abort()
+            raise
+        if packet is None:
+            self.abort()
+            raise pyzor.CommError("Connection closed by %s:%s." % self.address)
+        return packet, self.pending.popleft()
+
+    def close(self):
+        """The connection is kept open for the next requests, unless some
+        responses were not read.
+        """
+        if self.pending:
+            self.abort()
+
+    def abort(self):
+        self.closed = True
+        self.rfile.close()
+        self.sock.close()
+
+
+class StreamClient(PipelinedClient):
+    """Like the PipelinedClient, but the requests are sent over a stream
+    connection kept open to each server instead of UDP datagrams: TCP, or
+    a Unix socket if the host is the path of the socket. See pyzor.stream.
+
+    The requests are not limited to max_packet_size, so the report and
+    whitelist requests can carry many more digests.
+    """
+
+    def __init__(self, accounts=None, timeout=None, spec=None, window=50, ring=None):
+        PipelinedClient.__init__(
+            self,
+            accounts=accounts,
+            timeout=timeout,
+            spec=spec,
+            window=window,
+            ring=ring,
+        )
+        self._connections = {}
+
+    def _connect(self, address):
+        """Return the connection to this address, opening it if needed."""
+        connection = self._connections.get(address)
+        if connection is None or connection.closed:
+            connection = _StreamConnection(address, self.timeout)
+            self._connections[address] = connection
+        return connection
+
+    def close(self):
+        """Close the connections to the servers."""
+        for connection in self._connections.values():
+            if not connection.closed:
+                connection.abort()
+        self._connections.clear()
+
+    def _send(self, msg, address):
+        connection = self._connect(address)
+        connection.send(msg.as_string().encode("utf8"), msg)
+        return connection
+
+    def read_response(self, connection, expected_id):
+        packet, _ = connection.read(self.timeout)
+        self.log.debug("received: %r/%r", packet, connection.address)
+        return self._parse_response(packet, expected_id)
+
+    def _pipeline_send(self, entry, in_flight, sockets):
+        address = (entry.address[0], int(entry.address[1]))
+        msg = entry.msg
+        try:
+            connection = self._connect(address)
+            msg.init_for_sending()
+            self.sign(msg, address)
+            self.log.debug("sending: %r", msg.as_string())
+            connection.send(msg.as_string().encode("utf8"), entry)
+        except pyzor.CommError as ex:
+            entry.response = ex
+            return
+        # The connections still waiting for responses are closed if the
+        # pipeline is not run to the end.
+        sockets[address] = connection
+        entry.key = (connection, id(entry))
+        entry.deadline = time.time() + self.timeout
+        in_flight[entry.key] = entry
+
+    def _pipeline_read(self, in_flight, sockets):
+        # The responses come back in order on each connection, so the first
+        # request in flight is the next one answered on its connection.
+        first = next(iter(in_flight.values()))
+        connection = first.key[0]
+        try:
+            packet, entry = connection.read(first.deadline - time.time())
+        except pyzor.CommError as ex:
+            # The connection is closed, its other requests are lost too.
+            for key in [key for key in in_flight if key[0] is connection]:
+                in_flight.pop(key).response = ex
+            return
+        del in_flight[entry.key]
+        self.log.debug("received: %r/%r", packet, connection.address)
+        try:
+            entry.response = self._parse_response(packet, entry.msg.get_thread())
+        except pyzor.ProtocolError as ex:
+            entry.response = ex
+
+
+def _return_or_raise(response):
+    if isinstance(response, Exception):
+        raise response
+    return response
+
+
 class ClientRunner(object):
     def __init__(self, routine):
         self.log = logging.getLogger("pyzor")
@@ -277,10 +804,20 @@ class ClientRunner(object):
     def run(self, server, args, kwargs=None):
         if kwargs is None:
             kwargs = {}
-        message = "%s:%s\t" % server
+        self._handle(server, self.routine, args, kwargs)
+
+    def add_result(self, server, response):
+        """Handle a response that was obtained without calling the routine,
+        e.g. through the PipelinedClient. The response may also be the
+        pyzor.CommError that was raised instead.
+        """
+        self._handle(server, _return_or_raise, (response,), {})
+
+    def _handle(self, server, routine, args, kwargs):
+        message = "%s\t" % format_address(server)
         response = None
         try:
-            response = self.routine(*args, **kwargs)
+            response = routine(*args, **kwargs)
             self.handle_response(response, message)
         except (pyzor.CommError, KeyError, ValueError) as e:
             self.results.append("%s%s\n" % (message, (e.code, str(e))))
@@ -344,3 +881,14 @@ class InfoClientRunner(ClientRunner):
         else:
             self.all_ok = False
         self.results.append(message + "\n")
+
+
+class StatsClientRunner(ClientRunner):
+    def handle_response(self, response, message):
+        message += "%s\n" % str(response.head_tuple())
+        if response.is_ok():
+            for line in response.get_all("Stat", ()):
+                message += "\t%s\n" % line
+        else:
+            self.all_ok = False
+        self.results.append(message)
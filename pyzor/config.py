@@ -12,7 +12,10 @@ try:
 except ImportError:
     _has_sentry = False
 
+import pyzor.index
+import pyzor.client
 import pyzor.account
+import pyzor.usagelog
 
 _COMMENT_P = re.compile(r"((?<=[^\\])#.*)")
 
@@ -97,6 +100,52 @@ def load_access_file(access_fn, accounts):
     return acl
 
 
+def load_limits_file(limits_fn):
+    """Load the rate limits from the specified file, if it exists, and
+    return a dictionary that maps "address" and "user" to dictionaries of
+    (rate, burst) tuples by name, as expected by pyzor.limits.RateLimiter.
+
+    Each line of the file should be in the following format:
+        address|user : names : rate [burst]
+    where 'names' is a space-separated list of client IP addresses or
+    usernames, or the keyword 'all' (meaning every address or user that
+    has no limit of its own), 'rate' is the number of requests per second
+    allowed for each of them and 'burst' is the number of requests that can
+    be made at once (this defaults to the rate). A rate of 0 removes the
+    limit.
+
+    If the file does not exist, then None is returned and the requests are
+    not limited.
+    """
+    log = logging.getLogger("pyzord")
+    if not os.path.exists(limits_fn):
+        log.info("No rate limits file, the requests are not limited.")
+        return None
+    limits = {"address": {}, "user": {}}
+    with open(limits_fn) as limitsf:
+        for line in limitsf:
+            if not line.strip() or line[0] == "#":
+                continue
+            try:
+                # The IPv6 addresses also contain colons.
+                kind, names = line.split(":", 1)
+                names, values = names.rsplit(":", 1)
+                values = [float(value) for value in values.split()]
+                rate = values[0]
+                burst = values[1] if len(values) > 1 else max(rate, 1)
+                if len(values) > 2 or rate < 0 or burst < 1:
+                    raise ValueError(values)
+                kind_limits = limits[kind.strip().lower()]
+            except (ValueError, IndexError, KeyError):
+                log.warning("Invalid rate limits line: %r", line)
+                continue
+            for name in names.split():
+                log.debug("Limiting %s %s to %s/s (burst %s).", kind, name, rate, burst)
+                kind_limits[name] = (rate, burst)
+    log.info("Rate limits: %r", limits)
+    return limits
+
+
 def load_passwd_file(passwd_fn):
     """Load the accounts from the specified file.
 
@@ -179,19 +228,68 @@ def load_accounts(filepath):
     return accounts
 
 
+def _parse_options(parts, types, where):
+    """Parse a list of key=value strings into a dictionary, converting the
+    values with the `types` dictionary. Invalid options are ignored.
+    """
+    log = logging.getLogger("pyzor")
+    options = {}
+    for part in parts:
+        try:
+            key, value = part.split("=", 1)
+            options[key] = types[key](value)
+        except (KeyError, ValueError):
+            log.warning("%s: invalid option %r", where, part)
+    return options
+
+
+def _read_servers_file(filepath):
+    """Read the servers file and return a tuple with the list of servers,
+    the server options and the sharding options (or None if the servers
+    file doesn't configure sharding).
+    """
+    servers = []
+    server_options = {}
+    sharding = None
+    if not os.path.exists(filepath):
+        return servers, server_options, sharding
+    with open(filepath) as serverf:
+        for line in serverf:
+            line = line.strip()
+            if line.lower().startswith("sharding:"):
+                sharding = _parse_options(
+                    line.split(":", 1)[1].split(),
+                    {"replicas": int, "vnodes": int},
+                    "servers file",
+                )
+            elif line.startswith("unix:/") or re.match(
+                "[^#][a-zA-Z0-9.-]+:[0-9]+", line
+            ):
+                parts = line.split()
+                if parts[0].startswith("unix:"):
+                    # The Unix socket of a local server, see
+                    # pyzor.client.is_unix_address.
+                    server = (parts[0][len("unix:") :], 0)
+                else:
+                    address, port = parts[0].rsplit(":", 1)
+                    server = (address, int(port))
+                servers.append(server)
+                server_options[server] = _parse_options(
+                    parts[1:], {"weight": float}, "servers file %s" % parts[0]
+                )
+    return servers, server_options, sharding
+
+
 def load_servers(filepath):
-    """Load the servers file."""
+    """Load the servers file.
+
+    Each server is specified on a separate line as address:port, or as
+    unix:/path/to/socket for the Unix socket of a server running on the same
+    host, optionally followed by whitespace-separated key=value options
+    (e.g. weight=2).
+    """
     logger = logging.getLogger("pyzor")
-    if not os.path.exists(filepath):
-        servers = []
-    else:
-        servers = []
-        with open(filepath) as serverf:
-            for line in serverf:
-                line = line.strip()
-                if re.match("[^#][a-zA-Z0-9.-]+:[0-9]+", line):
-                    address, port = line.rsplit(":", 1)
-                    servers.append((address, int(port)))
+    servers = _read_servers_file(filepath)[0]
 
     if not servers:
         logger.info("No servers specified, defaulting to public.pyzor.org.")
@@ -199,11 +297,46 @@ def load_servers(filepath):
     return servers
 
 
+def load_server_ring(filepath):
+    """Load the sharding configuration from the servers file.
+
+    Sharding is enabled with a line in the following format:
+        sharding: replicas=1 vnodes=100
+
+    In this case a pyzor.client.HashRing is returned, that sends each digest
+    only to the servers owning it. The `weight` option of each server
+    increases or decreases the part of the keyspace it owns. If sharding
+    isn't enabled, None is returned.
+    """
+    servers, server_options, sharding = _read_servers_file(filepath)
+    if sharding is None or not servers:
+        return None
+    weights = dict(
+        (server, options["weight"])
+        for server, options in server_options.items()
+        if "weight" in options
+    )
+    return pyzor.client.HashRing(
+        servers,
+        replicas=sharding.get("replicas", 1),
+        vnodes=sharding.get("vnodes", 100),
+        weights=weights,
+    )
+
+
 def load_local_whitelist(filepath):
-    """Load the local digest skip file."""
+    """Load the local digest skip file.
+
+    If the file is an indexed whitelist, a pyzor.index.DigestSet is returned
+    instead of a set. This supports the same lookups, without loading the
+    whole file.
+    """
     if not os.path.exists(filepath):
         return set()
 
+    if pyzor.index.is_index(filepath):
+        return pyzor.index.DigestSet(filepath)
+
     whitelist = set()
     with open(filepath) as serverf:
         for line in serverf:
@@ -214,10 +347,47 @@ def load_local_whitelist(filepath):
     return whitelist
 
 
+def load_snapshot(filepath):
+    """Load the local snapshot of the digest database, created with
+    pyzor-migrate. Returns a pyzor.index.DigestSnapshot or None if the file
+    is missing or invalid.
+    """
+    log = logging.getLogger("pyzor")
+    if not os.path.exists(filepath):
+        log.warning("Snapshot file %s does not exist.", filepath)
+        return None
+    try:
+        return pyzor.index.DigestSnapshot(filepath)
+    except (IOError, OSError, ValueError) as e:
+        log.warning("Unable to load snapshot: %s", e)
+        return None
+
+
 # Common configurations
-def setup_logging(log_name, filepath, debug, sentry_dsn=None, sentry_lvl="WARN"):
+def setup_logging(
+    log_name,
+    filepath,
+    debug,
+    sentry_dsn=None,
+    sentry_lvl="WARN",
+    file_format="text",
+    queue_size=0,
+    batch_size=100,
+    sample_rate=1,
+    stats_interval=0,
+):
     """Setup logging according to the specified options. Return the Logger
     object.
+
+    The log file is written in `file_format`, see pyzor.usagelog.FORMATS.
+    If `queue_size` is set, the records are written asynchronously in
+    batches of up to `batch_size` records (see
+    pyzor.usagelog.AsyncFileHandler).
+
+    Only a `sample_rate` fraction of the records of the requests are
+    written to the log file. If `stats_interval` is set, the totals of the
+    requests are written every `stats_interval` seconds (see
+    pyzor.usagelog.UsageStatsHandler).
     """
     fmt = logging.Formatter("%(asctime)s (%(process)d) %(levelname)s " "%(message)s")
 
@@ -238,10 +408,24 @@ def setup_logging(log_name, filepath, debug, sentry_dsn=None, sentry_lvl="WARN")
     logger.addHandler(stream_handler)
 
     if filepath:
-        file_handler = logging.FileHandler(filepath)
+        if queue_size:
+            file_handler = pyzor.usagelog.AsyncFileHandler(
+                filepath, queue_size, batch_size
+            )
+        else:
+            file_handler = logging.FileHandler(filepath)
         file_handler.setLevel(file_log_level)
-        file_handler.setFormatter(fmt)
+        if file_format == "csv":
+            file_handler.setFormatter(pyzor.usagelog.CSVFormatter())
+        else:
+            file_handler.setFormatter(fmt)
+        if sample_rate < 1:
+            file_handler.addFilter(pyzor.usagelog.SampleFilter(sample_rate))
         logger.addHandler(file_handler)
+        if stats_interval:
+            logger.addHandler(
+                pyzor.usagelog.UsageStatsHandler(file_handler, stats_interval)
+            )
 
     if sentry_dsn and _has_sentry:
         sentry_sdk.init("https://8cb95c088d04414e885879898a952d05@sentry.io/1443213")
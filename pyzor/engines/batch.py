@@ -0,0 +1,137 @@
+"""Read batching for the database engines.
+
+The BatchedEngine wraps any engine and gathers the records looked up at the
+same time by concurrent requests, fetching them with a single get_many call
+instead of one call for each record. With a remote database this saves a
+round trip for most of the lookups, at the cost of a short wait.
+"""
+
+import copy
+import threading
+
+from pyzor.engines.common import *
+
+
+class _Batch(object):
+    """The keys looked up together, and the records fetched for them."""
+
+    def __init__(self):
+        # The distinct keys, in the order they were looked up.
+        self.keys = {}
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.records = None
+        self.error = None
+
+
+class BatchedEngine(BaseEngine):
+    """Batch the lookups made to `engine` by concurrent threads.
+
+    The first thread that looks up a record waits up to `window` seconds
+    for other lookups, or until `max_keys` distinct keys are waiting, then
+    fetches all the records with a single get_many call. The other threads
+    wait for that call and get their record from its result.
+
+    This only helps when the lookups are made from several threads, like
+    with the threaded servers, otherwise every lookup just waits for
+    `window` seconds. The other calls are made to the engine directly.
+    """
+
+    def __init__(self, engine, window=0.001, max_keys=64):
+        self.engine = engine
+        self.absolute_source = getattr(engine, "absolute_source", True)
+        self.handles_one_step = getattr(engine, "handles_one_step", False)
+        self.window = window
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._batch = None
+        self.lookups = 0
+        self.batches = 0
+        self.keys = 0
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def __iter__(self):
+        return iter(self.engine)
+
+    def iteritems(self):
+        return self.engine.iteritems()
+
+    def items(self):
+        return self.engine.items()
+
+    def __getitem__(self, key):
+        with self._lock:
+            self.lookups += 1
+            batch = self._batch
+            first = batch is None
+            if first:
+                batch = self._batch = _Batch()
+            batch.keys[key] = None
+            if len(batch.keys) >= self.max_keys:
+                # The next lookups start a new batch.
+                self._batch = None
+                batch.full.set()
+        if first:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            self._fetch(batch)
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        record = batch.records[key]
+        if record is None:
+            raise KeyError(key)
+        # The same key may be looked up by several threads, and the callers
+        # may change the record.
+        return copy.copy(record)
+
+    def _fetch(self, batch):
+        """Get the records of the batch and wake up the waiting threads."""
+        try:
+            keys = list(batch.keys)
+            batch.records = dict(zip(keys, self.engine.get_many(keys)))
+        except Exception as e:
+            batch.error = e
+        finally:
+            with self._lock:
+                self.batches += 1
+                self.keys += len(batch.keys)
+            batch.done.set()
+
+    def get_many(self, keys):
+        return self.engine.get_many(keys)
+
+    def __setitem__(self, key, value):
+        self.engine[key] = value
+
+    def __delitem__(self, key):
+        del self.engine[key]
+
+    def report(self, keys):
+        self.engine.report(keys)
+
+    def whitelist(self, keys):
+        self.engine.whitelist(keys)
+
+    def report_counts(self, counts):
+        self.engine.report_counts(counts)
+
+    def whitelist_counts(self, counts):
+        self.engine.whitelist_counts(counts)
+
+    def stats(self):
+        """Returns a dictionary with the number of records looked up, the
+        number of get_many calls made for them, and the number of distinct
+        keys fetched by these calls.
+        """
+        with self._lock:
+            return {
+                "lookups": self.lookups,
+                "batches": self.batches,
+                "keys": self.keys,
+            }
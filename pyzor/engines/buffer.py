@@ -0,0 +1,234 @@
+"""Write buffer for the database engines.
+
+The BufferedEngine wraps any engine and sums the reports and whitelists of
+each digest in memory, writing them to the engine in bulk. When the same
+digests are reported many times, this saves most of the database calls.
+"""
+
+import copy
+import time
+import logging
+import threading
+
+from pyzor.engines.common import *
+
+
+class BufferedEngine(BaseEngine):
+    """Buffer the increments for `engine` and write them every
+    `flush_interval` seconds, or as soon as `max_entries` digests have
+    pending increments.
+
+    Reading a record from the engine includes the pending increments, so
+    the buffer is not visible to the server that uses it. Other servers
+    sharing the same database will see the increments after at most
+    `flush_interval` seconds, as long as flush() is called regularly.
+
+    The buffer must be flushed with flush(True) before the server exits, or
+    the pending increments are lost.
+
+    The increments being written are dropped from the buffer as soon as
+    each engine call returns. A record read while it's written can still
+    be off by these increments: it's read from the engine before or during
+    the call, and merged with the buffer after it. This only affects that
+    read.
+    """
+
+    log = logging.getLogger("pyzord")
+
+    def __init__(self, engine, flush_interval=0.1, max_entries=1000):
+        self.engine = engine
+        self.absolute_source = getattr(engine, "absolute_source", True)
+        # The increments are always handled here.
+        self.handles_one_step = True
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        # Maps the keys to a Record with the pending increments, that is
+        # the counts to add and the times of the first and last increments.
+        self._pending = {}
+        # The increments that are being written.
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.time()
+        self.increments = 0
+        self.writes = 0
+        self.flushes = 0
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def __iter__(self):
+        return iter(self.engine)
+
+    def iteritems(self):
+        return self.engine.iteritems()
+
+    def items(self):
+        return self.engine.items()
+
+    @staticmethod
+    def _merge(record, delta):
+        """Add the increments in `delta` to `record`."""
+        if delta.r_count:
+            record.r_count += delta.r_count
+            record.r_entered = record.r_entered or delta.r_entered
+            record.r_updated = delta.r_updated
+        if delta.wl_count:
+            record.wl_count += delta.wl_count
+            record.wl_entered = record.wl_entered or delta.wl_entered
+            record.wl_updated = delta.wl_updated
+
+    def _add_pending(self, key, record):
+        """Add the increments that are not written yet to `record`. Returns
+        None if there is no record and no pending increment.
+        """
+        with self._lock:
+            deltas = [
+                pending[key]
+                for pending in (self._flushing, self._pending)
+                if key in pending
+            ]
+        if not deltas:
+            return record
+        if record is None:
+            record = Record()
+        else:
+            record = copy.copy(record)
+        for delta in deltas:
+            self._merge(record, delta)
+        return record
+
+    def __getitem__(self, key):
+        try:
+            record = self.engine[key]
+        except KeyError:
+            record = None
+        record = self._add_pending(key, record)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def get_many(self, keys):
+        records = self.engine.get_many(keys)
+        return [self._add_pending(key, record) for key, record in zip(keys, records)]
+
+    def get_fresh(self, keys):
+        records = fresh_records(self.engine, keys)
+        return [self._add_pending(key, record) for key, record in zip(keys, records)]
+
+    def __setitem__(self, key, value):
+        self.engine[key] = value
+
+    def __delitem__(self, key):
+        del self.engine[key]
+
+    def _increment(self, keys, whitelist):
+        with self._lock:
+            for key in keys:
+                try:
+                    delta = self._pending[key]
+                except KeyError:
+                    delta = self._pending[key] = Record()
+                if whitelist:
+                    delta.wl_increment()
+                else:
+                    delta.r_increment()
+            self.increments += len(keys)
+            full = len(self._pending) >= self.max_entries
+        if full:
+            self.flush(True)
+        else:
+            self.flush()
+
+    def report(self, keys):
+        self._increment(keys, False)
+
+    def whitelist(self, keys):
+        self._increment(keys, True)
+
+    def flush(self, force=False):
+        """Write the pending increments to the engine, if `flush_interval`
+        has passed since the last time, or if `force` is true.
+        """
+        if not force and time.time() - self._last_flush < self.flush_interval:
+            return
+        with self._flush_lock:
+            with self._lock:
+                self._last_flush = time.time()
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+            try:
+                self._write(self._flushing)
+            except Exception as e:
+                # Keep the increments that were not written, they are
+                # written with the next flush.
+                self.log.error("Unable to write the buffered increments: %s", e)
+                with self._lock:
+                    pending, self._pending = self._pending, self._flushing
+                    self._flushing = {}
+                    for key, delta in pending.items():
+                        if key in self._pending:
+                            self._merge(self._pending[key], delta)
+                        else:
+                            self._pending[key] = delta
+
+    def _written(self, keys, whitelist):
+        """Drop the reports of `keys`, or their whitelists if `whitelist` is
+        true, from the increments being written, once they are written.
+        """
+        with self._lock:
+            for key in keys:
+                delta = self._flushing[key]
+                if whitelist:
+                    delta.wl_count = 0
+                else:
+                    delta.r_count = 0
+                if not delta.r_count and not delta.wl_count:
+                    del self._flushing[key]
+
+    def _write(self, deltas):
+        keys = list(deltas)
+        if getattr(self.engine, "handles_one_step", False):
+            # The summed counts are added with a single update for each key.
+            reports = dict(
+                (key, deltas[key].r_count) for key in keys if deltas[key].r_count
+            )
+            whitelists = dict(
+                (key, deltas[key].wl_count) for key in keys if deltas[key].wl_count
+            )
+            if reports:
+                self.engine.report_counts(reports)
+                self._written(reports, False)
+            if whitelists:
+                self.engine.whitelist_counts(whitelists)
+                self._written(whitelists, True)
+        else:
+            records = fresh_records(self.engine, keys)
+            for key, record in zip(keys, records):
+                if record is None:
+                    record = Record()
+                self._merge(record, deltas[key])
+                self.engine[key] = record
+                with self._lock:
+                    del self._flushing[key]
+        with self._lock:
+            self.writes += len(keys)
+            self.flushes += 1
+
+    def stats(self):
+        """Returns a dictionary with the buffer statistics. The coalescing
+        ratio is the number of increments received for each record written.
+        """
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "increments": self.increments,
+                "writes": self.writes,
+                "flushes": self.flushes,
+                "coalescing_ratio": (
+                    float(self.increments - len(self._pending)) / self.writes
+                    if self.writes
+                    else 0.0
+                ),
+            }
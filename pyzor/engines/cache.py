@@ -0,0 +1,225 @@
+"""In-process read cache for the database engines.
+
+The CachedEngine wraps any engine and keeps the most recently used records
+in memory for a limited time, so that the digests that are checked often
+don't need a call to the database every time.
+"""
+
+import sys
+import copy
+import time
+import datetime
+import threading
+import collections
+
+from pyzor.engines.common import *
+
+# Returned by _lookup when the key is not cached.
+_MISS = object()
+
+
+def _estimate_entry_size():
+    """Estimate the memory used by a cached record, without the key."""
+    now = datetime.datetime.now()
+    record = Record(1, 1, now, now, now, now)
+    size = sys.getsizeof(record) + sys.getsizeof(record.__dict__)
+    size += 4 * sys.getsizeof(now)
+    # The cache entry itself and the OrderedDict overhead.
+    size += sys.getsizeof((0, record, 0)) + 100
+    return size
+
+
+_ENTRY_SIZE = _estimate_entry_size()
+
+
+class CachedEngine(BaseEngine):
+    """Cache the records of `engine` in a LRU cache, limited to
+    `max_entries` records and/or about `max_bytes` bytes of memory.
+
+    Records are kept for `ttl` seconds, missing records are remembered for
+    `negative_ttl` seconds (0 disables negative caching). Reports and
+    whitelists are written through to the engine and update the cached
+    record. The records read with get_fresh(), to be incremented, are
+    always read from the engine.
+
+    The cache is thread-safe, but is not shared between processes.
+    """
+
+    def __init__(self, engine, max_entries=0, max_bytes=0, ttl=10, negative_ttl=5):
+        self.engine = engine
+        self.absolute_source = getattr(engine, "absolute_source", True)
+        self.handles_one_step = getattr(engine, "handles_one_step", False)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # Maps the keys to (expires, record, size), record is None for
+        # negative entries.
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def __iter__(self):
+        return iter(self.engine)
+
+    def iteritems(self):
+        return self.engine.iteritems()
+
+    def items(self):
+        return self.engine.items()
+
+    def _lookup(self, key):
+        with self._lock:
+            try:
+                expires, record, size = self._cache[key]
+            except KeyError:
+                self.misses += 1
+                return _MISS
+            if expires < time.time():
+                del self._cache[key]
+                self.size -= size
+                self.expirations += 1
+                self.misses += 1
+                return _MISS
+            self._cache.move_to_end(key)
+            if record is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return record
+
+    def _store(self, key, record):
+        ttl = self.ttl if record is not None else self.negative_ttl
+        if not ttl:
+            return
+        expires = time.time() + ttl
+        size = sys.getsizeof(key)
+        if record is not None:
+            size += _ENTRY_SIZE
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self._cache[key] = (expires, record, size)
+            self.size += size
+            while (self.max_entries and len(self._cache) > self.max_entries) or (
+                self.max_bytes and self.size > self.max_bytes
+            ):
+                _, (_, _, evicted_size) = self._cache.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def _invalidate(self, key):
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+
+    def __getitem__(self, key):
+        record = self._lookup(key)
+        if record is _MISS:
+            try:
+                record = self.engine[key]
+            except KeyError:
+                self._store(key, None)
+                raise
+            # The callers and the engine may change the record, so the
+            # cached records are never shared.
+            self._store(key, copy.copy(record))
+            return record
+        if record is None:
+            raise KeyError(key)
+        return copy.copy(record)
+
+    def get_many(self, keys):
+        records = []
+        missing = []
+        for key in keys:
+            record = self._lookup(key)
+            if record is _MISS:
+                missing.append(key)
+            elif record is not None:
+                record = copy.copy(record)
+            records.append(record)
+        if missing:
+            fetched = dict(zip(missing, self.engine.get_many(missing)))
+            for i, key in enumerate(keys):
+                if key in fetched:
+                    record = fetched[key]
+                    self._store(key, copy.copy(record))
+                    records[i] = record
+        return records
+
+    def get_fresh(self, keys):
+        records = fresh_records(self.engine, keys)
+        for key, record in zip(keys, records):
+            self._store(key, copy.copy(record))
+        return records
+
+    def __setitem__(self, key, value):
+        self.engine[key] = value
+        self._store(key, copy.copy(value))
+
+    def __delitem__(self, key):
+        self._invalidate(key)
+        del self.engine[key]
+
+    def _increment(self, counts, whitelist):
+        """Update the cached records after the engine was updated. They
+        keep their original expiry time.
+        """
+        with self._lock:
+            for key, count in counts.items():
+                try:
+                    expires, record, size = self._cache[key]
+                except KeyError:
+                    continue
+                if record is None:
+                    record = Record()
+                    self.size += _ENTRY_SIZE
+                    size += _ENTRY_SIZE
+                else:
+                    record = copy.copy(record)
+                for _ in range(count):
+                    if whitelist:
+                        record.wl_increment()
+                    else:
+                        record.r_increment()
+                self._cache[key] = (expires, record, size)
+
+    def report(self, keys):
+        self.engine.report(keys)
+        self._increment(collections.Counter(keys), False)
+
+    def whitelist(self, keys):
+        self.engine.whitelist(keys)
+        self._increment(collections.Counter(keys), True)
+
+    def report_counts(self, counts):
+        self.engine.report_counts(counts)
+        self._increment(counts, False)
+
+    def whitelist_counts(self, counts):
+        self.engine.whitelist_counts(counts)
+        self._increment(counts, True)
+
+    def stats(self):
+        """Returns a dictionary with the cache statistics."""
+        with self._lock:
+            return {
+                "entries": len(self._cache),
+                "bytes": self.size,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
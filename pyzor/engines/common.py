@@ -5,10 +5,24 @@ import datetime
 
 from collections import namedtuple
 
-__all__ = ["DBHandle", "DatabaseError", "Record", "BaseEngine"]
+__all__ = [
+    "DBHandle",
+    "DatabaseError",
+    "Record",
+    "BaseEngine",
+    "AsyncBaseEngine",
+    "fresh_records",
+]
 
 DBHandle = namedtuple(
-    "DBHandle", ["single_threaded", "multi_threaded", "multi_processing", "prefork"]
+    "DBHandle",
+    [
+        "single_threaded",
+        "multi_threaded",
+        "multi_processing",
+        "prefork",
+        "asynchronous",
+    ],
 )
 
 
@@ -83,6 +97,30 @@ class BaseEngine(object):
         """Get the record for this corresponding key."""
         raise NotImplementedError()
 
+    def get_many(self, keys):
+        """Get the records for all these keys, with as few calls to the
+        database as possible. Returns a list with the record of each key, or
+        None if there is no matching record.
+
+        Engines should override this if they can fetch multiple records
+        more efficiently.
+        """
+        records = []
+        for key in keys:
+            try:
+                records.append(self[key])
+            except KeyError:
+                records.append(None)
+        return records
+
+    def get_fresh(self, keys):
+        """Same as get_many(), but the records are read from the database
+        even if they are cached (see pyzor.engines.cache). The records that
+        are incremented by reading them and writing them back are read this
+        way, so that the increments of other processes are not overwritten.
+        """
+        return self.get_many(keys)
+
     def __setitem__(self, key, value):
         """Set the record for this corresponding key. 'value' should be a
         instance of the ``Record`` class.
@@ -111,9 +149,78 @@ class BaseEngine(object):
 
         raise NotImplementedError()
 
+    def report_counts(self, counts):
+        """Add several reports at once, `counts` maps the keys to the number
+        of reports to add. Engines that handle one step can override this to
+        update each key only once.
+        """
+        self.report([key for key, count in counts.items() for _ in range(count)])
+
+    def whitelist_counts(self, counts):
+        """Add several whitelists at once, `counts` maps the keys to the
+        number of whitelists to add.
+        """
+        self.whitelist([key for key, count in counts.items() for _ in range(count)])
+
     @classmethod
     def get_prefork_connections(cls, fn, mode, max_age=None):
         """Yields an unlimited number of partial functions that return a new
         engine instance, suitable for using toghether with the Pre-Fork server.
         """
         raise NotImplementedError()
+
+
+def fresh_records(engine, keys):
+    """Returns the records of `keys` read with engine.get_fresh(), or with
+    engine.get() if `engine` is a plain mapping.
+    """
+    get_fresh = getattr(engine, "get_fresh", None)
+    if get_fresh is None:
+        return [engine.get(key) for key in keys]
+    return get_fresh(keys)
+
+
+class AsyncBaseEngine(object):
+    """Base class for the Pyzor engines that are natively asynchronous,
+    suitable for the asyncio server. All the methods are coroutines.
+    """
+
+    absolute_source = True
+    handles_one_step = False
+
+    def get(self, key):
+        """Get the record for this corresponding key, raises KeyError if
+        there is no such record.
+        """
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        """Set the record for this corresponding key. 'value' should be a
+        instance of the ``Record`` class.
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """Remove the corresponding record from the database."""
+        raise NotImplementedError()
+
+    def report(self, keys):
+        """Report the corresponding key as spam, incrementing the report count.
+
+        Engines that implement don't implement this method should have
+        handles_one_step set to False.
+        """
+        raise NotImplementedError()
+
+    def whitelist(self, keys):
+        """Report the corresponding key as ham, incrementing the whitelist
+        count.
+
+        Engines that implement don't implement this method should have
+        handles_one_step set to False.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """Close the connections to the database."""
+        raise NotImplementedError()
@@ -93,6 +93,18 @@ class GdbmDBHandle(BaseEngine):
     def _really_getitem(self, key):
         return GdbmDBHandle.decode_record(self.db[key])
 
+    def get_many(self, keys):
+        return self.apply_method(self._really_get_many, (keys,))
+
+    def _really_get_many(self, keys):
+        records = []
+        for key in keys:
+            try:
+                records.append(self._really_getitem(key))
+            except KeyError:
+                records.append(None)
+        return records
+
     def __setitem__(self, key, value):
         self.apply_method(self._really_setitem, (key, value))
 
@@ -210,7 +222,11 @@ class ThreadedGdbmDBHandle(GdbmDBHandle):
 
 if not _has_gdbm:
     handle = DBHandle(
-        single_threaded=None, multi_threaded=None, multi_processing=None, prefork=None
+        single_threaded=None,
+        multi_threaded=None,
+        multi_processing=None,
+        prefork=None,
+        asynchronous=None,
     )
 else:
     handle = DBHandle(
@@ -218,4 +234,5 @@ else:
         multi_threaded=ThreadedGdbmDBHandle,
         multi_processing=None,
         prefork=None,
+        asynchronous=None,
     )
@@ -4,6 +4,7 @@ import time
 import logging
 import datetime
 import itertools
+import collections
 import functools
 import threading
 
@@ -18,7 +19,15 @@ try:
 
     _has_mysql = True
 except ImportError:
-    _has_mysql = False
+    # PyMySQL is written in Python, so with gevent its calls let the other
+    # requests run.
+    try:
+        import pymysql as MySQLdb
+        import pymysql.cursors
+
+        _has_mysql = True
+    except ImportError:
+        _has_mysql = False
 
 from pyzor.engines.common import *
 
@@ -91,7 +100,9 @@ class MySQLDBHandle(BaseEngine):
         self.last_connect_attempt = time.time()
 
     def _iter(self, db):
-        c = db.cursor(cursorclass=MySQLdb.cursors.SSCursor)
+        # The cursor class is passed positionally, the keyword is
+        # "cursorclass" with MySQLdb but "cursor" with PyMySQL.
+        c = db.cursor(MySQLdb.cursors.SSCursor)
         c.execute("SELECT digest FROM %s" % self.table_name)
         while True:
             row = c.fetchone()
@@ -104,7 +115,7 @@ class MySQLDBHandle(BaseEngine):
         return self._safe_call("iter", self._iter, ())
 
     def _iteritems(self, db):
-        c = db.cursor(cursorclass=MySQLdb.cursors.SSCursor)
+        c = db.cursor(MySQLdb.cursors.SSCursor)
         c.execute(
             "SELECT digest, r_count, wl_count, r_entered, r_updated, "
             "wl_entered, wl_updated FROM %s" % self.table_name
@@ -143,44 +154,54 @@ class MySQLDBHandle(BaseEngine):
             raise DatabaseError("Database temporarily unavailable.")
 
     def report(self, keys):
-        return self._safe_call("report", self._report, (keys,))
+        # The same key can be reported several times.
+        return self.report_counts(collections.Counter(keys))
 
     def whitelist(self, keys):
-        return self._safe_call("whitelist", self._whitelist, (keys,))
+        return self.whitelist_counts(collections.Counter(keys))
+
+    def report_counts(self, counts):
+        return self._safe_call("report", self._report, (counts,))
+
+    def whitelist_counts(self, counts):
+        return self._safe_call("whitelist", self._whitelist, (counts,))
 
     def __getitem__(self, key):
         return self._safe_call("getitem", self._really__getitem__, (key,))
 
+    def get_many(self, keys):
+        return self._safe_call("get_many", self._really_get_many, (keys,))
+
     def __setitem__(self, key, value):
         return self._safe_call("setitem", self._really__setitem__, (key, value))
 
     def __delitem__(self, key):
         return self._safe_call("delitem", self._really__delitem__, (key,))
 
-    def _report(self, keys, db=None):
+    def _report(self, counts, db=None):
         c = db.cursor()
         try:
             c.executemany(
                 "INSERT INTO %s (digest, r_count, wl_count, "
                 "r_entered, r_updated, wl_entered, wl_updated) "
-                "VALUES (%%s, 1, 0, NOW(), NOW(), NOW(), NOW()) ON "
-                "DUPLICATE KEY UPDATE r_count=r_count+1, "
+                "VALUES (%%s, %%s, 0, NOW(), NOW(), NOW(), NOW()) ON "
+                "DUPLICATE KEY UPDATE r_count=r_count+%%s, "
                 "r_updated=NOW()" % self.table_name,
-                map(lambda key: (key,), keys),
+                [(key, count, count) for key, count in counts.items()],
             )
         finally:
             c.close()
 
-    def _whitelist(self, keys, db=None):
+    def _whitelist(self, counts, db=None):
         c = db.cursor()
         try:
             c.executemany(
                 "INSERT INTO %s (digest, r_count, wl_count, "
                 "r_entered, r_updated, wl_entered, wl_updated) "
-                "VALUES (%%s, 0, 1, NOW(), NOW(), NOW(), NOW()) ON "
-                "DUPLICATE KEY UPDATE wl_count=wl_count+1, "
+                "VALUES (%%s, 0, %%s, NOW(), NOW(), NOW(), NOW()) ON "
+                "DUPLICATE KEY UPDATE wl_count=wl_count+%%s, "
                 "wl_updated=NOW()" % self.table_name,
-                map(lambda key: (key,), keys),
+                [(key, count, count) for key, count in counts.items()],
             )
         finally:
             c.close()
@@ -204,6 +225,24 @@ class MySQLDBHandle(BaseEngine):
         finally:
             c.close()
 
+    def _really_get_many(self, keys, db=None):
+        """get_many without the exception handling."""
+        keys = list(keys)
+        if not keys:
+            return []
+        c = db.cursor()
+        try:
+            c.execute(
+                "SELECT digest, r_count, wl_count, r_entered, r_updated, "
+                "wl_entered, wl_updated FROM %s WHERE digest IN (%s)"
+                % (self.table_name, ", ".join(["%s"] * len(set(keys)))),
+                tuple(set(keys)),
+            )
+            records = dict((row[0], Record(*row[1:])) for row in c.fetchall())
+        finally:
+            c.close()
+        return [records.get(key) for key in keys]
+
     def _really__setitem__(self, key, value, db=None):
         """__setitem__ without the exception handling."""
         c = db.cursor()
@@ -363,7 +402,11 @@ class ProcessMySQLDBHandle(MySQLDBHandle):
 
 if not _has_mysql:
     handle = DBHandle(
-        single_threaded=None, multi_threaded=None, multi_processing=None, prefork=None
+        single_threaded=None,
+        multi_threaded=None,
+        multi_processing=None,
+        prefork=None,
+        asynchronous=None,
     )
 else:
     handle = DBHandle(
@@ -371,4 +414,5 @@ else:
         multi_threaded=ThreadedMySQLDBHandle,
         multi_processing=ProcessMySQLDBHandle,
         prefork=MySQLDBHandle,
+        asynchronous=None,
     )
@@ -4,6 +4,7 @@ import time
 import logging
 import datetime
 import functools
+import collections
 
 try:
     import redis
@@ -13,6 +14,13 @@ except ImportError:
     redis = None
     _has_redis = False
 
+try:
+    import redis.asyncio
+
+    _has_redis_asyncio = True
+except ImportError:
+    _has_redis_asyncio = False
+
 from pyzor.engines.common import *
 
 VERSION = "1"
@@ -49,6 +57,20 @@ def safe_call(f):
     return wrapped_f
 
 
+def async_safe_call(f):
+    """Same as safe_call, but for coroutines."""
+
+    @functools.wraps(f)
+    async def wrapped_f(self, *args, **kwargs):
+        try:
+            return await f(self, *args, **kwargs)
+        except redis.exceptions.RedisError as e:
+            self.log.error("Redis error while calling %s: %s", f.__name__, e)
+            raise DatabaseError("Database temporarily unavailable.")
+
+    return wrapped_f
+
+
 class RedisDBHandle(BaseEngine):
     absolute_source = False
     handles_one_step = True
@@ -131,6 +153,13 @@ class RedisDBHandle(BaseEngine):
     def __getitem__(self, key):
         return self._decode_record(self.db.hgetall(self._real_key(key)))
 
+    @safe_call
+    def get_many(self, keys):
+        pipe = self.db.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(self._real_key(key))
+        return [self._decode_record(r) for r in pipe.execute()]
+
     @safe_call
     def __setitem__(self, key, value):
         real_key = self._real_key(key)
@@ -142,27 +171,35 @@ class RedisDBHandle(BaseEngine):
     def __delitem__(self, key):
         self.db.delete(self._real_key(key))
 
-    @safe_call
-    def report(self, keys):
+    def _increment(self, counts, prefix):
+        # All the commands are sent in a single round-trip.
         now = int(time.time())
-        for key in keys:
+        pipe = self.db.pipeline(transaction=False)
+        for key, count in counts.items():
             real_key = self._real_key(key)
-            self.db.hincrby(real_key, "r_count")
-            self.db.hsetnx(real_key, "r_entered", now)
-            self.db.hset(real_key, "r_updated", now)
+            pipe.hincrby(real_key, "%s_count" % prefix, count)
+            pipe.hsetnx(real_key, "%s_entered" % prefix, now)
+            pipe.hset(real_key, "%s_updated" % prefix, now)
             if self.max_age:
-                self.db.expire(real_key, self.max_age)
+                pipe.expire(real_key, self.max_age)
+        pipe.execute()
+
+    @safe_call
+    def report(self, keys):
+        # The same key can be incremented several times.
+        self._increment(collections.Counter(keys), "r")
 
     @safe_call
     def whitelist(self, keys):
-        now = int(time.time())
-        for key in keys:
-            real_key = self._real_key(key)
-            self.db.hincrby(real_key, "wl_count")
-            self.db.hsetnx(real_key, "wl_entered", now)
-            self.db.hset(real_key, "wl_updated", now)
-            if self.max_age:
-                self.db.expire(real_key, self.max_age)
+        self._increment(collections.Counter(keys), "wl")
+
+    @safe_call
+    def report_counts(self, counts):
+        self._increment(counts, "r")
+
+    @safe_call
+    def whitelist_counts(self, counts):
+        self._increment(counts, "wl")
 
     @classmethod
     def get_prefork_connections(cls, fn, mode, max_age=None):
@@ -192,9 +229,97 @@ class ThreadedRedisDBHandle(RedisDBHandle):
         RedisDBHandle.__init__(self, fn, mode, max_age=max_age)
 
 
+class AsyncRedisDBHandle(AsyncBaseEngine):
+    """Redis engine for the asyncio server, using the asyncio client of
+    redis-py. The records are stored in the same format as RedisDBHandle.
+    """
+
+    absolute_source = False
+    handles_one_step = True
+
+    log = logging.getLogger("pyzord")
+
+    def __init__(self, fn, mode, max_age=None, bound=None):
+        self.max_age = max_age
+        # The 'fn' is host,port,password,db.  We ignore mode.
+        fn = fn.split(",")
+        self.host = fn[0] or "localhost"
+        self.port = fn[1] or "6379"
+        self.passwd = fn[2] or None
+        self.db_name = fn[3] or "0"
+        # The connections are only created when first used, in the event
+        # loop of the server.
+        if "/" in self.host:
+            self.db = redis.asyncio.StrictRedis(
+                unix_socket_path=self.host,
+                db=int(self.db_name),
+                password=self.passwd,
+                max_connections=bound or None,
+            )
+        else:
+            self.db = redis.asyncio.StrictRedis(
+                host=self.host,
+                port=int(self.port),
+                db=int(self.db_name),
+                password=self.passwd,
+                max_connections=bound or None,
+            )
+
+    _real_key = staticmethod(RedisDBHandle._real_key)
+    _encode_record = staticmethod(RedisDBHandle._encode_record)
+    _decode_record = staticmethod(RedisDBHandle._decode_record)
+
+    @async_safe_call
+    async def get(self, key):
+        return self._decode_record(await self.db.hgetall(self._real_key(key)))
+
+    @async_safe_call
+    async def set(self, key, value):
+        real_key = self._real_key(key)
+        pipe = self.db.pipeline(transaction=False)
+        pipe.hset(real_key, mapping=self._encode_record(value))
+        if self.max_age is not None:
+            pipe.expire(real_key, self.max_age)
+        await pipe.execute()
+
+    @async_safe_call
+    async def delete(self, key):
+        await self.db.delete(self._real_key(key))
+
+    async def _increment(self, keys, prefix):
+        now = int(time.time())
+        pipe = self.db.pipeline(transaction=False)
+        # The same key can be incremented several times.
+        for key, count in collections.Counter(keys).items():
+            real_key = self._real_key(key)
+            pipe.hincrby(real_key, "%s_count" % prefix, count)
+            pipe.hsetnx(real_key, "%s_entered" % prefix, now)
+            pipe.hset(real_key, "%s_updated" % prefix, now)
+            if self.max_age:
+                pipe.expire(real_key, self.max_age)
+        await pipe.execute()
+
+    @async_safe_call
+    async def report(self, keys):
+        await self._increment(keys, "r")
+
+    @async_safe_call
+    async def whitelist(self, keys):
+        await self._increment(keys, "wl")
+
+    async def close(self):
+        # Older versions of redis-py only have close()
+        close = getattr(self.db, "aclose", None) or self.db.close
+        await close()
+
+
 if not _has_redis:
     handle = DBHandle(
-        single_threaded=None, multi_threaded=None, multi_processing=None, prefork=None
+        single_threaded=None,
+        multi_threaded=None,
+        multi_processing=None,
+        prefork=None,
+        asynchronous=None,
     )
 else:
     handle = DBHandle(
@@ -202,4 +327,5 @@ else:
         multi_threaded=ThreadedRedisDBHandle,
         multi_processing=None,
         prefork=RedisDBHandle,
+        asynchronous=AsyncRedisDBHandle if _has_redis_asyncio else None,
     )
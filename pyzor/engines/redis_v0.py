@@ -151,7 +151,11 @@ class ThreadedRedisDBHandle(RedisDBHandle):
 
 if not _has_redis:
     handle = DBHandle(
-        single_threaded=None, multi_threaded=None, multi_processing=None, prefork=None
+        single_threaded=None,
+        multi_threaded=None,
+        multi_processing=None,
+        prefork=None,
+        asynchronous=None,
     )
 else:
     handle = DBHandle(
@@ -159,4 +163,5 @@ else:
         multi_threaded=ThreadedRedisDBHandle,
         multi_processing=None,
         prefork=RedisDBHandle,
+        asynchronous=None,
     )
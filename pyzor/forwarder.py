@@ -8,10 +8,18 @@ try:
 except ImportError:
     import queue as Queue
 
+import pyzor.client
+
 
 class Forwarder(object):
     """Forwards digest to remote pyzor servers"""
 
+    # With a client that pipelines its requests (see
+    # pyzor.client.PipelinedClient), up to `bulk_size` queued digests are
+    # forwarded together, `batch_size` digests in each request.
+    bulk_size = 1000
+    batch_size = 100
+
     def __init__(self, forwarding_client, remote_servers, max_queue_size=10000):
         """
         forward_client: a pyzor.client.Client instance to use as
@@ -24,6 +32,8 @@ class Forwarder(object):
         self.forwarding_client = forwarding_client
         self.forward_queue = Queue.Queue(max_queue_size)
         self.remote_servers = remote_servers
+        # The number of digests dropped because the queue was full.
+        self.dropped = 0
 
     def _forward_loop(self):
         """read forwarding requests from the queue"""
@@ -38,6 +48,10 @@ class Forwarder(object):
                 else:
                     continue
 
+            if isinstance(self.forwarding_client, pyzor.client.PipelinedClient):
+                self._forward_bulk(digest, whitelist)
+                continue
+
             for server in self.remote_servers:
                 try:
                     if whitelist:
@@ -49,6 +63,41 @@ class Forwarder(object):
                         "Forwarding digest %s to %s failed: %s", digest, server, ex
                     )
 
+    def _forward_bulk(self, digest, whitelist):
+        """Forward this digest together with the digests already queued,
+        pipelining the requests.
+        """
+        queued = {False: [], True: []}
+        queued[whitelist].append(digest)
+        for _ in range(self.bulk_size - 1):
+            try:
+                digest, whitelist = self.forward_queue.get_nowait()
+            except Queue.Empty:
+                break
+            queued[whitelist].append(digest)
+        client = self.forwarding_client
+        if client is None:
+            return
+        for whitelist, digests in queued.items():
+            if not digests:
+                continue
+            op = "whitelist" if whitelist else "report"
+            try:
+                results = client.pipeline_digests(
+                    op, digests, self.remote_servers, self.batch_size
+                )
+                for digest, responses in results:
+                    for server, response in responses:
+                        if isinstance(response, Exception):
+                            self.log.warn(
+                                "Forwarding digest %s to %s failed: %s",
+                                digest,
+                                server,
+                                response,
+                            )
+            except Exception as ex:
+                self.log.warn("Forwarding %s digests failed: %s", len(digests), ex)
+
     def queue_forward_request(self, digest, whitelist=False):
         """If forwarding is enabled, insert a digest into the forwarding queue
         if whitelist is True, the digest will be forwarded as whitelist request
@@ -62,7 +111,7 @@ class Forwarder(object):
                 (digest, whitelist),
             )
         except Queue.Full:
-            pass
+            self.dropped += 1
 
     def start_forwarding(self):
         """start the forwarding thread"""
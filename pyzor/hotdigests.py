@@ -0,0 +1,191 @@
+"""Tracking of the most requested digests.
+
+During a spam run a few digests make up most of the requests. HotDigests
+finds them with the Space-Saving algorithm, in a fixed amount of memory: at
+most `capacity` digests are counted, and a new digest takes the place of
+the one with the lowest count, starting from that count. The counts are
+never underestimated, and are overestimated by at most the count the
+digest started from.
+
+The hot digests can be saved when the server stops, and looked up when it
+starts again to prewarm the cache of the database, so that a new server
+doesn't send all the requests of the spam run to the database at once.
+The worker processes each save their own file, and the counts of all the
+files are added up when they are loaded.
+"""
+
+import os
+import heapq
+import logging
+import threading
+
+
+class HotDigests(object):
+    """Count the requests for at most `capacity` digests, and save the hot
+    ones to `filename`.
+
+    Every process has its own counts, see set_worker().
+    """
+
+    # The number of digests shown by summary().
+    shown = 10
+    # The number of digests looked up with each get_many call by prewarm().
+    prewarm_batch = 100
+
+    def __init__(self, capacity=1000, filename=None):
+        self.log = logging.getLogger("pyzord")
+        self.capacity = capacity
+        self.filename = filename
+        self._lock = threading.Lock()
+        # Maps the digests to [count, error].
+        self._counts = {}
+        # A heap of (count, digest), with an entry for the current count of
+        # every digest. The entries of the previous counts are skipped when
+        # popped, and removed when the heap gets too large.
+        self._heap = []
+        self.requests = 0
+        self.replaced = 0
+        self.worker = None
+
+    def set_worker(self, index):
+        """Save the hot digests of this process in the file of the worker
+        `index`, counting from 0.
+        """
+        self.worker = index
+
+    def add(self, digests):
+        """Count a request for each of these digests."""
+        with self._lock:
+            for digest in digests:
+                self.requests += 1
+                entry = self._counts.get(digest)
+                if entry is None:
+                    if len(self._counts) < self.capacity:
+                        entry = self._counts[digest] = [0, 0]
+                    else:
+                        count = self._pop_min()
+                        self.replaced += 1
+                        entry = self._counts[digest] = [count, count]
+                entry[0] += 1
+                heapq.heappush(self._heap, (entry[0], digest))
+            if len(self._heap) > 4 * self.capacity:
+                self._heap = [
+                    (count, digest) for digest, (count, _) in self._counts.items()
+                ]
+                heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        """Stop counting the digest with the lowest count, returns its
+        count.
+        """
+        while True:
+            count, digest = heapq.heappop(self._heap)
+            entry = self._counts.get(digest)
+            if entry is not None and entry[0] == count:
+                del self._counts[digest]
+                return count
+
+    def top(self, n=None):
+        """Returns the `n` digests with the highest counts, as a list of
+        (digest, count, error) tuples. The number of requests for a digest
+        is between count - error and count.
+        """
+        with self._lock:
+            items = [
+                (digest, count, error)
+                for digest, (count, error) in self._counts.items()
+            ]
+        items.sort(key=lambda item: item[1], reverse=True)
+        return items[:n]
+
+    def stats(self):
+        """Returns a dictionary with the number of digests counted, the
+        number of requests counted and the number of digests replaced.
+        """
+        with self._lock:
+            return {
+                "digests": len(self._counts),
+                "requests": self.requests,
+                "replaced": self.replaced,
+            }
+
+    def summary(self):
+        """Returns the `shown` hot digests as lines in the format of
+        pyzor.metrics.Metrics.summary().
+        """
+        return [
+            'pyzord_hot_digest_requests{digest="%s"} %d' % (digest, count)
+            for digest, count, _ in self.top(self.shown)
+        ]
+
+    def save(self):
+        """Write the counted digests to the file, or to the file of the
+        worker, hottest first. Nothing is written if no request was
+        counted, so that a process that didn't handle any request doesn't
+        replace the file.
+        """
+        if not self.filename:
+            return
+        items = self.top()
+        if not items:
+            return
+        filename = self.filename
+        if self.worker is not None:
+            filename = "%s.%d" % (filename, self.worker)
+        tmp_fn = "%s.%s.tmp" % (filename, os.getpid())
+        try:
+            with open(tmp_fn, "w") as hotf:
+                for digest, count, _ in items:
+                    hotf.write("%s %d\n" % (digest, count))
+            os.rename(tmp_fn, filename)
+        except (IOError, OSError) as e:
+            self.log.error("Unable to save the hot digests to %s: %s", tmp_fn, e)
+
+    def _saved_files(self):
+        """Returns the file and the files of the workers that exist."""
+        directory, name = os.path.split(self.filename)
+        prefix = name + "."
+        filenames = [
+            os.path.join(directory, filename)
+            for filename in sorted(os.listdir(directory or "."))
+            if filename.startswith(prefix) and filename[len(prefix) :].isdigit()
+        ]
+        if os.path.exists(self.filename):
+            filenames.insert(0, self.filename)
+        return filenames
+
+    def load(self):
+        """Returns at most `capacity` digests saved in the files, hottest
+        first. The counts of the workers are added up.
+        """
+        if not self.filename:
+            return []
+        counts = {}
+        for filename in self._saved_files():
+            with open(filename) as hotf:
+                for line in hotf:
+                    line = line.split()
+                    if line:
+                        count = int(line[1]) if len(line) > 1 else 0
+                        counts[line[0]] = counts.get(line[0], 0) + count
+        digests = sorted(counts, key=counts.get, reverse=True)
+        return digests[: self.capacity]
+
+    def prewarm(self, database):
+        """Look up the saved digests in the database, so that their records
+        are cached. Returns the number of digests looked up.
+        """
+        try:
+            digests = self.load()
+        except (IOError, OSError) as e:
+            self.log.error("Unable to load the hot digests: %s", e)
+            return 0
+        for i in range(0, len(digests), self.prewarm_batch):
+            try:
+                database.get_many(digests[i : i + self.prewarm_batch])
+            except Exception as e:
+                self.log.error("Unable to prewarm the cache: %s", e)
+                return i
+        if digests:
+            self.log.info("Prewarmed the cache with %s hot digests.", len(digests))
+        return len(digests)
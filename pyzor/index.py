@@ -0,0 +1,420 @@
+"""Sorted fixed-width binary digest files.
+
+The records of these files are kept sorted by digest, so a lookup is a
+binary search over a memory map of the file and nothing needs to be loaded
+in memory in advance.
+
+Every file starts with a header:
+
+    magic (8 bytes) | version (2) | record size (2) | kind (4) | created (8)
+
+followed by the kind specific fields, if any, and then by the records. Each record starts with the 20 byte binary form
+of the digest, followed by a kind specific payload.
+"""
+
+import os
+import mmap
+import time
+import heapq
+import struct
+import logging
+import binascii
+import tempfile
+import itertools
+
+MAGIC = b"PYZORIDX"
+VERSION = 1
+HEADER = struct.Struct("!8sHH4sQ")
+KEY_SIZE = 20
+
+
+def is_index(filepath):
+    """Check if this file is a digest index (as opposed to a text file)."""
+    try:
+        with open(filepath, "rb") as indexf:
+            return indexf.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def encode_digest(digest):
+    """Return the binary form of the hex digest.
+
+    Raises ValueError if this is not a valid digest.
+    """
+    if len(digest) != KEY_SIZE * 2:
+        raise ValueError("Invalid digest %r" % digest)
+    try:
+        return binascii.unhexlify(digest.encode("ascii").lower())
+    except (TypeError, UnicodeError, binascii.Error):
+        raise ValueError("Invalid digest %r" % digest)
+
+
+def decode_digest(key):
+    """Return the hex digest of this binary key."""
+    return binascii.hexlify(key).decode("ascii")
+
+
+class DigestIndex(object):
+    """Base class for the digest files. Subclasses define the kind of the
+    file and the payload stored with each digest.
+    """
+
+    kind = None
+    payload = struct.Struct("")
+    # The kind specific fields that follow the header.
+    extension = struct.Struct("")
+    log = logging.getLogger("pyzor")
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._file = None
+        self._mm = None
+        self.created = None
+        self.extension_fields = ()
+        self.record_size = KEY_SIZE + self.payload.size
+        self.header_size = HEADER.size + self.extension.size
+        self._open()
+
+    def _open(self):
+        self._file = open(self.filepath, "rb")
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            self._file.close()
+            raise ValueError("%s is not a digest index" % self.filepath)
+        try:
+            magic, version, record_size, kind, created = HEADER.unpack_from(self._mm)
+        except struct.error:
+            magic = None
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("%s is not a digest index" % self.filepath)
+        if version != VERSION or record_size != self.record_size or kind != self.kind:
+            self.close()
+            raise ValueError(
+                "%s: unsupported digest index (version %s, kind %r)"
+                % (self.filepath, version, kind)
+            )
+        size = len(self._mm) - self.header_size
+        if size < 0 or size % self.record_size:
+            self.close()
+            raise ValueError("%s: truncated digest index" % self.filepath)
+        self.created = created
+        self.extension_fields = self.extension.unpack_from(self._mm, HEADER.size)
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return (len(self._mm) - self.header_size) // self.record_size
+
+    def _offset(self, i):
+        return self.header_size + i * self.record_size
+
+    def _search(self, key):
+        """Return the (position, found) pair for this binary key. If the
+        key is not found, position is where it should be inserted.
+        """
+        mm = self._mm
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = self._offset(mid)
+            current = mm[offset : offset + KEY_SIZE]
+            if current < key:
+                lo = mid + 1
+            elif current > key:
+                hi = mid
+            else:
+                return mid, True
+        return lo, False
+
+    def _get_payload(self, digest):
+        """Return the raw payload stored for this digest or None."""
+        try:
+            key = encode_digest(digest)
+        except ValueError:
+            return None
+        position, found = self._search(key)
+        if not found:
+            return None
+        offset = self._offset(position) + KEY_SIZE
+        return self._mm[offset : offset + self.payload.size]
+
+    def __contains__(self, digest):
+        return self._get_payload(digest) is not None
+
+    def position(self, digest):
+        """Return the position of this digest in the file, or None if the
+        file doesn't have it.
+        """
+        try:
+            key = encode_digest(digest)
+        except ValueError:
+            return None
+        position, found = self._search(key)
+        return position if found else None
+
+    def iteritems(self):
+        """Iterate over (digest, payload) pairs in digest order."""
+        for position in range(len(self)):
+            offset = self._offset(position)
+            record = self._mm[offset : offset + self.record_size]
+            yield (
+                decode_digest(record[:KEY_SIZE]),
+                self.payload.unpack(record[KEY_SIZE:]),
+            )
+
+    def __iter__(self):
+        for digest, _ in self.iteritems():
+            yield digest
+
+    @classmethod
+    def _encode_changes(cls, changes):
+        """Convert a (digest, payload) iterable into a sorted list of
+        (key, record) pairs, where a None payload marks a removal. If a
+        digest is specified more than once, the last change is used.
+        """
+        encoded = {}
+        for digest, payload in changes:
+            try:
+                key = encode_digest(digest)
+            except ValueError:
+                cls.log.warning("Ignoring invalid digest %r", digest)
+                continue
+            if payload is None:
+                encoded[key] = None
+            else:
+                encoded[key] = key + cls.payload.pack(*payload)
+        return sorted(encoded.items())
+
+    @classmethod
+    def _write(cls, filepath, write_records, created=None, extension_fields=()):
+        """Atomically (re)write the file, `write_records` is called with
+        the temporary file object to write the sorted records.
+        """
+        if created is None:
+            created = int(time.time())
+        dirname = os.path.dirname(os.path.abspath(filepath))
+        fd, tmp_fp = tempfile.mkstemp(dir=dirname, prefix=".pyzor-index-")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                out.write(
+                    HEADER.pack(
+                        MAGIC, VERSION, KEY_SIZE + cls.payload.size, cls.kind, created
+                    )
+                )
+                out.write(cls.extension.pack(*extension_fields))
+                write_records(out)
+            getattr(os, "replace", os.rename)(tmp_fp, filepath)
+        except BaseException:
+            os.unlink(tmp_fp)
+            raise
+
+    @classmethod
+    def create(
+        cls, filepath, items=(), created=None, run_size=1000000, extension_fields=()
+    ):
+        """Create a new file from a (digest, payload) iterable.
+
+        The items don't need to fit in memory, they are sorted in runs of
+        `run_size` items that are then merged into the file.
+        """
+        record_size = KEY_SIZE + cls.payload.size
+        items = iter(items)
+        runs = []
+        try:
+            while True:
+                batch = list(itertools.islice(items, run_size))
+                records = [
+                    record
+                    for _, record in cls._encode_changes(batch)
+                    if record is not None
+                ]
+                if not runs and len(batch) < run_size:
+                    # Everything fits in a single run.
+                    break
+                runs.append(_write_run(records))
+                if len(batch) < run_size:
+                    records = _merge_runs(runs, record_size)
+                    break
+
+            def write_records(out):
+                for record in records:
+                    out.write(record)
+
+            cls._write(filepath, write_records, created, extension_fields)
+        finally:
+            for run in runs:
+                run.close()
+        return cls(filepath)
+
+    def update(self, changes, created=None):
+        """Apply a (digest, payload) iterable to the file, where a None
+        payload removes the digest.
+
+        Only the changed records are searched for, the unchanged ranges of
+        the file are copied as they are.
+        """
+        changes = self._encode_changes(changes)
+        if created is None:
+            created = self.created
+
+        def write_records(out):
+            copied = 0
+            for key, record in changes:
+                position, found = self._search(key)
+                out.write(self._mm[self._offset(copied) : self._offset(position)])
+                copied = position + 1 if found else position
+                if record is not None:
+                    out.write(record)
+            out.write(self._mm[self._offset(copied) :])
+
+        self._write(self.filepath, write_records, created, self.extension_fields)
+        self.close()
+        self._open()
+
+
+def _write_run(records):
+    """Write the sorted records to a temporary file."""
+    run = tempfile.TemporaryFile()
+    for record in records:
+        run.write(record)
+    run.seek(0)
+    return run
+
+
+def _read_run(run, record_size):
+    while True:
+        record = run.read(record_size)
+        if len(record) < record_size:
+            return
+        yield record
+
+
+def _read_keyed_run(run, i, record_size):
+    for record in _read_run(run, record_size):
+        yield record[:KEY_SIZE], i, record
+
+
+def _merge_runs(runs, record_size):
+    """Merge the sorted runs, if a digest is found in more than one run the
+    record from the last run is used.
+    """
+    merged = heapq.merge(
+        *[_read_keyed_run(run, i, record_size) for i, run in enumerate(runs)]
+    )
+    for _, entries in itertools.groupby(merged, lambda entry: entry[0]):
+        for entry in entries:
+            pass
+        yield entry[2]
+
+
+class DigestSet(DigestIndex):
+    """A set of digests, used for the local whitelist."""
+
+    kind = b"WLST"
+
+    @classmethod
+    def create(cls, filepath, digests=(), created=None):
+        return super(DigestSet, cls).create(
+            filepath, ((digest, ()) for digest in digests), created
+        )
+
+    def add(self, digests):
+        """Add these digests to the set."""
+        self.update((digest, ()) for digest in digests)
+
+    def remove(self, digests):
+        """Remove these digests from the set."""
+        self.update((digest, None) for digest in digests)
+
+
+class DigestSnapshot(DigestIndex):
+    """A read-only copy of the digest database, mapping each digest to its
+    report and whitelist counts.
+    """
+
+    kind = b"SNAP"
+    payload = struct.Struct("!II")
+    max_count = 2**32 - 1
+
+    @classmethod
+    def encode_record(cls, record):
+        """Return the payload for this pyzor.engines.common.Record."""
+        return (
+            min(max(record.r_count, 0), cls.max_count),
+            min(max(record.wl_count, 0), cls.max_count),
+        )
+
+    def get(self, digest):
+        """Return the (r_count, wl_count) pair for this digest, or None if
+        the snapshot doesn't have it.
+        """
+        payload = self._get_payload(digest)
+        if payload is None:
+            return None
+        return self.payload.unpack(payload)
+
+    def age(self):
+        """The number of seconds since the snapshot was exported."""
+        return time.time() - self.created
+
+    def apply_delta(self, delta):
+        """Update the snapshot with a DigestSnapshotDelta exported since
+        this snapshot. Raises ValueError if the delta has a different base,
+        as the changes made in between would be missing.
+        """
+        if delta.base != self.created:
+            raise ValueError(
+                "The delta was exported since the snapshot created at %s, not "
+                "since this one (created at %s)." % (delta.base, self.created)
+            )
+        self.update(
+            (
+                (digest, None if removed else (r_count, wl_count))
+                for digest, (r_count, wl_count, removed) in delta.iteritems()
+            ),
+            created=delta.created,
+        )
+
+
+class DigestSnapshotDelta(DigestSnapshot):
+    """The records of the digest database that changed since a previous
+    snapshot, and the digests that were removed from it since. It can only
+    be applied to a DigestSnapshot.
+    """
+
+    kind = b"SNDL"
+    # The report and whitelist counts, and whether the digest was removed.
+    payload = struct.Struct("!II?")
+    # The creation time of the snapshot the changes were exported since.
+    extension = struct.Struct("!Q")
+
+    @property
+    def base(self):
+        """The creation time of the snapshot this delta applies to."""
+        return self.extension_fields[0]
+
+    @classmethod
+    def create(
+        cls, filepath, items=(), created=None, run_size=1000000, removed=(), base=0
+    ):
+        """Create a new delta from a (digest, (r_count, wl_count)) iterable
+        and an iterable of the removed digests, with the changes since the
+        snapshot created at `base`. `removed` is only iterated once all the
+        `items` are read.
+        """
+        changes = itertools.chain(
+            ((digest, payload + (False,)) for digest, payload in items),
+            ((digest, (0, 0, True)) for digest in removed),
+        )
+        return super(DigestSnapshotDelta, cls).create(
+            filepath, changes, created, run_size, (base,)
+        )
@@ -0,0 +1,113 @@
+"""Rate limits of the pyzord server.
+
+Each client address and each user gets a token bucket: a request takes a
+token from the bucket and the bucket is refilled at a constant rate, up to
+its burst size. Requests that find the bucket empty are rejected by the
+server with a 429 error, see pyzor.server.Server.verify_request.
+
+The limits are loaded from the limits file, see
+pyzor.config.load_limits_file.
+"""
+
+import time
+import threading
+import collections
+
+# The kinds of limits.
+KINDS = ("address", "user")
+
+
+class TokenBucket(object):
+    """A bucket of `burst` tokens, refilled with `rate` tokens per
+    second.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def consume(self, now):
+        """Take a token from the bucket. Returns False if the bucket is
+        empty.
+        """
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter(object):
+    """Rate limits for each client address and each user.
+
+    `limits` maps each kind ("address" or "user") to a dictionary of
+    (rate, burst) tuples by name, where the "all" name applies to every
+    name without its own limit. A rate of 0 means there is no limit.
+
+    At most `max_buckets` buckets of each kind are kept, the least recently
+    used are discarded (which is the same as refilling them).
+    """
+
+    max_buckets = 100000
+
+    def __init__(self, limits, max_buckets=None):
+        self.limits = dict((kind, dict(limits.get(kind, ()))) for kind in KINDS)
+        if max_buckets is not None:
+            self.max_buckets = max_buckets
+        self._buckets = dict((kind, collections.OrderedDict()) for kind in KINDS)
+        self._lock = threading.Lock()
+
+    def _allow(self, kind, name):
+        limits = self.limits[kind]
+        try:
+            rate, burst = limits[name]
+        except KeyError:
+            try:
+                rate, burst = limits["all"]
+            except KeyError:
+                return True
+        if not rate:
+            return True
+        now = time.monotonic()
+        buckets = self._buckets[kind]
+        with self._lock:
+            bucket = buckets.get(name)
+            if bucket is None:
+                bucket = buckets[name] = TokenBucket(rate, burst, now)
+                if len(buckets) > self.max_buckets:
+                    buckets.popitem(last=False)
+            else:
+                buckets.move_to_end(name)
+            return bucket.consume(now)
+
+    def allow_address(self, address):
+        """Take a token from the bucket of the client `address`. Returns
+        False if the request must be rejected.
+        """
+        # IPv4 clients of a dual-stack socket have mapped addresses.
+        if address.startswith("::ffff:") and "." in address:
+            address = address[7:]
+        return self._allow("address", address)
+
+    def allow_user(self, user):
+        """Take a token from the bucket of the `user`. Returns False if the
+        request must be rejected.
+        """
+        return self._allow("user", user)
+
+    def stats(self):
+        """Returns a dictionary with the number of addresses and users that
+        have a bucket.
+        """
+        with self._lock:
+            return {
+                "addresses": len(self._buckets["address"]),
+                "users": len(self._buckets["user"]),
+            }
@@ -2,11 +2,24 @@
 communication.
 """
 
+import re
 import random
+import email.policy
 import email.message
 
 import pyzor
 
+# Same as the email package parser.
+_LINE_RE = re.compile(r".*?(?:\r\n|\r|\n)|.+", re.S)
+_HEADER_RE = re.compile(r"From |[\041-\071\073-\176]*:|[\t ]")
+_NL_RE = re.compile(r"\r\n|\r")
+# Plain ASCII text, and the header values that are encoded as they are.
+_ASCII_RE = re.compile(r"[\x00-\x7f]*\Z")
+_PLAIN_VALUE_RE = re.compile(r"[\x00-\x09\x0b\x0c\x0e-\x7f]*\Z")
+# Used to encode the values that are not plain ASCII, exactly like
+# email.message.Message.as_string() does.
+_compat32 = email.policy.compat32.clone(max_line_length=0)
+
 
 class Message(email.message.Message):
     def __init__(self):
@@ -27,6 +40,158 @@ class Message(email.message.Message):
         pass
 
 
+class Headers(object):
+    """A lightweight replacement of email.message.Message, used by the
+    server to parse the requests and to encode the responses. Only the
+    headers are handled, in a single pass over the packet, but they are
+    parsed and encoded exactly like the email package does.
+
+    Like in email.message.Message the header names are case-insensitive,
+    item access returns the first matching header and setting an item adds
+    a new header.
+    """
+
+    # The format strings used to encode the headers, by the tuple of their
+    # names. The responses of each kind always have the same headers, so
+    # only a few layouts are kept.
+    _templates = {}
+    max_templates = 64
+
+    def __init__(self, headers=(), body=""):
+        self._headers = list(headers)
+        self.body = body
+
+    @classmethod
+    def parse(cls, data):
+        """Parse the headers from the `data` bytes."""
+        text = data.decode("ascii", "surrogateescape")
+        lines = _LINE_RE.findall(text)
+        # The headers end at the first line that isn't a header or a
+        # continuation line. If it's the blank line separating the headers
+        # from the body it's thrown away, otherwise it starts the body.
+        count = len(lines)
+        body_start = count
+        for i, line in enumerate(lines):
+            if not _HEADER_RE.match(line):
+                count = i
+                body_start = i + 1 if line[0] in "\r\n" else i
+                break
+        headers = []
+        body = []
+        name = None
+        value = None
+        for i in range(count):
+            line = lines[i]
+            if line[0] in " \t":
+                # A continuation line, ignored if there is no header yet.
+                if name is not None:
+                    value.append(line)
+                continue
+            if name is not None:
+                headers.append((name, "".join(value).rstrip("\r\n")))
+                name = None
+            if line.startswith("From "):
+                # The unix-from line is not a header. If it's the last line
+                # it's probably the first line of the body.
+                if i and i == count - 1:
+                    body.append(line)
+                continue
+            colon = line.find(":")
+            if colon == 0:
+                # Missing header name, ignore it.
+                continue
+            name = line[:colon]
+            value = [line[colon + 1 :].lstrip(" \t")]
+        if name is not None:
+            headers.append((name, "".join(value).rstrip("\r\n")))
+        body.extend(lines[body_start:])
+        return cls(headers, "".join(body))
+
+    def __len__(self):
+        return len(self._headers)
+
+    def __contains__(self, name):
+        name = name.lower()
+        for key, _ in self._headers:
+            if key.lower() == name:
+                return True
+        return False
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __setitem__(self, name, value):
+        self._headers.append((name, value))
+
+    def __delitem__(self, name):
+        name = name.lower()
+        self._headers = [
+            (key, value) for key, value in self._headers if key.lower() != name
+        ]
+
+    def get(self, name, failobj=None):
+        name = name.lower()
+        for key, value in self._headers:
+            if key.lower() == name:
+                return value
+        return failobj
+
+    def get_all(self, name, failobj=None):
+        name = name.lower()
+        values = [value for key, value in self._headers if key.lower() == name]
+        return values or failobj
+
+    def replace_header(self, name, value):
+        """Replace the value of the first matching header. Raises a KeyError
+        if there is no matching header.
+        """
+        lname = name.lower()
+        for i, (key, _) in enumerate(self._headers):
+            if key.lower() == lname:
+                self._headers[i] = (key, value)
+                return
+        raise KeyError(name)
+
+    def items(self):
+        return list(self._headers)
+
+    def _template(self):
+        """Returns the format string for these headers, or None."""
+        names = tuple(name for name, _ in self._headers)
+        template = self._templates.get(names)
+        if template is None and len(self._templates) < self.max_templates:
+            template = "".join("%s: %%s\n" % name.replace("%", "%%") for name in names)
+            self._templates[names] = template = template + "\n"
+        return template
+
+    def as_string(self):
+        values = tuple("" if value is None else value for _, value in self._headers)
+        if not self.body and _PLAIN_VALUE_RE.match("".join(values)):
+            # All the values are encoded as they are.
+            template = self._template()
+            if template is not None:
+                return template % values
+        parts = []
+        for (name, _), value in zip(self._headers, values):
+            if _PLAIN_VALUE_RE.match(value):
+                parts.append("%s: %s\n" % (name, value))
+            else:
+                parts.append(_compat32.fold(name, value))
+        parts.append("\n")
+        if self.body:
+            body = _NL_RE.sub("\n", self.body)
+            if not _ASCII_RE.match(body):
+                # Undecodable bytes are replaced, like in the email package.
+                body = body.encode("ascii", "surrogateescape").decode(
+                    "ascii", "replace"
+                )
+            parts.append(body)
+        return "".join(parts)
+
+    def __str__(self):
+        return self.as_string()
+
+
 class ThreadedMessage(Message):
     def init_for_sending(self):
         if "Thread" not in self:
@@ -119,6 +284,10 @@ class PingRequest(ClientSideRequest):
     op = "ping"
 
 
+class StatsRequest(ClientSideRequest):
+    op = "stats"
+
+
 class PongRequest(SimpleDigestBasedRequest):
     op = "pong"
 
@@ -0,0 +1,720 @@
+"""Metrics of the pyzord server.
+
+The servers count the requests by operation and response code, and measure
+the duration of the requests, of their phases and of the database calls in
+histograms. The statistics of the forwarder, the usage log, the socket, the
+coalesced lookups, the cache, the write buffer, the read batcher and the
+worker pools are copied to the metrics regularly.
+
+The metrics are kept in a flat array of numbers, with a slot for the main
+process and one for each worker process. For the servers that fork workers
+the array is in shared memory, so that any process can report the metrics
+of the whole server. They are available in the Prometheus text format from
+the MetricsServer, and in a shorter form with the `stats` operation.
+"""
+
+import os
+import time
+import socket
+import bisect
+import logging
+import threading
+import multiprocessing
+
+try:
+    import BaseHTTPServer
+except ImportError:
+    import http.server as BaseHTTPServer
+
+import pyzor.usagelog
+import pyzor.engines.batch
+import pyzor.engines.cache
+import pyzor.engines.buffer
+import pyzor.engines.common
+
+# The known operations and response codes, anything else is counted as
+# "other".
+OPERATIONS = ("ping", "pong", "check", "info", "report", "whitelist", "stats", "other")
+CODES = ("200", "400", "401", "403", "429", "500", "501", "503", "505", "other")
+# The reasons for rejecting a request without handling it: the client
+# address or the user is over its rate limit, or the server is too busy.
+REJECTIONS = ("address", "user", "busy")
+# The database calls that are measured.
+ENGINE_CALLS = ("get", "get_many", "set", "delete", "report", "whitelist")
+# The phases of the requests that are measured: parsing the request,
+# verifying the signature, checking the access and the limits, calling the
+# database, queuing the digests to forward, writing the usage log and
+# sending the response.
+PHASES = ("parse", "signature", "acl", "engine", "forward", "log", "response")
+# The upper bounds of the histogram buckets, in seconds.
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+# The values copied from the statistics of the other components, with
+# their type and description.
+GAUGES = (
+    ("forwarder_queue_depth", "gauge", "Digests waiting to be forwarded."),
+    (
+        "forwarder_dropped_total",
+        "counter",
+        "Digests not forwarded because the queue was full.",
+    ),
+    ("cache_entries", "gauge", "Records in the cache."),
+    ("cache_bytes", "gauge", "Estimated memory used by the cache."),
+    ("cache_hits_total", "counter", "Records found in the cache."),
+    (
+        "cache_negative_hits_total",
+        "counter",
+        "Missing records found in the cache.",
+    ),
+    ("cache_misses_total", "counter", "Records not found in the cache."),
+    ("cache_evictions_total", "counter", "Records evicted from the cache."),
+    ("cache_expirations_total", "counter", "Records expired in the cache."),
+    ("buffer_pending", "gauge", "Digests with increments waiting to be written."),
+    ("buffer_increments_total", "counter", "Increments added to the buffer."),
+    ("buffer_writes_total", "counter", "Records written by the buffer."),
+    ("buffer_flushes_total", "counter", "Flushes of the buffer."),
+    ("read_batch_lookups_total", "counter", "Records looked up in batches."),
+    ("read_batch_calls_total", "counter", "Batches fetched from the database."),
+    ("read_batch_keys_total", "counter", "Distinct records fetched in batches."),
+    ("pool_queue_depth", "gauge", "Requests waiting for a pool worker."),
+    ("pool_queue_size", "gauge", "Maximum number of queued requests."),
+    ("pool_workers", "gauge", "Workers in the pool."),
+    ("pool_busy_workers", "gauge", "Workers handling a request."),
+    (
+        "pool_busy_seconds_total",
+        "counter",
+        "Time spent by the pool workers handling requests.",
+    ),
+    ("pool_handled_total", "counter", "Requests handled by the pool."),
+    (
+        "pool_dropped_total",
+        "counter",
+        "Requests dropped because the queue was full.",
+    ),
+    ("hot_digests", "gauge", "Digests counted by the hot digests tracker."),
+    (
+        "hot_digests_requests_total",
+        "counter",
+        "Requests counted by the hot digests tracker.",
+    ),
+    (
+        "hot_digests_replaced_total",
+        "counter",
+        "Digests replaced in the hot digests tracker.",
+    ),
+    ("ratelimit_addresses", "gauge", "Client addresses with a token bucket."),
+    ("ratelimit_users", "gauge", "Users with a token bucket."),
+    ("usage_log_queue_depth", "gauge", "Usage log records waiting to be written."),
+    ("usage_log_written_total", "counter", "Usage log records written."),
+    (
+        "usage_log_dropped_total",
+        "counter",
+        "Usage log records dropped because the queue was full.",
+    ),
+    ("lookup_calls_total", "counter", "Database lookups made by check and info."),
+    (
+        "lookup_coalesced_total",
+        "counter",
+        "Lookups that shared the database call of a concurrent lookup.",
+    ),
+    ("lookup_in_flight", "gauge", "Database lookups in progress."),
+    (
+        "socket_receive_buffer_bytes",
+        "gauge",
+        "Size of the receive buffer of the socket.",
+    ),
+    (
+        "socket_receive_queue_bytes",
+        "gauge",
+        "Datagrams waiting in the receive buffer of the socket.",
+    ),
+    (
+        "socket_drops_total",
+        "counter",
+        "Datagrams dropped by the kernel because the receive buffer was full.",
+    ),
+)
+
+# The statistics of the components, mapped to the gauges.
+_CACHE_STATS = {
+    "entries": "cache_entries",
+    "bytes": "cache_bytes",
+    "hits": "cache_hits_total",
+    "negative_hits": "cache_negative_hits_total",
+    "misses": "cache_misses_total",
+    "evictions": "cache_evictions_total",
+    "expirations": "cache_expirations_total",
+}
+_BUFFER_STATS = {
+    "pending": "buffer_pending",
+    "increments": "buffer_increments_total",
+    "writes": "buffer_writes_total",
+    "flushes": "buffer_flushes_total",
+}
+_READ_BATCH_STATS = {
+    "lookups": "read_batch_lookups_total",
+    "batches": "read_batch_calls_total",
+    "keys": "read_batch_keys_total",
+}
+_USAGE_LOG_STATS = {
+    "queue_depth": "usage_log_queue_depth",
+    "written": "usage_log_written_total",
+    "dropped": "usage_log_dropped_total",
+}
+_LOOKUP_STATS = {
+    "calls": "lookup_calls_total",
+    "coalesced": "lookup_coalesced_total",
+    "in_flight": "lookup_in_flight",
+}
+_SOCKET_STATS = {
+    "receive_buffer": "socket_receive_buffer_bytes",
+    "receive_queue": "socket_receive_queue_bytes",
+    "drops": "socket_drops_total",
+}
+
+_OPERATION_INDEX = dict((op, i) for i, op in enumerate(OPERATIONS))
+_CODE_INDEX = dict((code, i) for i, code in enumerate(CODES))
+_CALL_INDEX = dict((call, i) for i, call in enumerate(ENGINE_CALLS))
+_PHASE_INDEX = dict((phase, i) for i, phase in enumerate(PHASES))
+_REJECTION_INDEX = dict((reason, i) for i, reason in enumerate(REJECTIONS))
+_GAUGE_INDEX = dict((gauge[0], i) for i, gauge in enumerate(GAUGES))
+
+# Each histogram has a count for every bucket, plus the +Inf bucket and the
+# sum of the observed values.
+_HISTOGRAM_SIZE = len(BUCKETS) + 2
+
+# The layout of a slot.
+_REQUESTS = 0
+_REQUEST_DURATION = _REQUESTS + len(OPERATIONS) * len(CODES)
+_ENGINE_DURATION = _REQUEST_DURATION + len(OPERATIONS) * _HISTOGRAM_SIZE
+_ENGINE_ERRORS = _ENGINE_DURATION + len(ENGINE_CALLS) * _HISTOGRAM_SIZE
+_PHASE_DURATION = _ENGINE_ERRORS + len(ENGINE_CALLS)
+_REJECTED = _PHASE_DURATION + len(PHASES) * _HISTOGRAM_SIZE
+_IN_FLIGHT = _REJECTED + len(REJECTIONS)
+_GAUGES = _IN_FLIGHT + 1
+SLOT_SIZE = _GAUGES + len(GAUGES)
+
+# The quantiles estimated for the stats operation.
+QUANTILES = (0.5, 0.9, 0.99)
+
+# The clock used to measure the durations.
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+
+def _format_value(value):
+    if value == int(value):
+        return "%d" % value
+    return "%.6g" % value
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        name = "%s{%s}" % (name, ",".join('%s="%s"' % label for label in labels))
+    return "pyzord_%s %s" % (name, _format_value(value))
+
+
+def quantile(counts, q):
+    """Estimate the `q` quantile from the bucket `counts` of a histogram,
+    assuming the values are spread evenly in each bucket.
+    """
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            if i == len(BUCKETS):
+                # The +Inf bucket has no upper bound.
+                return BUCKETS[-1]
+            lower = BUCKETS[i - 1] if i else 0.0
+            return lower + (BUCKETS[i] - lower) * (rank - seen) / count
+        seen += count
+    return BUCKETS[-1]
+
+
+def socket_stats(sock):
+    """Returns a dictionary with the size of the receive buffer of the UDP
+    socket `sock`, the number of bytes waiting in it and the number of
+    datagrams dropped because it was full. The last two are read from
+    /proc/net/udp and are only available on Linux.
+    """
+    stats = {}
+    try:
+        stats["receive_buffer"] = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        inode = str(os.fstat(sock.fileno()).st_ino)
+    except (OSError, ValueError):
+        return stats
+    for filename in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(filename) as procf:
+                for line in procf:
+                    fields = line.split()
+                    # The queues are in hexadecimal, "tx_queue:rx_queue".
+                    if len(fields) > 12 and fields[9] == inode:
+                        stats["receive_queue"] = int(fields[4].split(":")[1], 16)
+                        stats["drops"] = int(fields[12])
+                        return stats
+        except (IOError, OSError):
+            continue
+    return stats
+
+
+def collect_stats(database, forwarder=None, usage_log=None, sock=None, lookups=None):
+    """Returns the values of the gauges from the statistics of the
+    forwarder, of the asynchronous handlers of the `usage_log` logger, of
+    the socket `sock`, of the coalesced `lookups` (see
+    pyzor.server.Singleflight) and of the cache, write buffer and read
+    batcher wrapping `database`.
+    """
+    values = {}
+    if lookups is not None:
+        for key, value in lookups.stats().items():
+            values[_LOOKUP_STATS[key]] = value
+    if sock is not None:
+        for key, value in socket_stats(sock).items():
+            values[_SOCKET_STATS[key]] = value
+    if usage_log is not None:
+        for handler in usage_log.handlers:
+            if isinstance(handler, pyzor.usagelog.AsyncFileHandler):
+                for key, value in handler.stats().items():
+                    values[_USAGE_LOG_STATS[key]] = value
+    if forwarder is not None:
+        forward_queue = getattr(forwarder, "forward_queue", None)
+        if forward_queue is not None:
+            values["forwarder_queue_depth"] = forward_queue.qsize()
+        values["forwarder_dropped_total"] = getattr(forwarder, "dropped", 0)
+    # Follow the chain of wrappers down to the engine.
+    seen = set()
+    while database is not None and id(database) not in seen:
+        seen.add(id(database))
+        if isinstance(database, pyzor.engines.cache.CachedEngine):
+            for key, value in database.stats().items():
+                values[_CACHE_STATS[key]] = value
+        elif isinstance(database, pyzor.engines.buffer.BufferedEngine):
+            for key, value in database.stats().items():
+                if key in _BUFFER_STATS:
+                    values[_BUFFER_STATS[key]] = value
+        elif isinstance(database, pyzor.engines.batch.BatchedEngine):
+            for key, value in database.stats().items():
+                values[_READ_BATCH_STATS[key]] = value
+        database = getattr(database, "__dict__", {}).get("engine")
+    return values
+
+
+class Metrics(object):
+    """The metrics of a server with `workers` worker processes. If `shared`
+    is true the metrics are kept in shared memory, and must be created
+    before the workers are forked.
+
+    Every process records its metrics in its own slot, see set_worker(),
+    so the `lock` only serializes the threads of a process, and can be
+    held to make several updates at once. The slots of the other processes
+    are read without locking: the aggregated metrics may be slightly
+    inconsistent while the requests are being recorded.
+    """
+
+    def __init__(self, workers=0, shared=False):
+        self.workers = workers
+        size = (workers + 1) * SLOT_SIZE
+        if shared:
+            self.values = multiprocessing.RawArray("d", size)
+        else:
+            self.values = [0.0] * size
+        self.lock = threading.RLock()
+        self.offset = 0
+
+    def set_worker(self, index):
+        """Record the metrics of this process in the slot of the worker
+        `index`, counting from 0. This must be called in the worker process,
+        before it starts threads.
+        """
+        # The lock may have been held by another thread of the parent.
+        self.lock = threading.RLock()
+        self.offset = (index + 1) * SLOT_SIZE
+
+    def _observe(self, start, value):
+        self.values[start + bisect.bisect_left(BUCKETS, value)] += 1
+        self.values[start + _HISTOGRAM_SIZE - 1] += value
+
+    def request_started(self):
+        with self.lock:
+            self.values[self.offset + _IN_FLIGHT] += 1
+
+    def request_finished(self, opcode, code, duration):
+        """Record a request that was started with request_started()."""
+        op_index = _OPERATION_INDEX.get(opcode, len(OPERATIONS) - 1)
+        code_index = _CODE_INDEX.get(code, len(CODES) - 1)
+        offset = self.offset
+        with self.lock:
+            self.values[offset + _IN_FLIGHT] -= 1
+            self.values[offset + _REQUESTS + op_index * len(CODES) + code_index] += 1
+            self._observe(
+                offset + _REQUEST_DURATION + op_index * _HISTOGRAM_SIZE, duration
+            )
+
+    def engine_call(self, call, duration, error=False):
+        """Record a call to the database."""
+        index = _CALL_INDEX[call]
+        offset = self.offset
+        with self.lock:
+            self._observe(offset + _ENGINE_DURATION + index * _HISTOGRAM_SIZE, duration)
+            if error:
+                self.values[offset + _ENGINE_ERRORS + index] += 1
+
+    def request_phases(self, phases):
+        """Record the time spent in the phases of a request, `phases` maps
+        the names (see PHASES) to the durations.
+        """
+        offset = self.offset + _PHASE_DURATION
+        with self.lock:
+            for phase, duration in phases.items():
+                self._observe(offset + _PHASE_INDEX[phase] * _HISTOGRAM_SIZE, duration)
+
+    def request_rejected(self, reason):
+        """Record a request rejected for this reason, see REJECTIONS."""
+        index = _REJECTION_INDEX[reason]
+        with self.lock:
+            self.values[self.offset + _REJECTED + index] += 1
+
+    def set_gauges(self, values):
+        """Set the gauges of this process, `values` maps the names to the
+        values. Unknown names are ignored.
+        """
+        offset = self.offset + _GAUGES
+        with self.lock:
+            for name, value in values.items():
+                index = _GAUGE_INDEX.get(name)
+                if index is not None:
+                    self.values[offset + index] = value
+
+    def snapshot(self):
+        """Returns a list with the values of each slot, the main process
+        first and then the workers.
+        """
+        with self.lock:
+            values = self.values[:]
+        return [
+            values[i * SLOT_SIZE : (i + 1) * SLOT_SIZE] for i in range(self.workers + 1)
+        ]
+
+    def _families(self, histograms=True):
+        """Yields (name, type, description, samples) for all the metrics,
+        aggregated across processes. If `histograms` is false, the
+        histograms are summarized with quantiles instead of buckets.
+        """
+        slots = self.snapshot()
+        total = [sum(values) for values in zip(*slots)]
+
+        samples = []
+        for i, op in enumerate(OPERATIONS):
+            for j, code in enumerate(CODES):
+                value = total[_REQUESTS + i * len(CODES) + j]
+                if value:
+                    samples.append(
+                        ("requests_total", (("op", op), ("code", code)), value)
+                    )
+        yield "requests_total", "counter", "Requests handled.", samples
+        yield "requests_in_flight", "gauge", "Requests being handled.", [
+            ("requests_in_flight", (), total[_IN_FLIGHT])
+        ]
+        yield self._histogram(
+            "request_duration_seconds",
+            "Time spent handling the requests.",
+            "op",
+            OPERATIONS,
+            total[_REQUEST_DURATION:_ENGINE_DURATION],
+            histograms,
+        )
+        yield self._histogram(
+            "engine_call_duration_seconds",
+            "Time spent in the database calls, including the cache and the "
+            "write buffer.",
+            "call",
+            ENGINE_CALLS,
+            total[_ENGINE_DURATION:_ENGINE_ERRORS],
+            histograms,
+        )
+        samples = []
+        for i, call in enumerate(ENGINE_CALLS):
+            if total[_ENGINE_ERRORS + i]:
+                samples.append(
+                    (
+                        "engine_errors_total",
+                        (("call", call),),
+                        total[_ENGINE_ERRORS + i],
+                    )
+                )
+        yield "engine_errors_total", "counter", "Failed database calls.", samples
+        if histograms:
+            # Left out of the summary, which must fit in a single datagram.
+            yield self._histogram(
+                "request_phase_duration_seconds",
+                "Time spent in each phase of the requests.",
+                "phase",
+                PHASES,
+                total[_PHASE_DURATION:_REJECTED],
+                histograms,
+            )
+        samples = [
+            ("requests_rejected_total", (("reason", reason),), total[_REJECTED + i])
+            for i, reason in enumerate(REJECTIONS)
+        ]
+        description = "Requests rejected by the rate limits or the load shedding."
+        yield "requests_rejected_total", "counter", description, samples
+        for i, (name, kind, description) in enumerate(GAUGES):
+            if kind == "gauge" and self.workers and histograms:
+                # The gauges of the processes can't be added up, each
+                # worker has its own. The summary only has the total, its
+                # length must not depend on the number of workers.
+                values = [
+                    (name, (("worker", str(index)),), slot[_GAUGES + i])
+                    for index, slot in enumerate(slots[1:])
+                ]
+                values.insert(0, (name, (), slots[0][_GAUGES + i]))
+            else:
+                values = [(name, (), total[_GAUGES + i])]
+            # Most components are disabled, their gauges are left out of
+            # the summary to keep it short.
+            samples = [sample for sample in values if sample[2] or histograms]
+            if samples:
+                yield name, kind, description, samples
+
+        if not self.workers or not histograms:
+            return
+        requests = []
+        in_flight = []
+        for index, values in enumerate(slots[1:]):
+            labels = (("worker", str(index)),)
+            requests.append(
+                (
+                    "worker_requests_total",
+                    labels,
+                    sum(values[_REQUESTS:_REQUEST_DURATION]),
+                )
+            )
+            in_flight.append(("worker_requests_in_flight", labels, values[_IN_FLIGHT]))
+        description = "Requests handled by each worker."
+        yield "worker_requests_total", "counter", description, requests
+        description = "Requests being handled by each worker."
+        yield "worker_requests_in_flight", "gauge", description, in_flight
+
+    @staticmethod
+    def _histogram(name, description, label, keys, values, buckets):
+        samples = []
+        for i, key in enumerate(keys):
+            start = i * _HISTOGRAM_SIZE
+            counts = values[start : start + len(BUCKETS) + 1]
+            count = sum(counts)
+            if not count:
+                continue
+            labels = ((label, key),)
+            if buckets:
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS + ("+Inf",), counts):
+                    cumulative += bucket
+                    samples.append(
+                        (
+                            name + "_bucket",
+                            labels + (("le", str(bound)),),
+                            cumulative,
+                        )
+                    )
+            else:
+                for q in QUANTILES:
+                    samples.append(
+                        (name, labels + (("quantile", str(q)),), quantile(counts, q))
+                    )
+            samples.append((name + "_sum", labels, values[start + len(BUCKETS) + 1]))
+            samples.append((name + "_count", labels, count))
+        return name, "histogram" if buckets else "summary", description, samples
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, kind, description, samples in self._families():
+            lines.append("# HELP pyzord_%s %s" % (name, description))
+            lines.append("# TYPE pyzord_%s %s" % (name, kind))
+            lines.extend(_format_sample(*sample) for sample in samples)
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Returns the samples of the metrics as a list of lines, with
+        quantiles instead of the histogram buckets, without the gauges that
+        are 0 and without the samples of each worker: their gauges are
+        added up. The most important lines come first, the stats operation
+        sends the ones that fit in a single datagram.
+        """
+        lines = []
+        for _, _, _, samples in self._families(histograms=False):
+            lines.extend(_format_sample(*sample) for sample in samples)
+        return lines
+
+
+class MeasuredEngine(pyzor.engines.common.BaseEngine):
+    """Measure the duration of the calls made to `engine`."""
+
+    def __init__(self, engine, metrics):
+        self.engine = engine
+        self.metrics = metrics
+        self.absolute_source = getattr(engine, "absolute_source", True)
+        self.handles_one_step = getattr(engine, "handles_one_step", False)
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def __iter__(self):
+        return iter(self.engine)
+
+    def iteritems(self):
+        return self.engine.iteritems()
+
+    def items(self):
+        return self.engine.items()
+
+    def _measure(self, call, func, *args):
+        start = clock()
+        error = False
+        try:
+            return func(*args)
+        except KeyError:
+            # Missing records are not errors.
+            raise
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.metrics.engine_call(call, clock() - start, error)
+
+    def __getitem__(self, key):
+        return self._measure("get", self.engine.__getitem__, key)
+
+    def get_many(self, keys):
+        return self._measure("get_many", self.engine.get_many, keys)
+
+    def get_fresh(self, keys):
+        return self._measure(
+            "get_many", pyzor.engines.common.fresh_records, self.engine, keys
+        )
+
+    def __setitem__(self, key, value):
+        self._measure("set", self.engine.__setitem__, key, value)
+
+    def __delitem__(self, key):
+        self._measure("delete", self.engine.__delitem__, key)
+
+    def report(self, keys):
+        self._measure("report", self.engine.report, keys)
+
+    def whitelist(self, keys):
+        self._measure("whitelist", self.engine.whitelist, keys)
+
+
+class MeasuredAsyncEngine(pyzor.engines.common.AsyncBaseEngine):
+    """Same as MeasuredEngine, for the asynchronous engines."""
+
+    def __init__(self, engine, metrics):
+        self.engine = engine
+        self.metrics = metrics
+        self.absolute_source = getattr(engine, "absolute_source", True)
+        self.handles_one_step = getattr(engine, "handles_one_step", False)
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    async def _measure(self, call, func, *args):
+        start = clock()
+        error = False
+        try:
+            return await func(*args)
+        except KeyError:
+            raise
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.metrics.engine_call(call, clock() - start, error)
+
+    def get(self, key):
+        return self._measure("get", self.engine.get, key)
+
+    def set(self, key, value):
+        return self._measure("set", self.engine.set, key, value)
+
+    def delete(self, key):
+        return self._measure("delete", self.engine.delete, key)
+
+    def report(self, keys):
+        return self._measure("report", self.engine.report, keys)
+
+    def whitelist(self, keys):
+        return self._measure("whitelist", self.engine.whitelist, keys)
+
+    def close(self):
+        return self.engine.close()
+
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = self.server.collect().encode("utf8")
+        except Exception as e:
+            self.server.log.error("Unable to collect the metrics: %s", e)
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.log.debug(
+            "Metrics request from %s: %s", self.client_address[0], format % args
+        )
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    """Serves the metrics of the pyzord `server` over HTTP, on /metrics,
+    in a background thread.
+    """
+
+    def __init__(self, address, server):
+        if ":" in address[0]:
+            self.address_family = socket.AF_INET6
+        self.log = logging.getLogger("pyzord")
+        self.pyzord = server
+        BaseHTTPServer.HTTPServer.__init__(self, address, _MetricsRequestHandler)
+
+    def collect(self):
+        update_metrics = getattr(self.pyzord, "update_metrics", None)
+        if update_metrics is not None:
+            update_metrics()
+        return self.pyzord.metrics.render()
+
+    def start(self):
+        """Start serving the metrics in a daemon thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,158 @@
+"""On-demand profiling of the pyzord server.
+
+The Profiler samples the stacks of all the threads of the process for a
+while, and writes the result in the format of the pstats module, so that
+it can be read with:
+
+    python -m pstats pyzord-<pid>-<time>.prof
+
+The samples are taken at regular intervals whatever the threads are doing,
+including waiting for requests, so the times are wall-clock times. Unlike
+cProfile, this also covers the threads started before the profiling, like
+the workers of the pools, and the overhead doesn't depend on the number of
+calls made.
+
+The memory allocated while profiling is traced with tracemalloc, and the
+lines that allocated the most are written next to the profile.
+"""
+
+import os
+import sys
+import time
+import marshal
+import logging
+import threading
+import collections
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def _label(code):
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+class Profiler(object):
+    """Profile the process for `duration` seconds, sampling the stacks
+    every `interval` seconds, and write the results to `directory`. The
+    `top` lines that allocated the most memory are written as well.
+    """
+
+    interval = 0.005
+    top = 25
+
+    def __init__(self, directory, duration=30, top=None, interval=None):
+        self.log = logging.getLogger("pyzord")
+        self.directory = directory
+        self.duration = duration
+        if top is not None:
+            self.top = top
+        if interval is not None:
+            self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start profiling in a background thread. Returns False if the
+        process is already being profiled.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        return True
+
+    def stop(self):
+        """Stop profiling before the end of the duration, and wait for the
+        results to be written.
+        """
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+
+    def _run(self):
+        now = time.time()
+        base = os.path.join(
+            self.directory,
+            "pyzord-%s-%s.%03d"
+            % (
+                os.getpid(),
+                time.strftime("%Y%m%d%H%M%S", time.localtime(now)),
+                now % 1 * 1000,
+            ),
+        )
+        self.log.info("Profiling for %s seconds to %s.prof", self.duration, base)
+        tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        snapshot = tracemalloc.take_snapshot() if tracemalloc is not None else None
+        try:
+            stats, samples = self.sample()
+            with open(base + ".prof", "wb") as proff:
+                marshal.dump(stats, proff)
+            if snapshot is not None:
+                self.write_memory(base + ".mem", snapshot)
+        except Exception as e:
+            self.log.error("Unable to write the profile to %s: %s", base, e)
+            return
+        finally:
+            if tracing:
+                tracemalloc.stop()
+        self.log.info("Profile written to %s.prof (%s samples).", base, samples)
+
+    def sample(self):
+        """Sample the stacks of the other threads until the duration is
+        over or stop() is called. Returns the statistics in the format of
+        the pstats module and the number of samples.
+        """
+        own = collections.Counter()
+        cumulative = collections.Counter()
+        callers = collections.defaultdict(collections.Counter)
+        ident = threading.current_thread().ident
+        samples = 0
+        deadline = time.monotonic() + self.duration
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            for thread_ident, frame in sys._current_frames().items():
+                if thread_ident == ident:
+                    continue
+                samples += 1
+                callee = _label(frame.f_code)
+                own[callee] += 1
+                seen = set()
+                while frame is not None:
+                    label = _label(frame.f_code)
+                    # Recursive calls are only counted once per sample.
+                    if label not in seen:
+                        seen.add(label)
+                        cumulative[label] += 1
+                    if label != callee:
+                        callers[callee][label] += 1
+                    callee = label
+                    frame = frame.f_back
+        stats = {}
+        for label, count in cumulative.items():
+            stats[label] = (
+                count,
+                count,
+                own[label] * self.interval,
+                count * self.interval,
+                dict(callers.get(label, ())),
+            )
+        return stats, samples
+
+    def write_memory(self, filename, snapshot):
+        """Write the lines that allocated the most memory since `snapshot`
+        was taken.
+        """
+        diff = tracemalloc.take_snapshot().compare_to(snapshot, "lineno")
+        with open(filename, "w") as memf:
+            for stat in diff[: self.top]:
+                memf.write("%s\n" % stat)
@@ -18,7 +18,10 @@ a response will always match the "Thread" header of the appropriate request.
 Authenticated requests must also have "User", "Time" (timestamp), and "Sig"
 (signature) headers.
 """
+
+import io
 import os
+import stat
 import sys
 import time
 import errno
@@ -27,20 +30,36 @@ import signal
 import logging
 import threading
 import traceback
-import email.message
+import multiprocessing
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
 try:
     import SocketServer
 except ImportError:
     import socketserver as SocketServer
 
+try:
+    import gevent
+    import gevent.pool
+    import gevent.event
+    import gevent.server
+except ImportError:
+    gevent = None
+
 import pyzor.config
+import pyzor.limits
 import pyzor.account
+import pyzor.message
+import pyzor.metrics
+import pyzor.stream
 import pyzor.engines.common
 
 import pyzor.hacks.py26
 
-
 pyzor.hacks.py26.hack_all()
 
 
@@ -54,31 +73,197 @@ def _eintr_retry(func, *args):
                 raise
 
 
+def set_buffer_sizes(sock, receive_buffer=0, send_buffer=0):
+    """Set the sizes of the receive and send buffers of the socket, in
+    bytes, unless they are 0. A warning is logged if the kernel caps them.
+    """
+    log = logging.getLogger("pyzord")
+    for option, size, sysctl in (
+        (socket.SO_RCVBUF, receive_buffer, "net.core.rmem_max"),
+        (socket.SO_SNDBUF, send_buffer, "net.core.wmem_max"),
+    ):
+        if not size:
+            continue
+        sock.setsockopt(socket.SOL_SOCKET, option, size)
+        actual = sock.getsockopt(socket.SOL_SOCKET, option)
+        # Linux doubles the size, to allow for its bookkeeping overhead.
+        if sys.platform.startswith("linux"):
+            actual //= 2
+        if actual < size:
+            log.warning(
+                "Socket buffer limited to %s bytes instead of %s, see the %s "
+                "sysctl.",
+                actual,
+                size,
+                sysctl,
+            )
+
+
+def load_limiter(limits_fn):
+    """Returns the RateLimiter for the limits loaded from `limits_fn`, or
+    None if there are no limits.
+    """
+    if not limits_fn:
+        return None
+    limits = pyzor.config.load_limits_file(limits_fn)
+    if not limits or not any(limits.values()):
+        return None
+    return pyzor.limits.RateLimiter(limits)
+
+
+class _Call(object):
+    """A call in progress in a Singleflight."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Singleflight(object):
+    """Share the result of the calls made with the same key at the same
+    time: the first thread makes the call, the others wait for its result
+    instead of repeating it. The result, or the exception raised, is the
+    same object for all of them and must not be changed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, func, *args):
+        """Returns func(*args), or the result of the call already in
+        progress for `key`.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    def stats(self):
+        """Returns a dictionary with the number of calls made, the number of
+        calls that shared the result of another one, and the number of calls
+        in progress.
+        """
+        with self._lock:
+            in_flight = len(self._calls)
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": in_flight,
+        }
+
+
+def hash_keys(accounts):
+    """Hash the keys of all the accounts in advance, so that it's not done
+    for every authenticated request.
+    """
+    hashed_keys = {}
+    for user, key in accounts.items():
+        hashed_keys[user] = pyzor.account.hash_key(key, user)
+    return hashed_keys
+
+
 class Server(SocketServer.UDPServer):
     """The pyzord server.  Handles incoming UDP connections in a single
-    thread and single process."""
+    thread and single process.
+
+    The requests are limited with the rate limits loaded from `limits_fn`
+    (see pyzor.config.load_limits_file). The servers that handle several
+    requests at once answer new requests with a 503 error when
+    `max_pending` requests are already waiting or being handled, see
+    pending_requests().
+
+    The requests received by the other listeners of the server (see
+    StreamServer) are handed to it with dispatch_request(). This server
+    handles them one at a time with the datagrams, in the threads of the
+    listeners.
+    """
 
     max_packet_size = 8192
     time_diff_allowance = 180
+    # The statistics of the other components are copied to the metrics
+    # every `metrics_interval` seconds.
+    metrics_interval = 1
+    # The requests that take longer than this (in seconds) are logged with
+    # the time spent in each phase, 0 disables the slow request log.
+    slow_request_time = 0
+    # The pyzor.profiling.Profiler started by the SIGUSR2 signal.
+    profiler = None
+    # The sizes of the receive and send buffers of the socket, in bytes, 0
+    # keeps the default of the system.
+    receive_buffer = 0
+    send_buffer = 0
+    # Whether this process reports the statistics of the socket, see
+    # pyzor.metrics.socket_stats. Only one of the processes sharing a
+    # socket reports them.
+    report_socket = True
+    # Whether the concurrent check and info requests for the same digest
+    # share a single database call, see Singleflight.
+    coalesce_reads = False
+    # The pyzor.hotdigests.HotDigests counting the check and report
+    # requests, and whether the cache of the database is prewarmed with the
+    # saved hot digests.
+    hot_digests = None
+    prewarm_cache = False
 
-    def __init__(self, address, database, passwd_fn, access_fn, forwarder=None):
+    def __init__(
+        self,
+        address,
+        database,
+        passwd_fn,
+        access_fn,
+        forwarder=None,
+        limits_fn=None,
+        max_pending=0,
+    ):
         if ":" in address[0]:
             Server.address_family = socket.AF_INET6
         else:
             Server.address_family = socket.AF_INET
         self.log = logging.getLogger("pyzord")
         self.usage_log = logging.getLogger("pyzord-usage")
-        self.database = database
-        self.one_step = getattr(self.database, "handles_one_step", False)
+        self.metrics = self.create_metrics()
+        self._next_metrics = 0
+        self._socket_drops = None
+        self._request_lock = threading.Lock()
+        self.lookups = Singleflight() if self.coalesce_reads else None
+        self.set_database(database)
 
         # Handle configuration files
         self.passwd_fn = passwd_fn
         self.access_fn = access_fn
+        self.limits_fn = limits_fn
         self.accounts = {}
+        self.hashed_keys = {}
         self.acl = {}
+        self.limiter = None
         self.load_config()
 
         self.forwarder = forwarder
+        self.max_pending = max_pending
 
         self.log.debug("Listening on %s", address)
         SocketServer.UDPServer.__init__(
@@ -96,12 +281,131 @@ class Server(SocketServer.UDPServer):
 
         # Finally, set signals
         signal.signal(signal.SIGUSR1, self.reload_handler)
+        signal.signal(signal.SIGUSR2, self.profile_handler)
         signal.signal(signal.SIGTERM, self.shutdown_handler)
 
+    def server_bind(self):
+        set_buffer_sizes(self.socket, self.receive_buffer, self.send_buffer)
+        SocketServer.UDPServer.server_bind(self)
+
+    def create_metrics(self):
+        """Returns the metrics of the server, see pyzor.metrics."""
+        return pyzor.metrics.Metrics()
+
+    def set_database(self, database):
+        """Use this database connection, measuring its calls."""
+        if database is not None:
+            database = pyzor.metrics.MeasuredEngine(database, self.metrics)
+            if self.prewarm_cache and self.hot_digests is not None:
+                self.hot_digests.prewarm(database)
+        self.database = database
+        self.one_step = getattr(database, "handles_one_step", False)
+
+    def update_metrics(self):
+        """Copy the statistics of the forwarder, the usage log, the database,
+        the coalesced lookups, the socket and the rate limits to the metrics
+        of this process. Log a warning if the kernel dropped datagrams since
+        the last update.
+        """
+        stats = pyzor.metrics.collect_stats(
+            self.database,
+            self.forwarder,
+            self.usage_log,
+            self.socket if self.report_socket else None,
+            self.lookups,
+        )
+        if self.limiter is not None:
+            for key, value in self.limiter.stats().items():
+                stats["ratelimit_%s" % key] = value
+        if self.hot_digests is not None:
+            hot_stats = self.hot_digests.stats()
+            stats["hot_digests"] = hot_stats["digests"]
+            stats["hot_digests_requests_total"] = hot_stats["requests"]
+            stats["hot_digests_replaced_total"] = hot_stats["replaced"]
+        drops = stats.get("socket_drops_total")
+        # The stats requests update the metrics from the handler threads.
+        with self.metrics.lock:
+            self.metrics.set_gauges(stats)
+            previous_drops = self._socket_drops
+            if drops is not None:
+                self._socket_drops = drops
+        if drops is not None and previous_drops is not None and drops > previous_drops:
+            self.log.warning(
+                "%s datagrams dropped because the receive queue was full, "
+                "%s bytes queued.",
+                drops - previous_drops,
+                stats.get("socket_receive_queue_bytes"),
+            )
+
     def load_config(self):
-        """Reads the configuration files and loads the accounts and ACLs."""
-        self.accounts = pyzor.config.load_passwd_file(self.passwd_fn)
+        """Reads the configuration files and loads the accounts, ACLs and
+        rate limits.
+        """
+        accounts = pyzor.config.load_passwd_file(self.passwd_fn)
+        self.hashed_keys = hash_keys(accounts)
+        self.accounts = accounts
         self.acl = pyzor.config.load_access_file(self.access_fn, self.accounts)
+        self.limiter = load_limiter(self.limits_fn)
+
+    def pending_requests(self):
+        """Returns the number of requests that are waiting or being
+        handled. This server handles one request at a time.
+        """
+        return 0
+
+    def verify_request(self, request, client_address):
+        """Admit the request, unless the client address is over its rate
+        limit or there are too many pending requests. Rejected requests are
+        answered with an error straight away.
+        """
+        if self.limiter is not None and not self.limiter.allow_address(
+            client_address[0]
+        ):
+            self.reject_request(request, client_address, "address")
+            return False
+        if self.max_pending and self.pending_requests() >= self.max_pending:
+            self.reject_request(request, client_address, "busy")
+            return False
+        return True
+
+    def reject_request(self, request, client_address, reason):
+        """Answer the request with the error for the rejection `reason`
+        (see pyzor.metrics.REJECTIONS), without handling it.
+        """
+        self.metrics.request_rejected(reason)
+        try:
+            RejectedRequestHandler(request, client_address, self, reason)
+        except Exception:
+            self.handle_error(request, client_address)
+        self.shutdown_request(request)
+
+    def dispatch_request(self, request, client_address):
+        """Handle a request received by one of the other listeners of the
+        server, like the datagrams of its socket: it's admitted with
+        verify_request() and handed to process_request(), so it's handled
+        by the same threads, pool or greenlets, within the same limits.
+        shutdown_request() is called once it's handled or rejected.
+        """
+        if not self.verify_request(request, client_address):
+            self.shutdown_request(request)
+            return
+        try:
+            self.process_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        # The requests of the other listeners are handled in their threads.
+        with self._request_lock:
+            SocketServer.UDPServer.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        """Called once the request is handled or rejected. The listener
+        that received it is told, see dispatch_request().
+        """
+        if request[1] is not self.socket:
+            request[1].request_done()
 
     def shutdown_handler(self, *args, **kwargs):
         """Handler for the SIGTERM signal. This should be used to kill the
@@ -119,11 +423,60 @@ class Server(SocketServer.UDPServer):
         t = threading.Thread(target=self.load_config)
         t.start()
 
+    def profile_handler(self, *args, **kwargs):
+        """Handler for the SIGUSR2 signal. This should be used to profile
+        the server, see pyzor.profiling.
+        """
+        self.log.info("SIGUSR2 received. Profiling.")
+        self.start_profiler()
+
+    def start_profiler(self):
+        """Start the profiler, if profiling is enabled."""
+        if self.profiler is None:
+            self.log.warning("Profiling is not enabled.")
+        elif not self.profiler.start():
+            self.log.warning("Already profiling.")
+
     def handle_error(self, request, client_address):
         self.log.error(
             "Error while processing request from: %s", client_address, exc_info=True
         )
 
+    def flush_database(self, force=False):
+        """Write the buffered increments, if the database is buffered (see
+        pyzor.engines.buffer).
+        """
+        flush = getattr(self.database, "flush", None)
+        if flush is not None:
+            flush(force)
+
+    def set_worker(self, index):
+        """Record the metrics and save the hot digests of this process as
+        those of the worker `index`, counting from 0.
+        """
+        self.metrics.set_worker(index)
+        if self.hot_digests is not None:
+            self.hot_digests.set_worker(index)
+
+    def save_hot_digests(self):
+        """Save the hot digests, if they are counted."""
+        if self.hot_digests is not None:
+            self.hot_digests.save()
+
+    def service_actions(self):
+        self.flush_database()
+        if time.time() >= self._next_metrics:
+            self._next_metrics = time.time() + self.metrics_interval
+            self.update_metrics()
+
+    def server_close(self):
+        """Write any buffered increments, save the hot digests and close the
+        socket.
+        """
+        self.flush_database(True)
+        self.save_hot_digests()
+        SocketServer.UDPServer.server_close(self)
+
 
 class PreForkServer(Server):
     """The same as Server, but prefork itself when starting the self, by
@@ -132,26 +485,39 @@ class PreForkServer(Server):
     The parent process will then wait for all his child process to complete.
     """
 
-    def __init__(self, address, database, passwd_fn, access_fn, prefork=4):
+    def __init__(
+        self, address, database, passwd_fn, access_fn, prefork=4, limits_fn=None
+    ):
         """The same as Server.__init__ but requires a list of databases
         instead of a single database connection.
         """
         self.pids = None
-        Server.__init__(self, address, database, passwd_fn, access_fn)
         self._prefork = prefork
+        self.databases = database
+        Server.__init__(self, address, None, passwd_fn, access_fn, limits_fn=limits_fn)
+
+    def create_metrics(self):
+        return pyzor.metrics.Metrics(self._prefork, shared=True)
 
     def serve_forever(self, poll_interval=0.5):
         """Fork the current process and wait for all children to finish."""
         pids = []
-        for _ in range(self._prefork):
-            database = next(self.database)
+        for index in range(self._prefork):
+            database = next(self.databases)
             pid = os.fork()
             if not pid:
+                self.set_worker(index)
+                # The children share the socket.
+                self.report_socket = index == 0
                 # Create the database in the child process, to prevent issues
-                self.database = database()
+                self.set_database(database())
                 self.log.debug("Worker process started.")
                 Server.serve_forever(self, poll_interval=poll_interval)
+                self.flush_database(True)
+                self.save_hot_digests()
                 self.log.debug("Clean-up done for worker process.")
+                # Write the queued log records before exiting.
+                logging.shutdown()
                 os._exit(0)
             else:
                 pids.append(pid)
@@ -177,17 +543,55 @@ class PreForkServer(Server):
         if self.pids is None:
             Server.load_config(self)
 
+    def start_profiler(self):
+        """If this is the parent process send the USR2 signal to all
+        children, else call the super method.
+        """
+        for pid in self.pids or ():
+            os.kill(pid, signal.SIGUSR2)
+        if self.pids is None:
+            Server.start_profiler(self)
+
 
 class ThreadingServer(SocketServer.ThreadingMixIn, Server):
     """A threaded version of the pyzord server.  Each connection is served
     in a new thread.  This may not be suitable for all database types."""
 
-    pass
+    def __init__(self, *args, **kwargs):
+        self.active_threads = 0
+        self._active_lock = threading.Lock()
+        Server.__init__(self, *args, **kwargs)
+
+    def pending_requests(self):
+        return self.active_threads
+
+    def process_request(self, request, client_address):
+        with self._active_lock:
+            self.active_threads += 1
+        try:
+            SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+        except Exception:
+            with self._active_lock:
+                self.active_threads -= 1
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address
+            )
+        finally:
+            with self._active_lock:
+                self.active_threads -= 1
 
 
 class BoundedThreadingServer(ThreadingServer):
     """Same as ThreadingServer but this also accepts a limited number of
     concurrent threads.
+
+    When all the threads are busy, the server waits for one to finish
+    before receiving the next request. If `max_pending` is set, the
+    requests are instead answered with a 503 error straight away.
     """
 
     def __init__(
@@ -198,19 +602,138 @@ class BoundedThreadingServer(ThreadingServer):
         access_fn,
         max_threads,
         forwarding_server=None,
+        limits_fn=None,
+        max_pending=0,
     ):
         ThreadingServer.__init__(
-            self, address, database, passwd_fn, access_fn, forwarder=forwarding_server
+            self,
+            address,
+            database,
+            passwd_fn,
+            access_fn,
+            forwarder=forwarding_server,
+            limits_fn=limits_fn,
+            max_pending=max_pending,
         )
         self.semaphore = threading.Semaphore(max_threads)
 
     def process_request(self, request, client_address):
-        self.semaphore.acquire()
-        ThreadingServer.process_request(self, request, client_address)
+        if not self.semaphore.acquire(not self.max_pending):
+            self.reject_request(request, client_address, "busy")
+            return
+        try:
+            ThreadingServer.process_request(self, request, client_address)
+        except Exception:
+            # The thread wasn't started, it won't release its slot.
+            self.semaphore.release()
+            raise
 
     def process_request_thread(self, request, client_address):
-        ThreadingServer.process_request_thread(self, request, client_address)
-        self.semaphore.release()
+        try:
+            ThreadingServer.process_request_thread(self, request, client_address)
+        finally:
+            self.semaphore.release()
+
+
+class GeventServer(Server):
+    """A gevent version of the pyzord server. Each request is handled in a
+    new greenlet, from a pool of at most `max_greenlets` greenlets (0 means
+    unlimited).
+
+    The standard library must be patched with gevent.monkey.patch_all()
+    before the server and the database connections are created, so that
+    the database calls let the other greenlets run. This works with the
+    engines whose drivers are written in Python, like redis-py or PyMySQL;
+    the calls of the other engines block every request while they run.
+
+    When all the greenlets are busy, the server waits for one to finish
+    before receiving the next request. If `max_pending` is set, the
+    requests are answered with a 503 error once `max_pending` requests
+    are being handled.
+    """
+
+    # The number of seconds to wait for the requests being handled when
+    # the server stops.
+    stop_timeout = 5
+
+    def __init__(
+        self,
+        address,
+        database,
+        passwd_fn,
+        access_fn,
+        max_greenlets=0,
+        forwarder=None,
+        limits_fn=None,
+        max_pending=0,
+    ):
+        self.pool = gevent.pool.Pool(max_greenlets or None)
+        self.active_requests = 0
+        self._stopped = gevent.event.Event()
+        Server.__init__(
+            self,
+            address,
+            database,
+            passwd_fn,
+            access_fn,
+            forwarder=forwarder,
+            limits_fn=limits_fn,
+            max_pending=max_pending,
+        )
+        # The signals must be handled by the event loop, or they are only
+        # noticed when it wakes up.
+        self._signal_handlers = [
+            gevent.signal_handler(signal.SIGUSR1, self.reload_handler),
+            gevent.signal_handler(signal.SIGUSR2, self.profile_handler),
+            gevent.signal_handler(signal.SIGTERM, self.shutdown_handler),
+        ]
+
+    def pending_requests(self):
+        return self.active_requests
+
+    def serve_forever(self, poll_interval=0.5):
+        datagram_server = gevent.server.DatagramServer(
+            self.socket, self.handle_datagram, spawn=self.pool
+        )
+        datagram_server.start()
+        try:
+            while not self._stopped.wait(poll_interval):
+                self.service_actions()
+        finally:
+            datagram_server.stop(self.stop_timeout)
+
+    def handle_datagram(self, packet, client_address):
+        """Handle a request received by the gevent server, in its own
+        greenlet.
+        """
+        request = (packet, self.socket)
+        if not self.verify_request(request, client_address):
+            return
+        self.handle_request_greenlet(request, client_address)
+
+    def process_request(self, request, client_address):
+        """Handle a request of the other listeners in a greenlet of the
+        pool, waiting for one to be available.
+        """
+        self.pool.spawn(self.handle_request_greenlet, request, client_address)
+
+    def handle_request_greenlet(self, request, client_address):
+        self.active_requests += 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.active_requests -= 1
+            self.shutdown_request(request)
+
+    def shutdown(self):
+        self._stopped.set()
+
+    def server_close(self):
+        for handler in self._signal_handlers:
+            handler.cancel()
+        Server.server_close(self)
 
 
 class ProcessServer(SocketServer.ForkingMixIn, Server):
@@ -226,66 +749,1121 @@ class ProcessServer(SocketServer.ForkingMixIn, Server):
         access_fn,
         max_children=40,
         forwarding_server=None,
+        limits_fn=None,
+        max_pending=0,
     ):
         ProcessServer.max_children = max_children
         Server.__init__(
-            self, address, database, passwd_fn, access_fn, forwarder=forwarding_server
+            self,
+            address,
+            database,
+            passwd_fn,
+            access_fn,
+            forwarder=forwarding_server,
+            limits_fn=limits_fn,
+            max_pending=max_pending,
+        )
+
+    def create_metrics(self):
+        # Each request is handled in a new process.
+        return pyzor.metrics.Metrics(shared=True)
+
+    def pending_requests(self):
+        return len(self.active_children or ())
+
+    def finish_request(self, request, client_address):
+        try:
+            Server.finish_request(self, request, client_address)
+        finally:
+            # The child process exits with os._exit once the request is
+            # handled, write the queued log records first.
+            logging.shutdown()
+
+
+class PoolServer(Server):
+    """Base class for the servers that hand the requests to a fixed pool of
+    pre-started workers, through a bounded queue. When the queue is full
+    (or holds `max_pending` requests) the requests are answered with a 503
+    error, instead of blocking the receiving loop.
+
+    The queue depth and the utilization of the workers are logged every
+    `stats_interval` seconds, see stats().
+    """
+
+    stats_interval = 60
+
+    def __init__(
+        self,
+        address,
+        database,
+        passwd_fn,
+        access_fn,
+        workers=10,
+        queue_size=1024,
+        forwarder=None,
+        limits_fn=None,
+        max_pending=0,
+    ):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._last_stats = time.time()
+        self._last_busy_time = 0.0
+        self._next_stats = self._last_stats + self.stats_interval
+        Server.__init__(
+            self,
+            address,
+            database,
+            passwd_fn,
+            access_fn,
+            forwarder,
+            limits_fn=limits_fn,
+            max_pending=max_pending,
+        )
+
+    def pending_requests(self):
+        return self.queue_depth()
+
+    def process_request(self, request, client_address):
+        item = (request[0], client_address)
+        if request[1] is not self.socket:
+            # The requests of the other listeners are answered through them.
+            item += (request[1],)
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            self.dropped += 1
+            self.log.debug("Queue full, dropping request from %s", client_address)
+            self.reject_request(request, client_address, "busy")
+
+    def handle_queued_request(self, packet, client_address, sock=None):
+        """Handle a request taken from the queue, in a worker."""
+        start = time.time()
+        request = (packet, sock or self.socket)
+        with self._counters_lock:
+            self._counters[0] += 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self._counters_lock:
+                self._counters[0] -= 1
+                self._counters[1] += time.time() - start
+                self._counters[2] += 1
+            self.shutdown_request(request)
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def update_metrics(self):
+        with self._counters_lock:
+            busy, busy_time, handled = self._counters[:]
+        with self.metrics.lock:
+            Server.update_metrics(self)
+            self.metrics.set_gauges(
+                {
+                    "pool_queue_depth": self.queue_depth(),
+                    "pool_queue_size": self.queue_size,
+                    "pool_workers": self.workers,
+                    "pool_busy_workers": busy,
+                    "pool_busy_seconds_total": busy_time,
+                    "pool_handled_total": handled,
+                    "pool_dropped_total": self.dropped,
+                }
+            )
+
+    def stats(self):
+        """Returns a dictionary with the current queue depth, the number of
+        busy workers, the fraction of the workers' time spent handling
+        requests since the previous call, and the number of requests handled
+        and dropped since the server started.
+        """
+        now = time.time()
+        with self._counters_lock:
+            busy, busy_time, handled = self._counters[:]
+        elapsed = now - self._last_stats
+        utilization = 0.0
+        if elapsed > 0 and self.workers:
+            utilization = (busy_time - self._last_busy_time) / (elapsed * self.workers)
+        self._last_stats = now
+        self._last_busy_time = busy_time
+        return {
+            "queue_depth": self.queue_depth(),
+            "queue_size": self.queue_size,
+            "workers": self.workers,
+            "busy": int(busy),
+            "utilization": min(utilization, 1.0),
+            "handled": int(handled),
+            "dropped": self.dropped,
+        }
+
+    def service_actions(self):
+        Server.service_actions(self)
+        if self.stats_interval and time.time() >= self._next_stats:
+            self._next_stats = time.time() + self.stats_interval
+            self.log.info(
+                "Queue depth %(queue_depth)s/%(queue_size)s, %(busy)s/%(workers)s "
+                "workers busy, utilization %(utilization).2f, %(handled)s "
+                "requests handled, %(dropped)s dropped",
+                self.stats(),
+            )
+
+
+class ThreadPoolServer(PoolServer):
+    """A multi-threaded version of the pyzord server, with a fixed number of
+    threads started beforehand instead of a new thread for each request.
+    """
+
+    def __init__(
+        self,
+        address,
+        database,
+        passwd_fn,
+        access_fn,
+        workers=10,
+        queue_size=1024,
+        forwarder=None,
+        limits_fn=None,
+        max_pending=0,
+    ):
+        self.queue = Queue.Queue(queue_size)
+        # The number of busy workers, the total time spent handling
+        # requests and the number of requests handled.
+        self._counters = [0, 0.0, 0]
+        self._counters_lock = threading.Lock()
+        PoolServer.__init__(
+            self,
+            address,
+            database,
+            passwd_fn,
+            access_fn,
+            workers,
+            queue_size,
+            forwarder,
+            limits_fn,
+            max_pending,
+        )
+        self.threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._worker_loop)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _worker_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.handle_queued_request(*item)
+
+    def server_close(self):
+        """Wait for the queued requests to be handled, then close the
+        socket.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        PoolServer.server_close(self)
+
+
+class _ForwardQueue(object):
+    """Used as the forwarder in the ProcessPoolServer workers, it passes
+    the digests to the parent process that does the forwarding.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def queue_forward_request(self, digest, whitelist=False):
+        try:
+            self.queue.put_nowait((digest, whitelist))
+        except Queue.Full:
+            pass
+
+
+class ProcessPoolServer(PoolServer):
+    """A multi-processing version of the pyzord server, with a fixed number
+    of worker processes forked when the server starts instead of a new
+    process for each request.
+
+    The parent process receives the requests and puts them in the queue,
+    the workers answer them directly on the shared socket. Forwarded digests
+    are passed back to the parent.
+    """
+
+    def __init__(
+        self,
+        address,
+        databases,
+        passwd_fn,
+        access_fn,
+        workers=4,
+        queue_size=1024,
+        forwarder=None,
+        limits_fn=None,
+        max_pending=0,
+    ):
+        """The same as PoolServer.__init__ but requires an iterator of
+        database factories, as returned by the engines
+        get_prefork_connections, instead of a single database connection.
+        """
+        self.pids = None
+        self.stopping = False
+        self.databases = databases
+        self.queue = multiprocessing.Queue(queue_size)
+        self._counters = multiprocessing.Array("d", 3)
+        self._counters_lock = self._counters.get_lock()
+        self._forward_queue = None
+        if forwarder is not None:
+            self._forward_queue = multiprocessing.Queue(10000)
+        PoolServer.__init__(
+            self,
+            address,
+            None,
+            passwd_fn,
+            access_fn,
+            workers,
+            queue_size,
+            forwarder,
+            limits_fn,
+            max_pending,
+        )
+
+    def create_metrics(self):
+        return pyzor.metrics.Metrics(self.workers, shared=True)
+
+    def update_metrics(self):
+        if self.pids is None:
+            # In a worker, the pool statistics are kept by the parent.
+            Server.update_metrics(self)
+        else:
+            PoolServer.update_metrics(self)
+
+    def serve_forever(self, poll_interval=0.5):
+        """Start the workers, then receive the requests until shutdown is
+        called.
+        """
+        self.pids = {}
+        self._poll_interval = poll_interval
+        for index in range(self.workers):
+            self._start_worker(index, poll_interval)
+        Server.serve_forever(self, poll_interval=poll_interval)
+
+    def _start_worker(self, index, poll_interval):
+        database = next(self.databases)
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = index
+            return
+        self.pids = None
+        status = 0
+        try:
+            self._run_worker(index, database, poll_interval)
+        except Exception:
+            self.log.critical("Worker %s failed: %s", index, traceback.format_exc())
+            status = 1
+        # Write the queued log records before exiting.
+        logging.shutdown()
+        os._exit(status)
+
+    def _run_worker(self, index, database, poll_interval):
+        """Handle the queued requests in the worker process."""
+        signal.signal(signal.SIGTERM, self._stop_worker)
+        self.set_worker(index)
+        # The parent receives the requests.
+        self.report_socket = False
+        # Create the database in the child process, to prevent issues
+        self.set_database(database())
+        if self._forward_queue is not None:
+            self.forwarder = _ForwardQueue(self._forward_queue)
+        self.log.debug("Worker process started.")
+        while not self.stopping:
+            if time.time() >= self._next_metrics:
+                self._next_metrics = time.time() + self.metrics_interval
+                self.update_metrics()
+            try:
+                item = self.queue.get(timeout=poll_interval)
+            except Queue.Empty:
+                self.flush_database()
+                continue
+            if item is None:
+                break
+            self.handle_queued_request(*item)
+        self.flush_database(True)
+        self.save_hot_digests()
+        self.log.debug("Clean-up done for worker process.")
+
+    def _stop_worker(self, *args, **kwargs):
+        self.stopping = True
+
+    def service_actions(self):
+        PoolServer.service_actions(self)
+        while self._forward_queue is not None:
+            try:
+                digest, whitelist = self._forward_queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.forwarder.queue_forward_request(digest, whitelist)
+        # Restart any worker that exited unexpectedly.
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if not pid:
+                break
+            index = self.pids.pop(pid, None)
+            if index is not None:
+                self.log.error(
+                    "Worker %s (pid %s) exited with status %s, restarting it.",
+                    index,
+                    pid,
+                    status,
+                )
+                self._start_worker(index, self._poll_interval)
+
+    def queue_depth(self):
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            # Not available on some platforms
+            return -1
+
+    def load_config(self):
+        """If this is the parent process send the USR1 signal to all
+        workers, else call the super method.
+        """
+        for pid in self.pids or ():
+            os.kill(pid, signal.SIGUSR1)
+        if self.pids is None:
+            Server.load_config(self)
+
+    def start_profiler(self):
+        """Send the USR2 signal to all workers, and start the profiler of
+        this process, which receives the requests for the workers.
+        """
+        for pid in self.pids or ():
+            os.kill(pid, signal.SIGUSR2)
+        Server.start_profiler(self)
+
+    def server_close(self):
+        """Wait for the workers to handle the queued requests and exit, then
+        close the socket.
+        """
+        pids, self.pids = self.pids, None
+        if pids:
+            for _ in pids:
+                self.queue.put(None)
+            for pid in pids:
+                _eintr_retry(os.waitpid, pid, 0)
+        PoolServer.server_close(self)
+
+
+class BatchServer(Server):
+    """A version of the pyzord server that reads all the datagrams that are
+    ready (up to `max_batch`) every time the socket becomes readable.
+
+    The requests of a batch are handled together: all the digests looked
+    up by check and info requests are fetched with a single get_many call
+    to the database, and all the digests reported or whitelisted are
+    incremented with a single call, before replying to every request.
+    """
+
+    def __init__(
+        self,
+        address,
+        database,
+        passwd_fn,
+        access_fn,
+        forwarder=None,
+        max_batch=64,
+        limits_fn=None,
+    ):
+        Server.__init__(
+            self, address, database, passwd_fn, access_fn, forwarder, limits_fn
+        )
+        self.max_batch = max_batch
+
+    def _handle_request_noblock(self):
+        """Read all pending datagrams and handle them as a batch."""
+        requests = []
+        received = 0
+        while received < self.max_batch:
+            try:
+                packet, client_address = self.socket.recvfrom(self.max_packet_size)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self.log.warning("Error while reading requests: %s", e)
+                break
+            received += 1
+            if self.verify_request((packet, self.socket), client_address):
+                requests.append((packet, client_address))
+        if requests:
+            with self._request_lock:
+                self.process_batch(requests)
+
+    def process_batch(self, requests):
+        """Handle a list of (packet, client_address) pairs."""
+        start = pyzor.metrics.clock()
+        for _ in requests:
+            self.metrics.request_started()
+        handlers = []
+        for packet, client_address in requests:
+            handler = BatchRequestHandler(packet, client_address, self)
+            handler.prepare()
+            handlers.append(handler)
+
+        lookups = [h for h in handlers if h.opcode in ("check", "info") and h.digests]
+        self._fetch_records(lookups)
+        for opcode, whitelist in (("report", False), ("whitelist", True)):
+            increments = [h for h in handlers if h.opcode == opcode and h.digests]
+            self._increment(increments, whitelist)
+
+        for handler in handlers:
+            try:
+                self.socket.sendto(handler.complete(), handler.client_address)
+            except Exception:
+                self.handle_error(handler.packet, handler.client_address)
+            handler.end_phase("response")
+            duration = pyzor.metrics.clock() - start
+            self.metrics.request_finished(
+                handler.requested_op, handler.response["Code"], duration
+            )
+            handler.record_phases(duration)
+
+    def _fetch_records(self, handlers):
+        """Get the records for all the digests looked up by these handlers."""
+        if not handlers:
+            return
+        keys = list(set(h.digests[0] for h in handlers))
+        try:
+            records = dict(zip(keys, self.database.get_many(keys)))
+        except Exception as e:
+            for handler in handlers:
+                handler.error = e
+            return
+        for handler in handlers:
+            handler.records = records
+
+    def _increment(self, handlers, whitelist):
+        """Increment the counts of all the digests of these handlers."""
+        if not handlers:
+            return
+        digests = [digest for h in handlers for digest in h.digests]
+        try:
+            if self.one_step:
+                if whitelist:
+                    self.database.whitelist(digests)
+                else:
+                    self.database.report(digests)
+                return
+            # Every distinct digest is read and written only once, from the
+            # database and not from the cache.
+            keys = list(set(digests))
+            records = dict(
+                zip(keys, pyzor.engines.common.fresh_records(self.database, keys))
+            )
+            for digest in digests:
+                if records[digest] is None:
+                    records[digest] = pyzor.engines.common.Record()
+                if whitelist:
+                    records[digest].wl_increment()
+                else:
+                    records[digest].r_increment()
+            for key in keys:
+                self.database[key] = records[key]
+        except Exception as e:
+            for handler in handlers:
+                handler.error = e
+
+
+class ReusePortMixIn(object):
+    """Bind the socket with SO_REUSEPORT, so that several servers can listen
+    on the same address. The kernel then spreads the datagrams among them.
+    """
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super(ReusePortMixIn, self).server_bind()
+
+
+class ReusePortServer(ReusePortMixIn, Server):
+    pass
+
+
+class ReusePortBatchServer(ReusePortMixIn, BatchServer):
+    pass
+
+
+class MultiWorkerServer(object):
+    """Starts a number of worker processes, each one running its own server
+    bound to the address with SO_REUSEPORT. Unlike the PreForkServer the
+    workers don't share a socket, so they don't contend on it.
+
+    The parent process supervises the workers and restarts any worker that
+    exits unexpectedly. The workers can be pinned to CPUs, and each worker
+    can have its own forwarder.
+    """
+
+    # Workers that crash sooner than this after starting are restarted
+    # with a delay, to avoid spinning.
+    min_uptime = 5
+    restart_delay = 1
+
+    def __init__(
+        self,
+        address,
+        databases,
+        passwd_fn,
+        access_fn,
+        workers=4,
+        forwarder_factory=None,
+        cpus=None,
+        server_class=ReusePortServer,
+        server_kwargs=None,
+    ):
+        """`databases` is an iterator of callables that create a database
+        connection, as returned by the engines get_prefork_connections.
+        `forwarder_factory` is called in each worker to create its
+        forwarder. `cpus` is a list of CPUs the workers are pinned to, in
+        turn.
+        """
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise NotImplementedError("SO_REUSEPORT is not supported.")
+        self.log = logging.getLogger("pyzord")
+        self.address = address
+        self.passwd_fn = passwd_fn
+        self.access_fn = access_fn
+        self.forwarder_factory = forwarder_factory
+        self.cpus = cpus
+        self.server_class = server_class
+        self.server_kwargs = server_kwargs or {}
+        # Keep the same database factory for each worker, in case it's
+        # restarted.
+        self.databases = [next(databases) for _ in range(workers)]
+        self.pids = {}
+        self.started = {}
+        self.stopping = False
+        self.server = None
+        self.metrics = pyzor.metrics.Metrics(workers, shared=True)
+
+        signal.signal(signal.SIGUSR1, self.reload_handler)
+        signal.signal(signal.SIGUSR2, self.profile_handler)
+        signal.signal(signal.SIGTERM, self.shutdown_handler)
+
+    def serve_forever(self, poll_interval=0.5):
+        """Start the workers and restart them if they exit, until shutdown
+        is called.
+        """
+        self._check_address()
+        for index in range(len(self.databases)):
+            self._start_worker(index, poll_interval)
+        while self.pids:
+            try:
+                pid, status = _eintr_retry(os.wait)
+            except OSError as e:
+                if e.args[0] == errno.ECHILD:
+                    break
+                raise
+            index = self.pids.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            self.log.error(
+                "Worker %s (pid %s) exited with status %s, restarting it.",
+                index,
+                pid,
+                status,
+            )
+            if time.time() - self.started[index] < self.min_uptime:
+                time.sleep(self.restart_delay)
+            if not self.stopping:
+                self._start_worker(index, poll_interval)
+
+    def _check_address(self):
+        """Make sure the address can be used before starting the workers.
+        The parent must not keep a socket open on the address, or the kernel
+        would send it part of the datagrams.
+        """
+        server = self.server_class(
+            self.address, None, self.passwd_fn, self.access_fn, **self.server_kwargs
         )
+        server.server_close()
+        # Restore the signal handlers replaced by the server.
+        signal.signal(signal.SIGUSR1, self.reload_handler)
+        signal.signal(signal.SIGUSR2, self.profile_handler)
+        signal.signal(signal.SIGTERM, self.shutdown_handler)
+
+    def _start_worker(self, index, poll_interval):
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = index
+            self.started[index] = time.time()
+            return
+        self.pids = {}
+        status = 0
+        try:
+            self._run_worker(index, poll_interval)
+        except Exception:
+            self.log.critical("Worker %s failed: %s", index, traceback.format_exc())
+            status = 1
+        # Write the queued log records before exiting.
+        logging.shutdown()
+        os._exit(status)
+
+    def _run_worker(self, index, poll_interval):
+        """Run the server in the worker process."""
+        if self.cpus:
+            cpu = self.cpus[index % len(self.cpus)]
+            try:
+                os.sched_setaffinity(0, {cpu})
+            except (AttributeError, OSError) as e:
+                self.log.warning("Unable to pin worker %s to CPU %s: %s", index, cpu, e)
+        database = self.databases[index]()
+        forwarder = None
+        if self.forwarder_factory is not None:
+            forwarder = self.forwarder_factory()
+        self.server = self.server_class(
+            self.address,
+            None,
+            self.passwd_fn,
+            self.access_fn,
+            forwarder,
+            **self.server_kwargs
+        )
+        # All the workers record their metrics in the same shared memory.
+        self.server.metrics = self.metrics
+        self.server.set_worker(index)
+        self.server.set_database(database)
+        if forwarder:
+            forwarder.start_forwarding()
+        self.log.debug("Worker %s started.", index)
+        try:
+            self.server.serve_forever(poll_interval=poll_interval)
+        finally:
+            self.server.server_close()
+            if forwarder:
+                forwarder.stop_forwarding()
+            self.log.debug("Clean-up done for worker %s.", index)
+
+    def shutdown(self):
+        """Stop all the workers."""
+        self.stopping = True
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                self.log.debug("Unable to stop worker %s: %s", pid, e)
+
+    def server_close(self):
+        pass
+
+    def load_config(self):
+        """Make all the workers reload the configuration."""
+        for pid in list(self.pids):
+            os.kill(pid, signal.SIGUSR1)
+
+    def shutdown_handler(self, *args, **kwargs):
+        """Handler for the SIGTERM signal. This should be used to kill the
+        daemon and ensure proper clean-up.
+        """
+        self.log.info("SIGTERM received. Shutting down.")
+        self.shutdown()
+
+    def reload_handler(self, *args, **kwargs):
+        """Handler for the SIGUSR1 signal. This should be used to reload
+        the configuration files.
+        """
+        self.log.info("SIGUSR1 received. Reloading configuration.")
+        self.load_config()
+
+    def profile_handler(self, *args, **kwargs):
+        """Handler for the SIGUSR2 signal. This should be used to profile
+        all the workers.
+        """
+        self.log.info("SIGUSR2 received. Profiling the workers.")
+        for pid in list(self.pids):
+            os.kill(pid, signal.SIGUSR2)
+
+
+def _remove_socket(path):
+    """Remove the Unix socket left behind by a previous server."""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except OSError:
+        pass
+
+
+class StreamServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Accepts stream connections for the pyzord `server`, on a TCP address,
+    or on a Unix socket if `address` is a path. The requests are framed as
+    described in pyzor.stream, and are handled by `server` like the
+    datagrams it receives, with the same accounts, ACL and limits.
+
+    Each connection is read in its own thread. Its requests are handed one
+    after the other to `server`, with Server.dispatch_request(), so they
+    go through the same threads or pool as the datagrams, and are rejected
+    the same way when the server is busy. The connections still open are
+    closed by server_close(), which must be called before closing `server`.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # The largest request accepted, in bytes.
+    max_message_size = pyzor.stream.max_message_size
+    # The connections are closed after this many seconds without requests,
+    # or without the response to a request.
+    idle_timeout = 300
+    # When the server is closed, the connections are given this many
+    # seconds to finish the request being handled.
+    close_timeout = 10
+
+    def __init__(self, address, server):
+        if not isinstance(address, tuple):
+            self.address_family = socket.AF_UNIX
+            _remove_socket(address)
+        elif ":" in address[0]:
+            self.address_family = socket.AF_INET6
+        self.log = logging.getLogger("pyzord")
+        self.pyzord = server
+        # The open connections, mapped to the threads reading them.
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+        SocketServer.TCPServer.__init__(self, address, StreamRequestHandler)
+
+    def get_request(self):
+        connection, address = SocketServer.TCPServer.get_request(self)
+        if self.address_family == socket.AF_UNIX:
+            # The clients of a Unix socket have no address, the path of the
+            # socket is used instead.
+            address = (self.server_address, 0)
+        return connection, address
+
+    def start(self):
+        """Start accepting the connections in a daemon thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def server_close(self):
+        """Stop accepting the connections, and close the open ones once
+        their current request is handled, waiting up to close_timeout.
+        """
+        SocketServer.TCPServer.server_close(self)
+        if self.address_family == socket.AF_UNIX:
+            _remove_socket(self.server_address)
+        with self.connections_lock:
+            connections = list(self.connections.items())
+        for connection, _ in connections:
+            # Wake up the threads waiting for a request.
+            try:
+                connection.shutdown(socket.SHUT_RD)
+            except socket.error:
+                pass
+        deadline = time.time() + self.close_timeout
+        for _, thread in connections:
+            thread.join(max(deadline - time.time(), 0))
+
+
+class _StreamWriter(object):
+    """Sends the responses on a stream connection, in place of the socket
+    the request handlers send the datagrams with. The `done` event is set
+    once the request is handled. The responses are dropped once the
+    connection is closed.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.done = threading.Event()
+        self.closed = False
+
+    def sendto(self, data, address):
+        if not self.closed:
+            self.wfile.write(pyzor.stream.pack(data))
+
+    def request_done(self):
+        self.done.set()
+
+
+class StreamRequestHandler(SocketServer.StreamRequestHandler):
+    """Read the requests sent on a stream connection, and have them handled
+    by the pyzord server of the StreamServer.
+    """
+
+    def setup(self):
+        self.timeout = self.server.idle_timeout
+        SocketServer.StreamRequestHandler.setup(self)
+        with self.server.connections_lock:
+            self.server.connections[self.connection] = threading.current_thread()
+
+    def finish(self):
+        with self.server.connections_lock:
+            self.server.connections.pop(self.connection, None)
+        SocketServer.StreamRequestHandler.finish(self)
+
+    def handle(self):
+        pyzord = self.server.pyzord
+        writer = _StreamWriter(self.wfile)
+        try:
+            self._handle(pyzord, writer)
+        finally:
+            writer.closed = True
+
+    def _handle(self, pyzord, writer):
+        while True:
+            try:
+                packet = pyzor.stream.read_message(
+                    self.rfile, self.server.max_message_size
+                )
+            except (pyzor.ProtocolError, socket.error) as e:
+                self.server.log.info(
+                    "Closing the connection from %s: %s", self.client_address[0], e
+                )
+                return
+            if packet is None:
+                return
+            writer.done.clear()
+            pyzord.dispatch_request((packet, writer), self.client_address)
+            # The responses are sent in the order of the requests.
+            if not writer.done.wait(self.server.idle_timeout):
+                self.server.log.warning(
+                    "Closing the connection from %s: no response after %ss",
+                    self.client_address[0],
+                    self.server.idle_timeout,
+                )
+                return
+
+
+class UnixDatagramServer(SocketServer.UnixDatagramServer):
+    """Receives the datagrams of the clients running on the same host for
+    the pyzord `server`, on the Unix socket at `path`. This skips the IP
+    stack and the address resolution of the clients. The requests are
+    handed to `server` with Server.dispatch_request(), so they are handled
+    like the datagrams it receives, by the same threads or pool and within
+    the same limits. It must be shut down before closing `server`.
+
+    The access to the socket is controlled by the filesystem: it's given
+    the `mode` permissions and, if `gid` is set, that group. The clients
+    allowed to write to it are trusted as the ACL user `user`: their
+    anonymous requests are handled with the permissions and the rate limits
+    of this user. The signed requests are still handled as their own user.
+    """
+
+    max_packet_size = 8192
+
+    def __init__(self, path, server, mode=0o660, gid=None, user=None):
+        self.log = logging.getLogger("pyzord")
+        self.pyzord = server
+        self.user = user
+        _remove_socket(path)
+        SocketServer.UnixDatagramServer.__init__(self, path, RequestHandler)
+        try:
+            if gid is not None:
+                os.chown(path, -1, gid)
+            os.chmod(path, mode)
+        except OSError:
+            self.server_close()
+            raise
+
+    def get_request(self):
+        packet, address = self.socket.recvfrom(self.max_packet_size)
+        # The clients of a Unix socket have no network address, the path of
+        # the socket is used instead.
+        replier = _UnixReplier(self.socket, address, self.user)
+        return (packet, replier), (self.server_address, 0)
+
+    def verify_request(self, request, client_address):
+        if request[1].address is None:
+            self.log.debug("Ignoring a request from an unbound Unix socket.")
+            return False
+        return True
+
+    def process_request(self, request, client_address):
+        self.pyzord.dispatch_request(request, client_address)
+
+    def handle_error(self, request, client_address):
+        self.pyzord.handle_error(request, client_address)
+
+    def start(self):
+        """Start receiving the requests in a daemon thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def server_close(self):
+        SocketServer.UnixDatagramServer.server_close(self)
+        _remove_socket(self.server_address)
+
+
+class _UnixReplier(object):
+    """Sends the response to the client that sent the request on the Unix
+    socket, in place of the socket the request handlers send the datagrams
+    with. The request handlers use its `user` for the anonymous requests.
+    """
+
+    def __init__(self, sock, address, user):
+        self.sock = sock
+        self.address = address
+        self.user = user
+
+    def sendto(self, data, address):
+        self.sock.sendto(data, self.address)
+
+    def request_done(self):
+        # The responses of the datagrams don't need to be ordered.
+        pass
 
 
 class RequestHandler(SocketServer.DatagramRequestHandler):
     """Handle a single pyzord request."""
 
+    # The operation requested, even if it's not allowed.
+    requested_op = None
+    # The user that sent the request, even if it's not authenticated.
+    requested_user = None
+    # The number of digests in the request.
+    digest_count = 0
+    # The ACL user of the anonymous requests, see UnixDatagramServer.
+    local_user = None
+
     def __init__(self, *args, **kwargs):
-        self.response = email.message.Message()
+        self.response = pyzor.message.Headers()
         SocketServer.DatagramRequestHandler.__init__(self, *args, **kwargs)
 
+    def setup(self):
+        SocketServer.DatagramRequestHandler.setup(self)
+        self.local_user = getattr(self.socket, "user", None)
+
     def handle(self):
         """Handle a pyzord operation, cleanly handling any errors."""
+        start = pyzor.metrics.clock()
+        self.server.metrics.request_started()
+        self.start_response()
+        try:
+            self._really_handle()
+        except Exception as e:
+            self.handle_exception(e)
+        self.wfile.write(self.finish_response())
+        self.end_phase("response")
+        duration = pyzor.metrics.clock() - start
+        self.server.metrics.request_finished(
+            self.requested_op, self.response["Code"], duration
+        )
+        self.record_phases(duration)
+
+    def start_response(self):
+        """Add the headers present in every response, and start measuring
+        the phases of the request.
+        """
+        self.phases = {}
+        self._phase_start = pyzor.metrics.clock()
         self.response["Code"] = "200"
         self.response["Diag"] = "OK"
         self.response["PV"] = "%s" % pyzor.proto_version
-        try:
-            self._really_handle()
-        except NotImplementedError as e:
+
+    def end_phase(self, phase):
+        """Add the time spent since the end of the previous phase to
+        `phase`, see pyzor.metrics.PHASES.
+        """
+        now = pyzor.metrics.clock()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self._phase_start
+        self._phase_start = now
+
+    def record_phases(self, duration):
+        """Record the phases of the request in the metrics, and log them if
+        the request took longer than the slow_request_time of the server.
+        """
+        self.server.metrics.request_phases(self.phases)
+        slow_request_time = self.server.slow_request_time
+        if slow_request_time and duration >= slow_request_time:
+            self.server.log.warning(
+                "Slow request: %s from %s with %s digests took %.1fms (%s)",
+                self.requested_op,
+                self.client_address[0],
+                self.digest_count,
+                duration * 1000,
+                ", ".join(
+                    "%s %.1fms" % (phase, self.phases[phase] * 1000)
+                    for phase in pyzor.metrics.PHASES
+                    if phase in self.phases
+                ),
+            )
+
+    def finish_response(self):
+        """Return the encoded response."""
+        response = self.response.as_string()
+        self.server.log.debug("Sending: %r", response)
+        return response.encode("utf8")
+
+    def handle_exception(self, e):
+        """Convert an exception raised while handling the request into the
+        appropriate error response.
+        """
+        if isinstance(e, NotImplementedError):
             self.handle_error(501, "Not implemented: %s" % e)
-        except pyzor.UnsupportedVersionError as e:
+        elif isinstance(e, pyzor.UnsupportedVersionError):
             self.handle_error(505, "Version Not Supported: %s" % e)
-        except pyzor.ProtocolError as e:
+        elif isinstance(e, pyzor.ProtocolError):
             self.handle_error(400, "Bad request: %s" % e)
-        except pyzor.SignatureError as e:
+        elif isinstance(e, pyzor.SignatureError):
             self.handle_error(401, "Unauthorized: Signature Error: %s" % e)
-        except pyzor.AuthorizationError as e:
+        elif isinstance(e, pyzor.AuthorizationError):
             self.handle_error(403, "Forbidden: %s" % e)
-        except Exception as e:
+        elif isinstance(e, pyzor.RateLimitError):
+            self.handle_error(429, "Too Many Requests: %s" % e)
+        elif isinstance(e, pyzor.BusyError):
+            self.handle_error(503, "Service Unavailable: %s" % e)
+        else:
             self.handle_error(500, "Internal Server Error: %s" % e)
             self.server.log.error(traceback.format_exc())
-        self.server.log.debug("Sending: %r", self.response.as_string())
-        self.wfile.write(self.response.as_string().encode("utf8"))
 
     def _really_handle(self):
         """handle() without the exception handling."""
+        user, opcode, digests = self.read_request()
+
+        # Do the requested operation, log what we have done, and return.
+        dispatch = self.dispatches[opcode]
+        if dispatch and (digests or opcode == "stats"):
+            dispatch(self, digests)
+        self.end_phase("engine")
+        self.log_usage(user, opcode, digests)
+        self.end_phase("log")
+
+    def read_request(self):
+        """Parse the request and check that it's valid and that the user
+        is allowed to execute it.
+
+        Returns a (user, opcode, digests) tuple.
+        """
         self.server.log.debug("Received: %r", self.packet)
 
         # Read the request.
         # Old versions of the client sent a double \n after the signature,
         # which screws up the RFC5321 format.  Specifically handle that
         # here - this could be removed in time.
-        request = email.message_from_bytes(
-            self.rfile.read().replace(b"\n\n", b"\n") + b"\n"
-        )
+        data = self.rfile.read().replace(b"\n\n", b"\n") + b"\n"
+        request = pyzor.message.Headers.parse(data)
 
         # Ensure that the response can be paired with the request.
         self.response["Thread"] = request["Thread"]
+        digests = request.get_all("Op-Digest")
+        self.digest_count = len(digests or ())
+        self.end_phase("parse")
 
         # If this is an authenticated request, then check the authentication
         # details.
-        user = request["User"] or pyzor.anonymous_user
+        user = self.requested_user = request["User"] or pyzor.anonymous_user
         if user != pyzor.anonymous_user:
-            try:
-                pyzor.account.verify_signature(request, self.server.accounts[user])
-            except KeyError:
-                raise pyzor.SignatureError("Unknown user.")
+            self.verify_signature(user, request, data)
+            self.end_phase("signature")
+        else:
+            # The anonymous requests received on the Unix socket are handled
+            # as the user it's mapped to, see UnixDatagramServer.
+            user = self.requested_user = self.local_user or user
 
         if "PV" not in request:
             raise pyzor.ProtocolError("Protocol Version not specified in " "request")
@@ -301,7 +1879,7 @@ class RequestHandler(SocketServer.DatagramRequestHandler):
 
         # Check that the user has permission to execute the requested
         # operation.
-        opcode = request["Op"]
+        opcode = self.requested_op = request["Op"]
         if opcode not in self.server.acl[user]:
             raise pyzor.AuthorizationError(
                 "User is not authorized to request the operation."
@@ -309,18 +1887,40 @@ class RequestHandler(SocketServer.DatagramRequestHandler):
         self.server.log.debug(
             "Got a %s command from %s", opcode, self.client_address[0]
         )
-        # Get a handle to the appropriate method to execute this operation.
+        # Check that there is a method to execute this operation.
+        if opcode not in self.dispatches:
+            raise NotImplementedError("Requested operation is not " "implemented.")
+        # Check that the user is not over its rate limit.
+        limiter = self.server.limiter
+        if limiter is not None and not limiter.allow_user(user):
+            self.server.metrics.request_rejected("user")
+            raise pyzor.RateLimitError("Too many requests from this user.")
+        hot_digests = self.server.hot_digests
+        if hot_digests is not None and opcode in ("check", "report") and digests:
+            hot_digests.add(digests)
+        self.end_phase("acl")
+        return user, opcode, digests
+
+    def verify_signature(self, user, request, data):
+        """Check the signature of an authenticated request. If the request
+        was serialized like the pyzor client does it, the signature is
+        checked over the received data, otherwise over the request
+        serialized again.
+        """
         try:
-            dispatch = self.dispatches[opcode]
+            user_key = self.server.accounts[user]
         except KeyError:
-            raise NotImplementedError("Requested operation is not " "implemented.")
-        # Get the existing record from the database (or a blank one if
-        # there is no matching record).
-        digests = request.get_all("Op-Digest")
-
-        # Do the requested operation, log what we have done, and return.
-        if dispatch and digests:
-            dispatch(self, digests)
+            raise pyzor.SignatureError("Unknown user.")
+        hashed_key = self.server.hashed_keys.get(user)
+        if hashed_key is not None and pyzor.account.is_canonical(data):
+            # A mismatch is final, serializing the request again would
+            # give the same data.
+            pyzor.account.verify_raw_signature(request, data, hashed_key)
+            return
+        pyzor.account.verify_signature(request, user_key)
+
+    def log_usage(self, user, opcode, digests):
+        """Log the request that has been handled in the usage log."""
         self.server.usage_log.info(
             "%s,%s,%s,%r,%s",
             user,
@@ -328,11 +1928,23 @@ class RequestHandler(SocketServer.DatagramRequestHandler):
             opcode,
             digests,
             self.response["Code"],
+            extra={"usage": (user, self.client_address[0], opcode)},
         )
 
     def handle_error(self, code, message):
         """Create an appropriate response for an error."""
-        self.server.usage_log.error("%s: %s", code, message)
+        self.server.usage_log.error(
+            "%s: %s",
+            code,
+            message,
+            extra={
+                "usage": (
+                    self.requested_user,
+                    self.client_address[0],
+                    self.requested_op,
+                )
+            },
+        )
         self.response.replace_header("Code", "%d" % code)
         self.response.replace_header("Diag", message)
 
@@ -345,19 +1957,30 @@ class RequestHandler(SocketServer.DatagramRequestHandler):
         self.response["Count"] = "%d" % sys.maxsize
         self.response["WL-Count"] = "%d" % 0
 
+    def lookup_record(self, digest):
+        """Get the record of a check or info request from the database, or
+        a blank one if there is no matching record. The concurrent lookups
+        of the same digest share one database call if the server coalesces
+        them.
+        """
+        try:
+            if self.server.lookups is not None:
+                return self.server.lookups.do(
+                    digest, self.server.database.__getitem__, digest
+                )
+            return self.server.database[digest]
+        except KeyError:
+            return pyzor.engines.common.Record()
+
     def handle_check(self, digests):
         """Handle the 'check' command.
 
         This command returns the spam/ham counts for the specified digest.
         """
         digest = digests[0]
-        try:
-            record = self.server.database[digest]
-        except KeyError:
-            record = pyzor.engines.common.Record()
+        record = self.lookup_record(digest)
         self.server.log.debug("Request to check digest %s", digest)
-        self.response["Count"] = "%d" % record.r_count
-        self.response["WL-Count"] = "%d" % record.wl_count
+        self.set_counts(record)
 
     def handle_report(self, digests):
         """Handle the 'report' command in a single step.
@@ -368,15 +1991,15 @@ class RequestHandler(SocketServer.DatagramRequestHandler):
             self.server.database.report(digests)
         else:
             for digest in digests:
-                try:
-                    record = self.server.database[digest]
-                except KeyError:
+                # Not read from the cache, see BaseEngine.get_fresh.
+                (record,) = pyzor.engines.common.fresh_records(
+                    self.server.database, [digest]
+                )
+                if record is None:
                     record = pyzor.engines.common.Record()
                 record.r_increment()
                 self.server.database[digest] = record
-        if self.server.forwarder:
-            for digest in digests:
-                self.server.forwarder.queue_forward_request(digest)
+        self.forward(digests)
 
     def handle_whitelist(self, digests):
         """Handle the 'whitelist' command in a single step.
@@ -387,15 +2010,14 @@ class RequestHandler(SocketServer.DatagramRequestHandler):
             self.server.database.whitelist(digests)
         else:
             for digest in digests:
-                try:
-                    record = self.server.database[digest]
-                except KeyError:
+                (record,) = pyzor.engines.common.fresh_records(
+                    self.server.database, [digest]
+                )
+                if record is None:
                     record = pyzor.engines.common.Record()
                 record.wl_increment()
                 self.server.database[digest] = record
-        if self.server.forwarder:
-            for digest in digests:
-                self.server.forwarder.queue_forward_request(digest, True)
+        self.forward(digests, True)
 
     def handle_info(self, digests):
         """Handle the 'info' command.
@@ -405,11 +2027,40 @@ class RequestHandler(SocketServer.DatagramRequestHandler):
         counts).
         """
         digest = digests[0]
-        try:
-            record = self.server.database[digest]
-        except KeyError:
-            record = pyzor.engines.common.Record()
+        record = self.lookup_record(digest)
         self.server.log.debug("Request for information about digest %s", digest)
+        self.set_info(record)
+
+    def handle_stats(self, digests):
+        """Handle the 'stats' command.
+
+        This command returns the metrics of the server, aggregated across
+        all its processes, one per "Stat" header, followed by the hot
+        digests of the process that handles it. The lines that don't fit
+        in max_packet_size are left out.
+        """
+        self.server.log.debug("Request for the server statistics")
+        self.server.update_metrics()
+        lines = self.server.metrics.summary()
+        if self.server.hot_digests is not None:
+            lines.extend(self.server.hot_digests.summary())
+        size = len(self.response.as_string())
+        for line in lines:
+            size += len("Stat: %s\n" % line)
+            if size > self.server.max_packet_size:
+                self.server.log.debug("The statistics were truncated")
+                break
+            self.response["Stat"] = line
+
+    def set_counts(self, record):
+        """Add the spam/ham counts of the record to the response."""
+        self.response["Count"] = "%d" % record.r_count
+        self.response["WL-Count"] = "%d" % record.wl_count
+
+    def set_info(self, record):
+        """Add the timestamps and the spam/ham counts of the record to the
+        response.
+        """
 
         def time_output(time_obj):
             """Convert a datetime object to a POSIX timestamp.
@@ -424,8 +2075,15 @@ class RequestHandler(SocketServer.DatagramRequestHandler):
         self.response["Updated"] = "%d" % time_output(record.r_updated)
         self.response["WL-Entered"] = "%d" % time_output(record.wl_entered)
         self.response["WL-Updated"] = "%d" % time_output(record.wl_updated)
-        self.response["Count"] = "%d" % record.r_count
-        self.response["WL-Count"] = "%d" % record.wl_count
+        self.set_counts(record)
+
+    def forward(self, digests, whitelist=False):
+        """Queue the digests to be forwarded, if forwarding is enabled."""
+        if self.server.forwarder:
+            self.end_phase("engine")
+            for digest in digests:
+                self.server.forwarder.queue_forward_request(digest, whitelist)
+            self.end_phase("forward")
 
     dispatches = {
         "ping": None,
@@ -434,4 +2092,116 @@ class RequestHandler(SocketServer.DatagramRequestHandler):
         "check": handle_check,
         "report": handle_report,
         "whitelist": handle_whitelist,
+        "stats": handle_stats,
+    }
+
+
+class RejectedRequestHandler(RequestHandler):
+    """Answer a request that was not admitted by the server with an error,
+    without handling it. Only the headers needed to pair the response with
+    the request are read.
+    """
+
+    errors = {
+        "address": pyzor.RateLimitError("Too many requests from this address."),
+        "busy": pyzor.BusyError("Too many pending requests."),
+    }
+
+    def __init__(self, request, client_address, server, reason):
+        self.reason = reason
+        RequestHandler.__init__(self, request, client_address, server)
+
+    def _really_handle(self):
+        request = pyzor.message.Headers.parse(self.rfile.read())
+        self.response["Thread"] = request["Thread"]
+        self.requested_op = request["Op"]
+        raise self.errors[self.reason]
+
+    def handle_error(self, code, message):
+        # The rejected requests are only counted in the metrics, logging
+        # them would add to the load.
+        self.response.replace_header("Code", "%d" % code)
+        self.response.replace_header("Diag", message)
+
+    def record_phases(self, duration):
+        # The rejected requests are not handled, they have no phases.
+        pass
+
+
+class BatchRequestHandler(RequestHandler):
+    """Handle a single pyzord request that is part of a batch. The calls to
+    the database are made by the BatchServer for the whole batch.
+    """
+
+    def __init__(self, packet, client_address, server):
+        self.response = pyzor.message.Headers()
+        self.packet = packet
+        self.client_address = client_address
+        self.server = server
+        self.rfile = io.BytesIO(packet)
+        self.user = None
+        self.opcode = None
+        self.digests = None
+        # Filled in by the server
+        self.records = {}
+        self.error = None
+
+    def prepare(self):
+        """Read and check the request."""
+        self.start_response()
+        try:
+            self.user, self.opcode, self.digests = self.read_request()
+        except Exception as e:
+            self.opcode = None
+            self.handle_exception(e)
+
+    def complete(self):
+        """Complete the request once the database calls are done. Returns
+        the encoded response.
+        """
+        if self.opcode is None:
+            return self.finish_response()
+        try:
+            if self.error is not None:
+                raise self.error
+            # The records were read or written for the whole batch.
+            self.end_phase("engine")
+            dispatch = self.dispatches[self.opcode]
+            if dispatch and (self.digests or self.opcode == "stats"):
+                dispatch(self, self.digests)
+            self.end_phase("engine")
+            self.log_usage(self.user, self.opcode, self.digests)
+            self.end_phase("log")
+        except Exception as e:
+            self.handle_exception(e)
+        return self.finish_response()
+
+    def handle_check(self, digests):
+        digest = digests[0]
+        record = self.records.get(digest) or pyzor.engines.common.Record()
+        self.server.log.debug("Request to check digest %s", digest)
+        self.set_counts(record)
+
+    def handle_report(self, digests):
+        self.server.log.debug("Request to report digests %s", digests)
+        self.forward(digests)
+
+    def handle_whitelist(self, digests):
+        self.server.log.debug("Request to whitelist digests %s", digests)
+        self.forward(digests, True)
+
+    def handle_info(self, digests):
+        digest = digests[0]
+        record = self.records.get(digest) or pyzor.engines.common.Record()
+        self.server.log.debug("Request for information about digest %s", digest)
+        self.set_info(record)
+
+    dispatches = {
+        "ping": None,
+        "pong": RequestHandler.handle_pong,
+        "info": handle_info,
+        "check": handle_check,
+        "report": handle_report,
+        "whitelist": handle_whitelist,
+        "stats": RequestHandler.handle_stats,
     }
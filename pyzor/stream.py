@@ -0,0 +1,45 @@
+"""Framing of the pyzor messages sent over stream connections.
+
+Besides UDP datagrams, pyzord can accept requests over TCP or Unix stream
+connections. Every message sent on a connection is preceded by its
+length, as a 4 bytes unsigned integer in network byte order. Unlike the
+datagrams, the messages are not limited to 8192 bytes, so a single report
+can carry many digests.
+
+Several requests can be sent on a connection without waiting for their
+responses, which are sent back in the same order.
+"""
+
+import struct
+
+import pyzor
+
+_LENGTH = struct.Struct("!I")
+
+# The largest message accepted, in bytes.
+max_message_size = 1024 * 1024
+
+
+def pack(data):
+    """Returns the message prefixed with its length."""
+    return _LENGTH.pack(len(data)) + data
+
+
+def read_message(rfile, max_size=None):
+    """Read the next message from the file of a stream connection. Returns
+    None if the connection was closed between two messages.
+    """
+    if max_size is None:
+        max_size = max_message_size
+    header = rfile.read(_LENGTH.size)
+    if not header:
+        return None
+    if len(header) < _LENGTH.size:
+        raise pyzor.ProtocolError("Connection closed while reading a message.")
+    (length,) = _LENGTH.unpack(header)
+    if length > max_size:
+        raise pyzor.ProtocolError("Message too large (%d bytes)." % length)
+    data = rfile.read(length)
+    if len(data) < length:
+        raise pyzor.ProtocolError("Connection closed while reading a message.")
+    return data
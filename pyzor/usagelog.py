@@ -0,0 +1,284 @@
+"""Asynchronous usage log of the pyzord server.
+
+Writing every request to the usage log from the thread that handles it puts
+the latency of the disk on the request path. The AsyncFileHandler only
+queues the records, they are formatted and written by a background thread
+in batches, with a single write and flush for each batch.
+
+The CSVFormatter writes the records as comma separated values, which is
+more compact and easier to process than the default format.
+
+The requests are logged with a `usage` attribute holding the user, the
+client address and the operation. The SampleFilter only keeps a sample of
+these records, and the UsageStatsHandler counts them, writing the totals
+for each user, address and operation at regular intervals instead.
+"""
+
+import io
+import os
+import csv
+import time
+import random
+import logging
+import threading
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+# The formats of the usage log.
+FORMATS = ("text", "csv")
+
+
+class CSVFormatter(logging.Formatter):
+    """Format the records as CSV rows: the time, the process id and the
+    level, followed by one column for each argument of the message. Lists
+    (like the digests of a request) are joined with spaces.
+    """
+
+    def format(self, record):
+        args = record.args
+        if not args or not isinstance(args, tuple):
+            args = (record.getMessage(),)
+        row = [self.formatTime(record), record.process, record.levelname]
+        for arg in args:
+            if isinstance(arg, (list, tuple)):
+                arg = " ".join(str(item) for item in arg)
+            row.append(arg)
+        output = io.StringIO()
+        csv.writer(output, lineterminator="").writerow(row)
+        return output.getvalue()
+
+
+class AsyncFileHandler(logging.FileHandler):
+    """Write the records to `filename` from a background thread.
+
+    The records are queued, up to `queue_size` of them, and written in
+    batches of up to `batch_size` records. When the queue is full the
+    records are dropped and counted, so logging never blocks.
+
+    The records are only formatted by the background thread, the arguments
+    of the messages must not be changed after they are logged. A new
+    thread is started in the processes forked after the handler was
+    created. The queued records are written when the handler is closed,
+    e.g. by logging.shutdown().
+    """
+
+    def __init__(self, filename, queue_size=10000, batch_size=100):
+        logging.FileHandler.__init__(self, filename)
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.written = 0
+        self._pid = None
+        self._thread = None
+        self.queue = None
+
+    def _start(self):
+        # The records queued by the parent process are not written again,
+        # and the counts are only those of this process.
+        self.queue = Queue.Queue(self.queue_size)
+        self.dropped = 0
+        self.written = 0
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._write_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        queue = self.queue
+        while True:
+            records = [queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = None in records
+            self._write([record for record in records if record is not None])
+            if stop:
+                return
+
+    def _write(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record) + self.terminator)
+            except Exception:
+                self.handleError(record)
+        if not lines:
+            return
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write("".join(lines))
+            self.stream.flush()
+        except Exception:
+            self.handleError(records[-1])
+            return
+        self.written += len(lines)
+
+    def queue_depth(self):
+        if self.queue is None:
+            return 0
+        return self.queue.qsize()
+
+    def stats(self):
+        """Returns a dictionary with the number of records queued, written
+        and dropped by this process.
+        """
+        return {
+            "queue_depth": self.queue_depth(),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+    def flush(self):
+        # Only the background thread writes to the file, and it flushes it
+        # after each batch.
+        pass
+
+    def close(self):
+        """Write the queued records, then close the file."""
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        self._pid = None
+        logging.FileHandler.close(self)
+
+
+class SampleFilter(logging.Filter):
+    """Only keep a `rate` fraction of the records of the requests. The
+    errors and the records that are not about a request are always kept.
+    """
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or getattr(record, "usage", None) is None:
+            return True
+        return random.random() < self.rate
+
+
+class UsageStatsHandler(logging.Handler):
+    """Count the requests and errors of each user, client address and
+    operation, and write the totals to the `target` handler every
+    `interval` seconds, and when the handler is closed.
+
+    The totals are written by a background thread, even when no request
+    arrives. Like with the AsyncFileHandler, a new thread is started in
+    the processes forked after the handler was created, and they only
+    count their own requests.
+
+    The totals are written as records with the "stats" prefix, followed by
+    the number of seconds counted, the kind ("user", "address" or "op"),
+    the name, the number of requests and the number of errors. At most
+    `max_names` names of each kind are counted in an interval, the others
+    are added up as "other".
+    """
+
+    max_names = 10000
+
+    def __init__(self, target, interval, max_names=None):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.interval = interval
+        if max_names is not None:
+            self.max_names = max_names
+        self.counts = dict((kind, {}) for kind in ("user", "address", "op"))
+        self._logger_name = None
+        self._start = time.monotonic()
+        self._pid = None
+        self._stop = None
+
+    def _start_timer(self):
+        # The counts of the parent process are not written again.
+        for counts in self.counts.values():
+            counts.clear()
+        self._start = time.monotonic()
+        self._pid = os.getpid()
+        if self._stop is not None:
+            self._stop.set()
+        self._stop = threading.Event()
+        thread = threading.Thread(target=self._flush_loop, args=(self._stop,))
+        thread.daemon = True
+        thread.start()
+
+    def _flush_loop(self, stop):
+        while True:
+            remaining = self._start + self.interval - time.monotonic()
+            if remaining > 0:
+                if stop.wait(remaining):
+                    return
+            else:
+                self.flush()
+
+    def emit(self, record):
+        usage = getattr(record, "usage", None)
+        if usage is None:
+            return
+        if self._pid != os.getpid():
+            self._start_timer()
+        self._logger_name = record.name
+        error = record.levelno >= logging.WARNING
+        for kind, name in zip(("user", "address", "op"), usage):
+            if name is None:
+                continue
+            counts = self.counts[kind]
+            try:
+                count = counts[name]
+            except KeyError:
+                if len(counts) >= self.max_names:
+                    name = "other"
+                count = counts.setdefault(name, [0, 0])
+            count[0] += 1
+            if error:
+                count[1] += 1
+        if time.monotonic() - self._start >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Write the totals to the target handler and start a new
+        interval.
+        """
+        self.acquire()
+        try:
+            now = time.monotonic()
+            elapsed = int(round(now - self._start))
+            self._start = now
+            for kind, counts in self.counts.items():
+                for name, (requests, errors) in sorted(counts.items()):
+                    self.target.handle(
+                        logging.LogRecord(
+                            self._logger_name,
+                            logging.INFO,
+                            __file__,
+                            0,
+                            "%s,%s,%s,%s,%s,%s",
+                            ("stats", elapsed, kind, name, requests, errors),
+                            None,
+                        )
+                    )
+                counts.clear()
+        finally:
+            self.release()
+
+    def close(self):
+        """Write the totals of the current interval, then close the
+        handler.
+        """
+        if self._pid == os.getpid():
+            self._stop.set()
+        self.flush()
+        logging.Handler.close(self)
@@ -0,0 +1,199 @@
+"""Compare the throughput and the latency of the pyzord servers.
+
+Every server is started in its own process (the gevent server patches the
+standard library), and is sent `--requests` check requests from
+`--clients` concurrent clients. By default the records are kept in memory
+and every database call waits `--delay` milliseconds, like a remote
+database would; use `--engine` and `--dsn` to benchmark a real engine:
+
+    python tests/benchmark/compare_servers.py --engine redis --dsn localhost,6379,,0
+"""
+
+from __future__ import division
+
+import os
+import sys
+import time
+import socket
+import logging
+import optparse
+import threading
+import subprocess
+
+SERVERS = ("threading", "gevent")
+
+
+def get_database(engine, dsn, delay):
+    import pyzor.engines
+    import pyzor.engines.common
+
+    if engine != "memory":
+        database_classes = pyzor.engines.database_classes[engine]
+        database_class = (
+            database_classes.multi_threaded or database_classes.single_threaded
+        )
+        return database_class(dsn, "c", 0)
+
+    class MemoryEngine(dict, pyzor.engines.common.BaseEngine):
+        """Keep the records in memory, waiting `delay` seconds for every
+        call.
+        """
+
+        handles_one_step = False
+
+        def __getitem__(self, key):
+            time.sleep(delay)
+            return dict.__getitem__(self, key)
+
+        def __setitem__(self, key, value):
+            time.sleep(delay)
+            dict.__setitem__(self, key, value)
+
+    return MemoryEngine()
+
+
+def serve(kind, port, options):
+    """Run the `kind` server until it's terminated."""
+    if kind == "gevent":
+        import gevent.monkey
+
+        gevent.monkey.patch_all()
+    import pyzor.server
+
+    logging.getLogger("pyzord").addHandler(logging.NullHandler())
+    logging.getLogger("pyzord-usage").addHandler(logging.NullHandler())
+    database = get_database(options.engine, options.dsn, options.delay / 1000)
+    address = ("127.0.0.1", port)
+    if kind == "gevent":
+        server = pyzor.server.GeventServer(
+            address, database, os.devnull, os.devnull, options.max_concurrent
+        )
+    elif options.max_concurrent:
+        server = pyzor.server.BoundedThreadingServer(
+            address, database, os.devnull, os.devnull, options.max_concurrent
+        )
+    else:
+        server = pyzor.server.ThreadingServer(address, database, os.devnull, os.devnull)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_server(address, timeout=10):
+    import pyzor
+    import pyzor.client
+
+    client = pyzor.client.Client(timeout=0.5)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            client.ping(address)
+            return
+        except pyzor.TimeoutError:
+            pass
+    raise RuntimeError("The server didn't start.")
+
+
+def measure(address, requests, clients, timeout):
+    """Send the check requests, returns the total time, the latencies and
+    the number of timeouts.
+    """
+    import pyzor
+    import pyzor.client
+
+    latencies = []
+    timeouts = [0]
+    lock = threading.Lock()
+
+    def run(count, index):
+        client = pyzor.client.Client(timeout=timeout)
+        for i in range(count):
+            digest = "%040x" % (index * requests + i)
+            start = time.time()
+            try:
+                client.check(digest, address)
+            except pyzor.TimeoutError:
+                with lock:
+                    timeouts[0] += 1
+                continue
+            with lock:
+                latencies.append(time.time() - start)
+
+    threads = [
+        threading.Thread(target=run, args=(requests // clients, index))
+        for index in range(clients)
+    ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, sorted(latencies), timeouts[0]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    opt = optparse.OptionParser()
+    opt.add_option("--servers", default=",".join(SERVERS))
+    opt.add_option("--engine", default="memory")
+    opt.add_option("--dsn", default=None)
+    opt.add_option("--delay", type="float", default=1, help="milliseconds")
+    opt.add_option("--requests", type="int", default=10000)
+    opt.add_option("--clients", type="int", default=50)
+    opt.add_option("--max-concurrent", type="int", default=0)
+    opt.add_option("--timeout", type="float", default=5)
+    opt.add_option("--serve", default=None, help=optparse.SUPPRESS_HELP)
+    opt.add_option("--port", type="int", default=0, help=optparse.SUPPRESS_HELP)
+    options, _ = opt.parse_args()
+    if options.serve:
+        serve(options.serve, options.port, options)
+        return
+
+    print(
+        "%-10s %10s %10s %10s %10s %8s"
+        % ("server", "req/s", "p50 (ms)", "p99 (ms)", "max (ms)", "timeouts")
+    )
+    for kind in options.servers.split(","):
+        port = free_port()
+        argv = [a for a in sys.argv if not a.startswith("--servers")]
+        process = subprocess.Popen(
+            [sys.executable] + argv + ["--serve", kind, "--port", str(port)]
+        )
+        address = ("127.0.0.1", port)
+        try:
+            wait_for_server(address)
+            elapsed, latencies, timeouts = measure(
+                address, options.requests, options.clients, options.timeout
+            )
+        finally:
+            process.terminate()
+            process.wait()
+        print(
+            "%-10s %10.0f %10.2f %10.2f %10.2f %8d"
+            % (
+                kind,
+                len(latencies) / elapsed,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                (latencies[-1] if latencies else 0) * 1000,
+                timeouts,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
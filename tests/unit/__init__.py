@@ -12,9 +12,18 @@ def suite():
     import test_client
     import test_config
     import test_digest
+    import test_index
+    import test_limits
+    import test_hotdigests
+    import test_message
+    import test_profiling
+    import test_metrics
     import test_server
+    import test_stream
+    import test_asyncserver
     import test_account
     import test_forwarder
+    import test_usagelog
     import test_engines
 
     test_suite = unittest.TestSuite()
@@ -23,9 +32,18 @@ def suite():
     test_suite.addTest(test_client.suite())
     test_suite.addTest(test_config.suite())
     test_suite.addTest(test_digest.suite())
+    test_suite.addTest(test_index.suite())
+    test_suite.addTest(test_limits.suite())
+    test_suite.addTest(test_hotdigests.suite())
+    test_suite.addTest(test_message.suite())
+    test_suite.addTest(test_profiling.suite())
+    test_suite.addTest(test_metrics.suite())
     test_suite.addTest(test_server.suite())
+    test_suite.addTest(test_stream.suite())
+    test_suite.addTest(test_asyncserver.suite())
     test_suite.addTest(test_account.suite())
     test_suite.addTest(test_forwarder.suite())
+    test_suite.addTest(test_usagelog.suite())
     return test_suite
 
 
@@ -33,6 +33,14 @@ class AccountTest(unittest.TestCase):
         result = pyzor.account.sign_msg(hashed_key, self.timestamp, self.msg)
         self.assertEqual(result, expected)
 
+    def test_sign_bytes(self):
+        """Test signing the serialized message"""
+        hashed_key = hashlib.sha1(b"test_key").hexdigest()
+        expected = "2ab1bad2aae6fd80c656a896c82eef0ec1ec38a0"
+        data = self.msg.as_string().encode("utf8")
+        result = pyzor.account.sign_bytes(hashed_key, self.timestamp, data)
+        self.assertEqual(result, expected)
+
     def test_hash_key(self):
         """Test the hash key function"""
         user = "testuser"
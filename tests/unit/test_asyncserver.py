@@ -0,0 +1,281 @@
+"""Test the pyzor.asyncserver module"""
+
+import os
+import sys
+import time
+import socket
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+
+import pyzor.client
+import pyzor.limits
+import pyzor.asyncserver
+import pyzor.engines.buffer
+import pyzor.engines.common
+
+from tests.unit.test_server import MockServer
+from tests.unit.test_engines.test_cache import MockEngine
+
+
+class MockAsyncEngine(pyzor.engines.common.AsyncBaseEngine):
+    """A natively asynchronous engine backed by a dictionary."""
+
+    def __init__(self, records=None):
+        self.records = records or {}
+
+    async def get(self, key):
+        return self.records[key]
+
+    async def set(self, key, value):
+        self.records[key] = value
+
+    async def close(self):
+        pass
+
+
+class SlowAsyncEngine(MockAsyncEngine):
+    """Count the lookups, which take a little while."""
+
+    def __init__(self, records=None):
+        MockAsyncEngine.__init__(self, records)
+        self.lookups = 0
+
+    async def get(self, key):
+        self.lookups += 1
+        await asyncio.sleep(0.01)
+        return self.records[key]
+
+
+class AsyncRequestHandlerTest(unittest.TestCase):
+    digest = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.loop = asyncio.new_event_loop()
+        self.request = {
+            "User": pyzor.anonymous_user,
+            "Time": str(int(time.time())),
+            "PV": str(pyzor.proto_version),
+            "Thread": "3597",
+        }
+        self.expected_response = {
+            "Code": "200",
+            "Diag": "OK",
+            "PV": str(pyzor.proto_version),
+            "Thread": "3597",
+        }
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.loop.close()
+
+    def get_handler(self, database):
+        server = MockServer()
+        server.database = database
+        server.one_step = database.handles_one_step
+        server.acl = {pyzor.anonymous_user: ("check", "report", "ping", "pong", "info")}
+        server.accounts = {}
+        packet = "".join("%s: %s\n" % item for item in self.request.items())
+        return pyzor.asyncserver.AsyncRequestHandler(
+            packet.encode("utf8"), ("127.0.0.1", 24442), server
+        )
+
+    def handle(self, database):
+        handler = self.get_handler(database)
+        return self.loop.run_until_complete(handler.handle())
+
+    def check_response(self, response):
+        result = {}
+        for line in response.decode("utf8").splitlines():
+            if line:
+                key, value = line.split(":", 1)
+                result[key] = value.strip()
+        self.assertEqual(result, self.expected_response)
+
+    def test_ping(self):
+        self.request["Op"] = "ping"
+        self.check_response(self.handle(MockAsyncEngine()))
+
+    def test_pong(self):
+        self.request["Op"] = "pong"
+        self.request["Op-Digest"] = self.digest
+        self.expected_response["Count"] = str(sys.maxsize)
+        self.expected_response["WL-Count"] = "0"
+        self.check_response(self.handle(MockAsyncEngine()))
+
+    def test_check(self):
+        database = MockAsyncEngine({self.digest: pyzor.engines.common.Record(24, 42)})
+        self.request["Op"] = "check"
+        self.request["Op-Digest"] = self.digest
+        self.expected_response["Count"] = "24"
+        self.expected_response["WL-Count"] = "42"
+        self.check_response(self.handle(database))
+
+    def test_check_new(self):
+        self.request["Op"] = "check"
+        self.request["Op-Digest"] = self.digest
+        self.expected_response["Count"] = "0"
+        self.expected_response["WL-Count"] = "0"
+        self.check_response(self.handle(MockAsyncEngine()))
+
+    def test_report(self):
+        database = MockAsyncEngine({self.digest: pyzor.engines.common.Record(24, 42)})
+        self.request["Op"] = "report"
+        self.request["Op-Digest"] = self.digest
+        self.check_response(self.handle(database))
+        self.assertEqual(database.records[self.digest].r_count, 25)
+
+    def test_check_coalesced(self):
+        database = SlowAsyncEngine({self.digest: pyzor.engines.common.Record(24, 42)})
+        self.request["Op"] = "check"
+        self.request["Op-Digest"] = self.digest
+        lookups = pyzor.asyncserver.AsyncSingleflight()
+        handlers = [self.get_handler(database) for _ in range(3)]
+        for handler in handlers:
+            handler.server.lookups = lookups
+
+        async def handle_all():
+            return await asyncio.gather(*[handler.handle() for handler in handlers])
+
+        responses = self.loop.run_until_complete(handle_all())
+        self.expected_response["Count"] = "24"
+        self.expected_response["WL-Count"] = "42"
+        for response in responses:
+            self.check_response(response)
+        self.assertEqual(database.lookups, 1)
+        self.assertEqual(lookups.stats(), {"calls": 1, "coalesced": 2, "in_flight": 0})
+        # The next lookup is not coalesced.
+        handler = self.get_handler(database)
+        handler.server.lookups = lookups
+        self.check_response(self.loop.run_until_complete(handler.handle()))
+        self.assertEqual(database.lookups, 2)
+
+    def test_phases(self):
+        self.request["Op"] = "check"
+        self.request["Op-Digest"] = self.digest
+        handler = self.get_handler(MockAsyncEngine())
+        self.loop.run_until_complete(handler.handle())
+        self.assertEqual(sorted(handler.phases), ["acl", "engine", "log", "parse"])
+
+    def test_report_executor(self):
+        records = {}
+        database = pyzor.asyncserver.ExecutorEngine(records, self.loop, 1)
+        self.request["Op"] = "report"
+        self.request["Op-Digest"] = self.digest
+        self.check_response(self.handle(database))
+        self.check_response(self.handle(database))
+        self.assertEqual(records[self.digest].r_count, 2)
+        self.loop.run_until_complete(database.close())
+
+    def test_unauthorized(self):
+        self.request["Op"] = "whitelist"
+        self.request["Op-Digest"] = self.digest
+        self.expected_response["Code"] = "403"
+        self.expected_response["Diag"] = (
+            "Forbidden: User is not authorized to request the operation."
+        )
+        self.check_response(self.handle(MockAsyncEngine()))
+
+    def test_database_error(self):
+        class FailingEngine(MockAsyncEngine):
+            async def get(self, key):
+                raise pyzor.engines.common.DatabaseError("unavailable")
+
+        self.request["Op"] = "check"
+        self.request["Op-Digest"] = self.digest
+        self.expected_response["Code"] = "500"
+        self.expected_response["Diag"] = "Internal Server Error: unavailable"
+        self.check_response(self.handle(FailingEngine()))
+
+
+class AsyncServerTest(unittest.TestCase):
+    digest = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        access_fn = os.path.join(self.tmpdir, "pyzord.access")
+        with open(access_fn, "w") as accessf:
+            accessf.write("all : anonymous : allow\n")
+        self.records = {}
+        self.server = pyzor.asyncserver.AsyncServer(
+            ("127.0.0.1", 0),
+            self.records,
+            os.path.join(self.tmpdir, "pyzord.passwd"),
+            access_fn,
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.server.shutdown()
+        self.thread.join(5)
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_serve(self):
+        client = pyzor.client.Client(timeout=5)
+        address = self.server.server_address
+        self.assertTrue(client.ping(address).is_ok())
+        client.report(self.digest, address)
+        client.report(self.digest, address)
+        response = client.check(self.digest, address)
+        self.assertEqual(response["Count"], "2")
+        self.assertEqual(self.records[self.digest].r_count, 2)
+
+    def test_service_actions(self):
+        self.server.shutdown()
+        self.thread.join(5)
+        self.server.server_close()
+        engine = MockEngine()
+        database = pyzor.engines.buffer.BufferedEngine(engine, flush_interval=1)
+        self.server = pyzor.asyncserver.AsyncServer(
+            ("127.0.0.1", 0),
+            database,
+            self.server.passwd_fn,
+            self.server.access_fn,
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        client = pyzor.client.Client(timeout=5)
+        client.report(self.digest, self.server.server_address)
+        self.assertEqual(engine.records, {})
+        # The increment is written while the server is idle.
+        deadline = time.time() + 5
+        while not engine.records and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(engine.records[self.digest].r_count, 1)
+        deadline = time.time() + 5
+        while (
+            "pyzord_buffer_flushes_total 1" not in self.server.metrics.summary()
+            and time.time() < deadline
+        ):
+            time.sleep(0.05)
+        self.assertIn("pyzord_buffer_flushes_total 1", self.server.metrics.summary())
+
+    def test_rate_limit(self):
+        self.server.limiter = pyzor.limits.RateLimiter({"address": {"all": (1, 2)}})
+        client = pyzor.client.Client(timeout=5)
+        address = self.server.server_address
+        codes = [client.ping(address)["Code"] for _ in range(3)]
+        self.assertEqual(codes, ["200", "200", "429"])
+        self.assertIn(
+            'pyzord_requests_rejected_total{reason="address"} 1',
+            self.server.metrics.summary(),
+        )
+
+
+def suite():
+    """Gather all the tests from this module in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(AsyncRequestHandlerTest))
+    test_suite.addTest(unittest.makeSuite(AsyncServerTest))
+    return test_suite
+
+
+if __name__ == "__main__":
+    unittest.main()
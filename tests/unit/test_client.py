@@ -1,5 +1,7 @@
 import time
 import email
+import errno
+import socket
 import unittest
 
 try:
@@ -9,6 +11,7 @@ except ImportError:
 
 
 import pyzor.client
+import pyzor.stream
 import pyzor.account
 
 
@@ -167,6 +170,18 @@ class ClientTest(TestBase):
         self.patch_all()
         self.assertRaises(pyzor.ProtocolError, self.check_client, None, "ping")
 
+    def test_unix(self):
+        self.patch_all()
+        client = pyzor.client.Client()
+        client.ping(("/run/pyzord.sock", 0))
+        self.mock_socket.socket.assert_called_once_with(
+            self.mock_socket.AF_UNIX, self.mock_socket.SOCK_DGRAM
+        )
+        # The client socket is bound, so that the server can answer.
+        self.mock_socket.socket().bind.assert_called_once_with("")
+        self.assertEqual(list(self.get_requests())[0][0][2], "/run/pyzord.sock")
+        self.assertFalse(self.mock_socket.getaddrinfo.called)
+
     def test_set_timeout(self):
         self.expected = None
         self.patch_all()
@@ -178,6 +193,17 @@ class ClientTest(TestBase):
         ]
         self.mock_socket.assert_has_calls(calls)
 
+    def test_snapshot_check(self):
+        digest = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+        client = pyzor.client.Client()
+        response = client.snapshot_check(digest, {digest: (5, 1)})
+        self.assertTrue(response.is_ok())
+        self.assertEqual(response["Count"], "5")
+        self.assertEqual(response["WL-Count"], "1")
+        response = client.snapshot_check(digest, {})
+        self.assertEqual(response["Count"], "0")
+        self.assertEqual(response["WL-Count"], "0")
+
 
 class BatchClientTest(TestBase):
     def test_report(self):
@@ -277,6 +303,308 @@ class BatchClientTest(TestBase):
         self.assertEqual(list(self.get_requests()), [])
 
 
+class MockPipelineSocket(object):
+    """Answers every request with an OK response, in reverse order."""
+
+    def __init__(self, *args):
+        self.sent = []
+        self.responses = []
+
+    def setblocking(self, flag):
+        pass
+
+    def bind(self, address):
+        pass
+
+    def sendto(self, packet, flags, address):
+        msg = email.message_from_bytes(packet)
+        self.sent.append(msg)
+        response = "Code: 200\nDiag: OK\nPV: 2.1\nThread: %s\nCount: %d\n" % (
+            msg["Thread"],
+            len(self.sent),
+        )
+        response += "WL-Count: 0\n"
+        self.responses.append((response.encode(), address))
+
+    def recvfrom(self, size):
+        if not self.responses:
+            raise socket.error(errno.EAGAIN, "Try again")
+        return self.responses.pop()
+
+    def close(self):
+        pass
+
+
+class PipelinedClientTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.servers = [("127.0.0.1", 24441), ("127.0.0.2", 24441)]
+        self.digests = [
+            "2aedaac999d71421c9ee49b9d81f627a7bc570aa",
+            "da39a3ee5e6b4b0d3255bfef95601890afd80709",
+            "975422c090e7a43ab7c9bf0065d5b661259e6d74",
+        ]
+        patch("pyzor.account.sign_msg", return_value="TestSig").start()
+        patch("pyzor.account.hash_key").start()
+        patch(
+            "pyzor.client.socket.getaddrinfo",
+            side_effect=lambda host, port, *args: [(2, 2, 17, "", (host, port))],
+        ).start()
+        self.sock = MockPipelineSocket()
+        patch("pyzor.client.socket.socket", return_value=self.sock).start()
+        patch(
+            "pyzor.client.select.select", side_effect=lambda r, w, x, t: (r, w, x)
+        ).start()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def test_input_order(self):
+        client = pyzor.client.PipelinedClient(window=10)
+        results = list(client.pipeline_digests("check", self.digests, self.servers))
+        self.assertEqual([digest for digest, _ in results], self.digests)
+        for digest, responses in results:
+            self.assertEqual([server for server, _ in responses], self.servers)
+            for server, response in responses:
+                request = self.sock.sent[int(response["Count"]) - 1]
+                self.assertEqual(request["Op-Digest"], digest)
+                self.assertEqual(request["Thread"], response["Thread"])
+
+    def test_window(self):
+        client = pyzor.client.PipelinedClient(window=1)
+        results = list(client.pipeline_digests("check", self.digests, self.servers))
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(self.sock.sent), 6)
+
+    def test_batch(self):
+        client = pyzor.client.PipelinedClient()
+        results = list(
+            client.pipeline_digests("report", self.digests, self.servers, 2)
+        )
+        self.assertEqual([digest for digest, _ in results], self.digests)
+        self.assertEqual(len(self.sock.sent), 4)
+        self.assertEqual(self.sock.sent[0].get_all("Op-Digest"), self.digests[:2])
+        self.assertEqual(self.sock.sent[0]["Op"], "report")
+
+    def test_timeout(self):
+        self.sock.responses = None
+        self.sock.sendto = lambda packet, flags, address: None
+        client = pyzor.client.PipelinedClient(timeout=0)
+        results = list(client.pipeline_digests("check", self.digests, self.servers))
+        for _, responses in results:
+            for _, response in responses:
+                self.assertIsInstance(response, pyzor.TimeoutError)
+
+    def test_unix(self):
+        servers = [("/run/pyzord.sock", 0)]
+        client = pyzor.client.PipelinedClient()
+        with patch("pyzor.client.socket.socket", return_value=self.sock) as socket_:
+            results = list(client.pipeline_digests("check", self.digests, servers))
+        socket_.assert_called_once_with(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.assertFalse(pyzor.client.socket.getaddrinfo.called)
+        for _, responses in results:
+            self.assertEqual(responses[0][0], servers[0])
+            self.assertTrue(responses[0][1].is_ok())
+
+    def test_runner(self):
+        client = pyzor.client.PipelinedClient()
+        runner = pyzor.client.CheckClientRunner(client.check)
+        for digest, responses in client.pipeline_digests(
+            "check", self.digests, self.servers
+        ):
+            for server, response in responses:
+                runner.add_result(server, response)
+        self.assertTrue(runner.all_ok)
+        self.assertEqual(len(runner.results), 6)
+        runner.add_result(self.servers[0], pyzor.TimeoutError("timeout"))
+        self.assertFalse(runner.all_ok)
+
+
+    def test_ring(self):
+        ring = pyzor.client.HashRing(self.servers)
+        client = pyzor.client.PipelinedClient(ring=ring)
+        results = list(
+            client.pipeline_digests("report", self.digests, self.servers, 3)
+        )
+        self.assertEqual([digest for digest, _ in results], self.digests)
+        for digest, responses in results:
+            self.assertEqual(
+                [server for server, _ in responses], ring.get_servers(digest)
+            )
+        sent = sum(len(msg.get_all("Op-Digest")) for msg in self.sock.sent)
+        self.assertEqual(sent, len(self.digests))
+
+
+class MockStreamSocket(object):
+    """Answers every request sent on the stream connection with an OK
+    response, in order.
+    """
+
+    def __init__(self, *args):
+        self.sent = []
+        self.buffer = b""
+        self.closed = False
+        self.answer = True
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def connect(self, address):
+        self.address = address
+
+    def makefile(self, mode):
+        return self
+
+    def sendall(self, data):
+        msg = email.message_from_bytes(data[4:])
+        self.sent.append(msg)
+        if not self.answer:
+            return
+        response = "Code: 200\nDiag: OK\nPV: 2.1\nThread: %s\nCount: %d\n" % (
+            msg["Thread"],
+            len(msg.get_all("Op-Digest", [])),
+        )
+        response += "WL-Count: 0\n"
+        self.buffer += pyzor.stream.pack(response.encode())
+
+    def read(self, size):
+        if not self.buffer:
+            raise socket.timeout()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class StreamClientTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.servers = [("127.0.0.1", 24441), ("127.0.0.2", 24441)]
+        self.digests = ["%040x" % i for i in range(3)]
+        patch("pyzor.account.sign_msg", return_value="TestSig").start()
+        patch("pyzor.account.hash_key").start()
+        self.sockets = []
+
+        def create_connection(*args):
+            self.sockets.append(MockStreamSocket())
+            return self.sockets[-1]
+
+        self.connect = patch(
+            "pyzor.client.socket.create_connection", side_effect=create_connection
+        ).start()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def test_connection_reused(self):
+        client = pyzor.client.StreamClient()
+        self.assertEqual(client.check(self.digests[0], self.servers[0])["Code"], "200")
+        self.assertEqual(client.check(self.digests[1], self.servers[0])["Code"], "200")
+        self.assertEqual(len(self.sockets), 1)
+        self.assertFalse(self.sockets[0].closed)
+        self.assertEqual(len(self.sockets[0].sent), 2)
+        client.close()
+        self.assertTrue(self.sockets[0].closed)
+
+    def test_pipeline(self):
+        client = pyzor.client.StreamClient(window=2)
+        results = list(
+            client.pipeline_digests("report", self.digests, self.servers, 2)
+        )
+        self.assertEqual([digest for digest, _ in results], self.digests)
+        for digest, responses in results:
+            self.assertEqual([server for server, _ in responses], self.servers)
+        self.assertEqual(results[0][1][0][1]["Count"], "2")
+        self.assertEqual(results[2][1][0][1]["Count"], "1")
+        # One connection to each server.
+        self.assertEqual(len(self.sockets), 2)
+        self.assertEqual([len(sock.sent) for sock in self.sockets], [2, 2])
+
+    def test_large_request(self):
+        client = pyzor.client.StreamClient()
+        digests = ["%040x" % i for i in range(1000)]
+        results = list(
+            client.pipeline_digests("report", digests, self.servers[:1], 1000)
+        )
+        self.assertEqual(results[0][1][0][1]["Count"], "1000")
+        self.assertGreater(len(self.sockets[0].sent[0].as_bytes()), 8192)
+
+    def test_timeout(self):
+        client = pyzor.client.StreamClient()
+        client.check(self.digests[0], self.servers[0])
+        self.sockets[0].answer = False
+        self.assertRaises(
+            pyzor.TimeoutError, client.check, self.digests[0], self.servers[0]
+        )
+        self.assertTrue(self.sockets[0].closed)
+        # A new connection is opened for the next requests.
+        self.assertEqual(client.check(self.digests[0], self.servers[0])["Code"], "200")
+        self.assertEqual(len(self.sockets), 2)
+
+    def test_unix(self):
+        sock = MockStreamSocket()
+        with patch("pyzor.client.socket.socket", return_value=sock) as socket_:
+            client = pyzor.client.StreamClient()
+            client.ping(("/run/pyzord.sock", 0))
+        socket_.assert_called_once_with(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.assertEqual(sock.address, "/run/pyzord.sock")
+        self.assertFalse(self.connect.called)
+
+
+class HashRingTest(unittest.TestCase):
+    servers = [("10.0.0.%d" % i, 24441) for i in range(1, 5)]
+    digests = ["%040x" % (i * 104729) for i in range(2000)]
+
+    def test_owners(self):
+        ring = pyzor.client.HashRing(self.servers)
+        counts = dict((server, 0) for server in self.servers)
+        for digest in self.digests:
+            owners = ring.get_servers(digest)
+            self.assertEqual(len(owners), 1)
+            counts[owners[0]] += 1
+        for count in counts.values():
+            self.assertGreater(count, len(self.digests) / 8)
+
+    def test_replicas(self):
+        ring = pyzor.client.HashRing(self.servers, replicas=3)
+        for digest in self.digests[:100]:
+            owners = ring.get_servers(digest)
+            self.assertEqual(len(owners), 3)
+            self.assertEqual(len(set(owners)), 3)
+
+    def test_replicas_limit(self):
+        ring = pyzor.client.HashRing(self.servers[:2], replicas=3)
+        self.assertEqual(len(ring.get_servers(self.digests[0])), 2)
+
+    def test_weights(self):
+        weights = {self.servers[0]: 3}
+        ring = pyzor.client.HashRing(self.servers, weights=weights)
+        counts = dict((server, 0) for server in self.servers)
+        for digest in self.digests:
+            counts[ring.get_servers(digest)[0]] += 1
+        self.assertGreater(counts[self.servers[0]], counts[self.servers[1]] * 2)
+
+    def test_consistent(self):
+        ring = pyzor.client.HashRing(self.servers)
+        bigger = pyzor.client.HashRing(self.servers + [("10.0.0.5", 24441)])
+        moved = sum(
+            1
+            for digest in self.digests
+            if ring.get_servers(digest) != bigger.get_servers(digest)
+        )
+        # Only the digests taken over by the new server should move.
+        self.assertLess(moved, len(self.digests) / 3)
+        for digest in self.digests:
+            if ring.get_servers(digest) != bigger.get_servers(digest):
+                self.assertEqual(bigger.get_servers(digest), [("10.0.0.5", 24441)])
+
+
 class ClientRunnerTest(unittest.TestCase):
     def setUp(self):
         unittest.TestCase.setUp(self)
@@ -308,6 +636,17 @@ class ClientRunnerTest(unittest.TestCase):
 
         self.check_runner(pyzor.client.ClientRunner, response, results)
 
+    def test_unix(self):
+        self.server = "/run/pyzord.sock", 0
+        response = pyzor.message.Response()
+        response["Diag"] = "OK"
+        response["Code"] = "200"
+        results = [
+            "unix:/run/pyzord.sock\t%s\n" % (response.head_tuple(),),
+        ]
+
+        self.check_runner(pyzor.client.ClientRunner, response, results)
+
     def test_check(self):
         response = pyzor.message.Response()
         response["Diag"] = "OK"
@@ -387,6 +726,9 @@ def suite():
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(ClientTest))
     test_suite.addTest(unittest.makeSuite(BatchClientTest))
+    test_suite.addTest(unittest.makeSuite(PipelinedClientTest))
+    test_suite.addTest(unittest.makeSuite(StreamClientTest))
+    test_suite.addTest(unittest.makeSuite(HashRingTest))
     test_suite.addTest(unittest.makeSuite(ClientRunnerTest))
 
     return test_suite
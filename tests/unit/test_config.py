@@ -14,6 +14,7 @@ except ImportError:
 
 
 import pyzor.config
+import pyzor.usagelog
 
 from tests.util import mock_open
 
@@ -153,6 +154,57 @@ class TestAccessLoad(unittest.TestCase):
         self.assertEqual(result, {"alice": self.all})
 
 
+class TestLimitsLoad(unittest.TestCase):
+    fp = "pyzord.limits"
+
+    def setUp(self):
+        super(TestLimitsLoad, self).setUp()
+        self.data = []
+        real_exists = os.path.exists
+        _exists = lambda fp: True if fp == self.fp else real_exists(fp)
+        patch("pyzor.config.os.path.exists", side_effect=_exists).start()
+
+    def tearDown(self):
+        super(TestLimitsLoad, self).tearDown()
+        patch.stopall()
+
+    def get_limits(self, fp=None):
+        name = "pyzor.config.open"
+        with patch(name, mock_open(read_data="".join(self.data)), create=True):
+            return pyzor.config.load_limits_file(fp or self.fp)
+
+    def test_default(self):
+        self.assertIsNone(self.get_limits("foobar"))
+
+    def test_limits(self):
+        self.data.append("address : all : 100 200\n")
+        self.data.append("address : 192.0.2.1 ::1 : 0\n")
+        self.data.append("user : alice bob : 0.5\n")
+        result = self.get_limits()
+        self.assertEqual(
+            result,
+            {
+                "address": {"all": (100, 200), "192.0.2.1": (0, 1), "::1": (0, 1)},
+                "user": {"alice": (0.5, 1), "bob": (0.5, 1)},
+            },
+        )
+
+    def test_invalid_line(self):
+        self.data.append("host : all : 10\n")
+        self.data.append("user : all : ten\n")
+        self.data.append("user : all : 10 20 30\n")
+        self.data.append("user : all\n")
+        self.data.append("user : anonymous : 10\n")
+        result = self.get_limits()
+        self.assertEqual(result, {"address": {}, "user": {"anonymous": (10, 10)}})
+
+    def test_ignore_comments(self):
+        self.data.append("# user : all : 10\n")
+        self.data.append("user : alice : 10\n")
+        result = self.get_limits()
+        self.assertEqual(result, {"address": {}, "user": {"alice": (10, 10)}})
+
+
 class TestServersLoad(unittest.TestCase):
     fp = "servers"
     public_server = ("public.pyzor.org", 24441)
@@ -198,6 +250,47 @@ class TestServersLoad(unittest.TestCase):
         result = self.get_servers()
         self.assertEqual(result, [self.random_server2])
 
+    def test_server_options(self):
+        self.data.append("%s:%s weight=2\n" % self.random_server1)
+        self.data.append("%s:%s\n" % self.random_server2)
+        result = self.get_servers()
+        self.assertEqual(result, [self.random_server1, self.random_server2])
+
+    def test_unix_server(self):
+        self.data.append("unix:/run/pyzord.sock weight=2\n")
+        self.data.append("%s:%s\n" % self.random_server1)
+        result = self.get_servers()
+        self.assertEqual(result, [("/run/pyzord.sock", 0), self.random_server1])
+
+    def get_ring(self):
+        name = "pyzor.config.open"
+        with patch(name, mock_open(read_data="".join(self.data)), create=True) as m:
+            return pyzor.config.load_server_ring(self.fp)
+
+    def test_no_ring(self):
+        self.data.append("%s:%s\n" % self.random_server1)
+        self.assertIsNone(self.get_ring())
+
+    def test_ring(self):
+        self.data.append("sharding: replicas=2 vnodes=10\n")
+        self.data.append("%s:%s weight=2\n" % self.random_server1)
+        self.data.append("%s:%s\n" % self.random_server2)
+        self.data.append("%s:%s\n" % self.public_server)
+        ring = self.get_ring()
+        self.assertEqual(
+            ring.servers, [self.random_server1, self.random_server2, self.public_server]
+        )
+        self.assertEqual(ring.replicas, 2)
+        self.assertEqual(ring._owners.count(self.random_server1), 20)
+        self.assertEqual(ring._owners.count(self.random_server2), 10)
+
+    def test_ring_invalid_option(self):
+        self.data.append("sharding: replicas=two\n")
+        self.data.append("%s:%s weight=heavy\n" % self.random_server1)
+        ring = self.get_ring()
+        self.assertEqual(ring.replicas, 1)
+        self.assertEqual(ring._owners.count(self.random_server1), 100)
+
 
 class TestLogSetup(unittest.TestCase):
     log_file = "this_is_a_test_log_file"
@@ -242,6 +335,19 @@ class TestLogSetup(unittest.TestCase):
         self.assertEqual(log.handlers[0].level, logging.DEBUG)
         self.assertEqual(log.handlers[1].level, logging.DEBUG)
 
+    def test_logging_usage_stats(self):
+        pyzor.config.setup_logging(
+            "pyzor.test5", self.log_file, False, sample_rate=0.1, stats_interval=60
+        )
+        log = logging.getLogger("pyzor.test5")
+        file_handler, stats_handler = log.handlers[1:]
+        self.addCleanup(stats_handler.close)
+        self.addCleanup(file_handler.close)
+        self.assertEqual(file_handler.filters[0].rate, 0.1)
+        self.assertIsInstance(stats_handler, pyzor.usagelog.UsageStatsHandler)
+        self.assertIs(stats_handler.target, file_handler)
+        self.assertEqual(stats_handler.interval, 60)
+
 
 class TestExpandHomeFiles(unittest.TestCase):
     home = "/home/user/pyzor"
@@ -293,6 +399,7 @@ def suite():
     test_suite.addTest(unittest.makeSuite(TestLogSetup))
     test_suite.addTest(unittest.makeSuite(TestAccessLoad))
     test_suite.addTest(unittest.makeSuite(TestPasswdLoad))
+    test_suite.addTest(unittest.makeSuite(TestLimitsLoad))
     test_suite.addTest(unittest.makeSuite(TestServersLoad))
     return test_suite
 
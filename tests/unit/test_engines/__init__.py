@@ -9,6 +9,9 @@ import unittest
 
 def suite():
     """Gather all the tests from this package in a test suite."""
+    from . import test_batch
+    from . import test_buffer
+    from . import test_cache
     from . import test_gdbm
     from . import test_mysql
     from . import test_redis
@@ -16,6 +19,9 @@ def suite():
 
     test_suite = unittest.TestSuite()
 
+    test_suite.addTest(test_batch.suite())
+    test_suite.addTest(test_buffer.suite())
+    test_suite.addTest(test_cache.suite())
     test_suite.addTest(test_gdbm.suite())
     test_suite.addTest(test_mysql.suite())
     test_suite.addTest(test_redis.suite())
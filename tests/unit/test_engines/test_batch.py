@@ -0,0 +1,118 @@
+"""Test the pyzor.engines.batch module."""
+
+import unittest
+import threading
+
+import pyzor.engines.batch
+import pyzor.engines.common
+
+from tests.unit.test_engines.test_cache import MockEngine
+
+
+class MockBatchEngine(MockEngine):
+    """Record the keys of every get_many call."""
+
+    def __init__(self, records=None, one_step=False):
+        MockEngine.__init__(self, records, one_step)
+        self.batches = []
+        self.error = None
+
+    def get_many(self, keys):
+        self.batches.append(sorted(keys))
+        if self.error is not None:
+            raise self.error
+        return MockEngine.get_many(self, keys)
+
+
+class BatchedEngineTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.engine = MockBatchEngine(
+            {
+                "a": pyzor.engines.common.Record(r_count=1),
+                "b": pyzor.engines.common.Record(r_count=2),
+            }
+        )
+
+    def lookup_all(self, batched, keys):
+        """Look up the keys from concurrent threads, returns the records or
+        the exceptions raised.
+        """
+        results = [None] * len(keys)
+
+        def lookup(i, key):
+            try:
+                results[i] = batched[key]
+            except Exception as e:
+                results[i] = e
+
+        threads = [
+            threading.Thread(target=lookup, args=(i, key)) for i, key in enumerate(keys)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_get(self):
+        batched = pyzor.engines.batch.BatchedEngine(self.engine, 0.001)
+        self.assertEqual(batched["a"].r_count, 1)
+        self.assertRaises(KeyError, batched.__getitem__, "c")
+        self.assertEqual(self.engine.batches, [["a"], ["c"]])
+
+    def test_batch(self):
+        # The batch is only fetched when it's full.
+        batched = pyzor.engines.batch.BatchedEngine(self.engine, 10, 3)
+        results = self.lookup_all(batched, ["a", "a", "b", "c"])
+        self.assertEqual(self.engine.batches, [["a", "b", "c"]])
+        self.assertEqual(results[0].r_count, 1)
+        self.assertEqual(results[1].r_count, 1)
+        self.assertEqual(results[2].r_count, 2)
+        self.assertIsInstance(results[3], KeyError)
+        self.assertEqual(batched.stats(), {"lookups": 4, "batches": 1, "keys": 3})
+
+    def test_copy(self):
+        batched = pyzor.engines.batch.BatchedEngine(self.engine, 10, 2)
+        first, second, _ = self.lookup_all(batched, ["a", "a", "b"])
+        self.assertIsNot(first, second)
+        first.r_increment()
+        self.assertEqual(second.r_count, 1)
+        self.assertEqual(self.engine.records["a"].r_count, 1)
+
+    def test_error(self):
+        self.engine.error = pyzor.engines.common.DatabaseError("unavailable")
+        batched = pyzor.engines.batch.BatchedEngine(self.engine, 10, 2)
+        results = self.lookup_all(batched, ["a", "b"])
+        self.assertEqual(len(self.engine.batches), 1)
+        self.assertTrue(all(result is self.engine.error for result in results))
+
+    def test_new_batch(self):
+        batched = pyzor.engines.batch.BatchedEngine(self.engine, 10, 2)
+        self.lookup_all(batched, ["a", "b"])
+        self.lookup_all(batched, ["b", "c"])
+        self.assertEqual(self.engine.batches, [["a", "b"], ["b", "c"]])
+
+    def test_other_calls(self):
+        batched = pyzor.engines.batch.BatchedEngine(self.engine, 10)
+        self.assertEqual(
+            [record.r_count for record in batched.get_many(["a", "b"])], [1, 2]
+        )
+        batched.report(["a"])
+        batched["c"] = pyzor.engines.common.Record(r_count=3)
+        del batched["b"]
+        self.assertEqual(self.engine.records["a"].r_count, 2)
+        self.assertEqual(self.engine.records["c"].r_count, 3)
+        self.assertNotIn("b", self.engine.records)
+        self.assertEqual(batched.stats()["lookups"], 0)
+
+
+def suite():
+    """Gather all the tests from this module in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(BatchedEngineTest))
+    return test_suite
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+"""Test the pyzor.engines.buffer module."""
+
+import logging
+import unittest
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import pyzor.engines.buffer
+import pyzor.engines.common
+
+from tests.unit.test_engines.test_cache import MockEngine
+
+
+class BufferedEngineTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        logging.getLogger("pyzord").addHandler(logging.NullHandler())
+        self.time = patch("pyzor.engines.buffer.time.time", return_value=1000).start()
+        self.engine = MockEngine({"a": pyzor.engines.common.Record(r_count=1)})
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def get_buffer(self, engine=None, interval=1, max_entries=10):
+        return pyzor.engines.buffer.BufferedEngine(
+            engine or self.engine, interval, max_entries
+        )
+
+    def test_coalesce(self):
+        buffered = self.get_buffer()
+        for _ in range(5):
+            buffered.report(["a", "b"])
+        buffered.whitelist(["b"])
+        self.assertEqual(self.engine.records["a"].r_count, 1)
+        self.assertNotIn("b", self.engine.records)
+        self.time.return_value = 1001
+        buffered.flush()
+        self.assertEqual(self.engine.records["a"].r_count, 6)
+        self.assertEqual(self.engine.records["b"].r_count, 5)
+        self.assertEqual(self.engine.records["b"].wl_count, 1)
+        stats = buffered.stats()
+        self.assertEqual(stats["increments"], 11)
+        self.assertEqual(stats["writes"], 2)
+        self.assertEqual(stats["flushes"], 1)
+        self.assertEqual(stats["coalescing_ratio"], 5.5)
+
+    def test_one_step(self):
+        engine = MockEngine(one_step=True)
+        buffered = self.get_buffer(engine)
+        buffered.report(["a", "b"])
+        buffered.report(["a"])
+        buffered.flush(True)
+        self.assertEqual(engine.records["a"].r_count, 2)
+        self.assertEqual(engine.records["b"].r_count, 1)
+        self.assertEqual(engine.gets, 0)
+
+    def test_interval(self):
+        buffered = self.get_buffer()
+        buffered.report(["a"])
+        buffered.flush()
+        self.assertEqual(self.engine.records["a"].r_count, 1)
+        self.time.return_value = 1001
+        buffered.report(["a"])
+        self.assertEqual(self.engine.records["a"].r_count, 3)
+        self.assertEqual(buffered.stats()["pending"], 0)
+
+    def test_max_entries(self):
+        buffered = self.get_buffer(max_entries=2)
+        buffered.report(["b"])
+        self.assertNotIn("b", self.engine.records)
+        buffered.report(["c"])
+        self.assertEqual(self.engine.records["b"].r_count, 1)
+        self.assertEqual(self.engine.records["c"].r_count, 1)
+
+    def test_read_pending(self):
+        buffered = self.get_buffer()
+        buffered.report(["a", "b"])
+        buffered.whitelist(["b"])
+        self.assertEqual(buffered["a"].r_count, 2)
+        self.assertEqual(buffered["b"].r_count, 1)
+        self.assertEqual(buffered["b"].wl_count, 1)
+        self.assertIsNotNone(buffered["b"].r_entered)
+        self.assertRaises(KeyError, buffered.__getitem__, "c")
+        records = buffered.get_many(["a", "b", "c"])
+        self.assertEqual([r and r.r_count for r in records], [2, 1, None])
+        # The engine record is not changed.
+        self.assertEqual(self.engine.records["a"].r_count, 1)
+
+    def test_read_while_writing(self):
+        reads = []
+
+        class ReadingEngine(MockEngine):
+            def __setitem__(self, key, value):
+                if key == "b":
+                    # "a" is written, but not "b".
+                    reads.append((buffered["a"].r_count, buffered["b"].r_count))
+                MockEngine.__setitem__(self, key, value)
+
+            def whitelist_counts(self, counts):
+                # The reports are written, but not the whitelists.
+                record = buffered["b"]
+                reads.append((record.r_count, record.wl_count))
+                MockEngine.whitelist_counts(self, counts)
+
+        engine = ReadingEngine({"a": pyzor.engines.common.Record(r_count=1)})
+        buffered = self.get_buffer(engine)
+        buffered.report(["a", "b"])
+        buffered.flush(True)
+        engine.handles_one_step = True
+        buffered.report(["b"])
+        buffered.whitelist(["b"])
+        buffered.flush(True)
+        self.assertEqual(reads, [(2, 1), (2, 1)])
+        self.assertEqual(engine.records["b"].r_count, 2)
+        self.assertEqual(engine.records["b"].wl_count, 1)
+
+    def test_partial_error(self):
+        class FailingEngine(MockEngine):
+            def __setitem__(self, key, value):
+                if key == "b":
+                    raise pyzor.engines.common.DatabaseError("unavailable")
+                MockEngine.__setitem__(self, key, value)
+
+        engine = FailingEngine()
+        buffered = self.get_buffer(engine)
+        buffered.report(["a", "b"])
+        buffered.flush(True)
+        # Only the increments that were not written are kept.
+        self.assertEqual(engine.records["a"].r_count, 1)
+        self.assertEqual(buffered["a"].r_count, 1)
+        self.assertEqual(buffered["b"].r_count, 1)
+        self.assertEqual(buffered.stats()["pending"], 1)
+
+    def test_error(self):
+        class FailingEngine(MockEngine):
+            fail = True
+
+            def __setitem__(self, key, value):
+                if self.fail:
+                    raise pyzor.engines.common.DatabaseError("unavailable")
+                MockEngine.__setitem__(self, key, value)
+
+        engine = FailingEngine()
+        buffered = self.get_buffer(engine)
+        buffered.report(["a"])
+        buffered.flush(True)
+        buffered.report(["a"])
+        self.assertEqual(buffered["a"].r_count, 2)
+        engine.fail = False
+        buffered.flush(True)
+        self.assertEqual(engine.records["a"].r_count, 2)
+
+
+def suite():
+    """Gather all the tests from this module in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(BufferedEngineTest))
+    return test_suite
+
+
+if __name__ == "__main__":
+    unittest.main()
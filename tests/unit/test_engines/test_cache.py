@@ -0,0 +1,182 @@
+"""Test the pyzor.engines.cache module."""
+
+import unittest
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import pyzor.engines.cache
+import pyzor.engines.common
+
+
+class MockEngine(pyzor.engines.common.BaseEngine):
+    """A dictionary based engine that counts the calls to the database."""
+
+    def __init__(self, records=None, one_step=False):
+        self.records = records or {}
+        self.handles_one_step = one_step
+        self.gets = 0
+
+    def __getitem__(self, key):
+        self.gets += 1
+        return self.records[key]
+
+    def __setitem__(self, key, value):
+        self.records[key] = value
+
+    def __delitem__(self, key):
+        del self.records[key]
+
+    def report(self, keys):
+        for key in keys:
+            self.records.setdefault(key, pyzor.engines.common.Record()).r_increment()
+
+    def whitelist(self, keys):
+        for key in keys:
+            self.records.setdefault(key, pyzor.engines.common.Record()).wl_increment()
+
+
+class CachedEngineTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.time = patch("pyzor.engines.cache.time.time", return_value=1000).start()
+        self.engine = MockEngine(
+            {
+                "a": pyzor.engines.common.Record(r_count=1, wl_count=2),
+                "b": pyzor.engines.common.Record(3),
+            }
+        )
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def test_hit(self):
+        cache = pyzor.engines.cache.CachedEngine(self.engine, 10)
+        self.assertEqual(cache["a"].r_count, 1)
+        self.assertEqual(cache["a"].wl_count, 2)
+        self.assertEqual(self.engine.gets, 1)
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["entries"], 1)
+
+    def test_copy(self):
+        cache = pyzor.engines.cache.CachedEngine(self.engine, 10)
+        cache["a"].r_increment()
+        self.assertEqual(cache["a"].r_count, 1)
+
+    def test_ttl(self):
+        cache = pyzor.engines.cache.CachedEngine(self.engine, 10, ttl=5)
+        cache["a"]
+        self.time.return_value = 1006
+        cache["a"]
+        self.assertEqual(self.engine.gets, 2)
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_negative(self):
+        cache = pyzor.engines.cache.CachedEngine(self.engine, 10, negative_ttl=5)
+        self.assertRaises(KeyError, cache.__getitem__, "c")
+        self.assertRaises(KeyError, cache.__getitem__, "c")
+        self.assertEqual(self.engine.gets, 1)
+        self.assertEqual(cache.stats()["negative_hits"], 1)
+        self.time.return_value = 1006
+        self.assertRaises(KeyError, cache.__getitem__, "c")
+        self.assertEqual(self.engine.gets, 2)
+
+    def test_negative_disabled(self):
+        cache = pyzor.engines.cache.CachedEngine(self.engine, 10, negative_ttl=0)
+        self.assertRaises(KeyError, cache.__getitem__, "c")
+        self.assertRaises(KeyError, cache.__getitem__, "c")
+        self.assertEqual(self.engine.gets, 2)
+
+    def test_lru(self):
+        cache = pyzor.engines.cache.CachedEngine(self.engine, 2)
+        cache["a"]
+        cache["b"]
+        cache["a"]
+        self.assertRaises(KeyError, cache.__getitem__, "c")
+        # "b" was the least recently used.
+        self.assertEqual(cache.stats()["evictions"], 1)
+        cache["a"]
+        self.assertEqual(self.engine.gets, 3)
+        cache["b"]
+        self.assertEqual(self.engine.gets, 4)
+
+    def test_max_bytes(self):
+        cache = pyzor.engines.cache.CachedEngine(self.engine, max_bytes=1)
+        cache["a"]
+        cache["b"]
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 0)
+        self.assertEqual(stats["evictions"], 2)
+        cache = pyzor.engines.cache.CachedEngine(self.engine, max_bytes=10**6)
+        cache["a"]
+        cache["b"]
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertGreater(cache.stats()["bytes"], 0)
+
+    def test_write_through(self):
+        cache = pyzor.engines.cache.CachedEngine(self.engine, 10)
+        record = cache["a"]
+        record.r_increment()
+        cache["a"] = record
+        self.assertEqual(self.engine.records["a"].r_count, 2)
+        self.assertEqual(cache["a"].r_count, 2)
+        self.assertEqual(self.engine.gets, 1)
+
+    def test_report(self):
+        cache = pyzor.engines.cache.CachedEngine(self.engine, 10)
+        cache["a"]
+        self.assertRaises(KeyError, cache.__getitem__, "c")
+        cache.report(["a", "c"])
+        cache.whitelist(["a"])
+        self.assertEqual(cache["a"].r_count, 2)
+        self.assertEqual(cache["a"].wl_count, 3)
+        self.assertEqual(cache["c"].r_count, 1)
+        self.assertEqual(self.engine.records["c"].r_count, 1)
+        self.assertEqual(self.engine.gets, 2)
+
+    def test_delete(self):
+        cache = pyzor.engines.cache.CachedEngine(self.engine, 10)
+        cache["a"]
+        del cache["a"]
+        self.assertRaises(KeyError, cache.__getitem__, "a")
+
+    def test_get_many(self):
+        cache = pyzor.engines.cache.CachedEngine(self.engine, 10)
+        cache["a"]
+        records = cache.get_many(["a", "b", "c"])
+        self.assertEqual(records[0].r_count, 1)
+        self.assertEqual(records[1].r_count, 3)
+        self.assertIsNone(records[2])
+        # "a" was cached, "b" and "c" were fetched.
+        self.assertEqual(self.engine.gets, 3)
+        self.assertEqual(cache.get_many(["b", "c"])[0].r_count, 3)
+        self.assertEqual(self.engine.gets, 3)
+
+    def test_get_fresh(self):
+        cache = pyzor.engines.cache.CachedEngine(self.engine, 10)
+        cache.get_many(["a", "c"])
+        # Another process updates the database.
+        self.engine.records["a"] = pyzor.engines.common.Record(r_count=5)
+        self.engine.records["c"] = pyzor.engines.common.Record(r_count=1)
+        self.assertEqual(cache["a"].r_count, 1)
+        records = cache.get_fresh(["a", "c"])
+        self.assertEqual([record.r_count for record in records], [5, 1])
+        # The cache is refreshed.
+        self.assertEqual(cache["a"].r_count, 5)
+        self.assertEqual(cache["c"].r_count, 1)
+
+
+def suite():
+    """Gather all the tests from this module in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(CachedEngineTest))
+    return test_suite
+
+
+if __name__ == "__main__":
+    unittest.main()
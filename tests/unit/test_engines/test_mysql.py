@@ -5,8 +5,21 @@ import threading
 
 from datetime import datetime, timedelta
 
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+try:
+    import pymysql
+    import pymysql.cursors
+    import pymysql.connections
+except ImportError:
+    pymysql = None
+
 import pyzor.engines
 import pyzor.engines.mysql
+import pyzor.engines.buffer
 import pyzor.engines.common
 
 
@@ -39,6 +52,11 @@ def make_MockMySQL(result, queries):
         def execute(self, query, args=None):
             queries.append((query, args))
 
+        def executemany(self, query, args):
+            # Each row is a statement sent to the server.
+            for row in args:
+                self.execute(query, row)
+
         def close(self):
             pass
 
@@ -224,6 +242,91 @@ class MySQLTest(unittest.TestCase):
 
         self.assertEqual(self.queries[1], expected)
 
+    def test_report(self):
+        expected = (
+            "INSERT INTO testtable (digest, r_count, wl_count, "
+            "r_entered, r_updated, wl_entered, wl_updated) "
+            "VALUES (%s, %s, 0, NOW(), NOW(), NOW(), NOW()) ON "
+            "DUPLICATE KEY UPDATE r_count=r_count+%s, "
+            "r_updated=NOW()"
+        )
+        handle = self.handler(
+            "testhost,testuser,testpass,testdb,testtable", None, max_age=None
+        )
+        handle.report(["a", "b", "a"])
+        self.assertEqual(
+            self.queries, [(expected, ("a", 2, 2)), (expected, ("b", 1, 1))]
+        )
+
+    def test_buffered(self):
+        handle = self.handler(
+            "testhost,testuser,testpass,testdb,testtable", None, max_age=None
+        )
+        buffered = pyzor.engines.buffer.BufferedEngine(handle, 10, 10)
+        for _ in range(5):
+            buffered.report(["a", "b"])
+            buffered.whitelist(["a"])
+        buffered.flush(True)
+        # A single statement for each digest and count.
+        self.assertEqual(
+            [args for query, args in self.queries],
+            [("a", 5, 5), ("b", 5, 5), ("a", 5, 5)],
+        )
+        self.assertIn("wl_count=wl_count+%s", self.queries[2][0])
+
+
+@unittest.skipIf(pymysql is None, "pymysql is not installed")
+class PyMySQLTest(unittest.TestCase):
+    """Test the MySQLDBHandle class with PyMySQL instead of MySQLdb."""
+
+    handler = pyzor.engines.mysql.MySQLDBHandle
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.real_mysql = pyzor.engines.mysql.MySQLdb
+        pyzor.engines.mysql.MySQLdb = pymysql
+        self.queries = []
+        self.rows = []
+        patch("pymysql.connect", side_effect=self.connect).start()
+        patch.object(pymysql.cursors.SSCursor, "execute", self.execute).start()
+        patch.object(pymysql.cursors.SSCursor, "fetchone", self.fetchone).start()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        pyzor.engines.mysql.MySQLdb = self.real_mysql
+        patch.stopall()
+
+    @staticmethod
+    def connect(*args, **kwargs):
+        # A real PyMySQL connection that never connects to a server.
+        db = pymysql.connections.Connection(defer_connect=True)
+        db.autocommit = lambda value: None
+        return db
+
+    def execute(self, query, args=None):
+        self.queries.append(query)
+
+    def fetchone(self):
+        if self.rows:
+            return self.rows.pop(0)
+        return None
+
+    def test_iter(self):
+        self.rows = [("a",), ("b",)]
+        handle = self.handler(
+            "testhost,testuser,testpass,testdb,testtable", None, max_age=None
+        )
+        self.assertEqual(list(handle), ["a", "b"])
+        self.assertEqual(self.queries, ["SELECT digest FROM testtable"])
+
+    def test_items(self):
+        self.rows = [("a", 1, 2, None, None, None, None)]
+        handle = self.handler(
+            "testhost,testuser,testpass,testdb,testtable", None, max_age=None
+        )
+        ((digest, record),) = handle.items()
+        self.assertEqual((digest, record.r_count, record.wl_count), ("a", 1, 2))
+
 
 class ThreadedMySQLTest(MySQLTest):
     """Test the GdbmDBHandle class"""
@@ -241,6 +344,7 @@ def suite():
     """Gather all the tests from this module in a test suite."""
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(MySQLTest))
+    test_suite.addTest(unittest.makeSuite(PyMySQLTest))
     test_suite.addTest(unittest.makeSuite(ThreadedMySQLTest))
     test_suite.addTest(unittest.makeSuite(ProcessesMySQLTest))
     return test_suite
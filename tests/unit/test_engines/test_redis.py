@@ -1,5 +1,6 @@
 """Test the pyzor.engines.gdbm_ module."""
 import time
+import asyncio
 import logging
 import unittest
 
@@ -229,12 +230,82 @@ class RedisTest(unittest.TestCase):
         expected = ("pyzord.digest_v1.%s" % digest,)
         self.mredis.StrictRedis.return_value.delete.assert_called_with(*expected)
 
+    def test_report_repeated(self):
+        digest1 = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+        digest2 = "da39a3ee5e6b4b0d3255bfef95601890afd80709"
+
+        db = pyzor.engines.redis_.RedisDBHandle(",,,", None)
+        db.report([digest1, digest2, digest1])
+
+        pipe = self.mredis.StrictRedis.return_value.pipeline.return_value
+        calls = [c[0] for c in pipe.hincrby.call_args_list]
+        expected = [
+            ("pyzord.digest_v1.%s" % digest1, "r_count", 2),
+            ("pyzord.digest_v1.%s" % digest2, "r_count", 1),
+        ]
+        self.assertEqual(calls, expected)
+        self.assertEqual(pipe.execute.call_count, 1)
+
+
+@unittest.skipIf(
+    not pyzor.engines.redis_._has_redis_asyncio, "redis.asyncio is not available"
+)
+class AsyncRedisTest(unittest.TestCase):
+    max_age = 60 * 60
+    digest = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.loop = asyncio.new_event_loop()
+        self.db = pyzor.engines.redis_.AsyncRedisDBHandle(
+            ",,,", None, max_age=self.max_age
+        )
+        self.db.db = Mock()
+        self.pipe = self.db.db.pipeline.return_value
+
+        async def execute():
+            return []
+
+        self.pipe.execute.side_effect = execute
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.loop.close()
+
+    def test_get(self):
+        async def hgetall(key):
+            return {b"r_count": b"24", b"wl_count": b"42"}
+
+        self.db.db.hgetall.side_effect = hgetall
+        record = self.loop.run_until_complete(self.db.get(self.digest))
+        self.db.db.hgetall.assert_called_with("pyzord.digest_v1.%s" % self.digest)
+        self.assertEqual((record.r_count, record.wl_count), (24, 42))
+
+    def test_report(self):
+        self.loop.run_until_complete(self.db.report([self.digest]))
+        real_key = "pyzord.digest_v1.%s" % self.digest
+        self.pipe.hincrby.assert_called_with(real_key, "r_count", 1)
+        self.pipe.expire.assert_called_with(real_key, self.max_age)
+        self.assertEqual(self.pipe.execute.call_count, 1)
+
+    def test_error(self):
+        async def hgetall(key):
+            raise pyzor.engines.redis_.redis.exceptions.ConnectionError()
+
+        self.db.db.hgetall.side_effect = hgetall
+        self.assertRaises(
+            pyzor.engines.common.DatabaseError,
+            self.loop.run_until_complete,
+            self.db.get(self.digest),
+        )
+
 
 def suite():
     """Gather all the tests from this module in a test suite."""
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(EncodingRedisTest))
     test_suite.addTest(unittest.makeSuite(RedisTest))
+    test_suite.addTest(unittest.makeSuite(AsyncRedisTest))
     return test_suite
 
 
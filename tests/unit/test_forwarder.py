@@ -9,6 +9,7 @@ try:
 except ImportError:
     from mock import call, Mock
 
+import pyzor.client
 import pyzor.forwarder
 
 
@@ -67,6 +68,35 @@ class ForwarderTest(unittest.TestCase):
             [call(digest, servlist[0]), call(digest, servlist[1])]
         )
 
+    def test_bulk(self):
+        client = Mock(spec=pyzor.client.StreamClient)
+        client.pipeline_digests.side_effect = lambda op, digests, servers, size: [
+            (digest, [(server, pyzor.TimeoutError()) for server in servers])
+            for digest in digests
+        ]
+        servlist = [("test1.example.com", 24441)]
+        forwarder = pyzor.forwarder.Forwarder(client, servlist)
+        forwarder.log = Mock()
+        forwarder.queue_forward_request("a")
+        forwarder.queue_forward_request("b", whitelist=True)
+        forwarder.queue_forward_request("c")
+
+        t = threading.Thread(target=forwarder._forward_loop)
+        t.start()
+        time.sleep(1)
+        forwarder.stop_forwarding()
+        t.join(5)
+
+        self.assertEqual(
+            client.pipeline_digests.call_args_list,
+            [
+                call("report", ["a", "c"], servlist, forwarder.batch_size),
+                call("whitelist", ["b"], servlist, forwarder.batch_size),
+            ],
+        )
+        self.assertEqual(forwarder.log.warn.call_count, 3)
+        self.assertFalse(client.report.called)
+
 
 def suite():
     """Gather all the tests from this module in a test suite."""
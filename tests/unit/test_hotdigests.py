@@ -0,0 +1,150 @@
+"""Test the pyzor.hotdigests module
+"""
+
+import os
+import random
+import shutil
+import logging
+import tempfile
+import unittest
+import collections
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+import pyzor.hotdigests
+import pyzor.engines.common
+
+
+class HotDigestsTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        logging.getLogger("pyzord").addHandler(logging.NullHandler())
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, "hot-digests")
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def test_count(self):
+        hot = pyzor.hotdigests.HotDigests(10)
+        hot.add(["a", "b"])
+        hot.add(["a"])
+        self.assertEqual(hot.top(), [("a", 2, 0), ("b", 1, 0)])
+        self.assertEqual(hot.top(1), [("a", 2, 0)])
+        self.assertEqual(hot.stats(), {"digests": 2, "requests": 3, "replaced": 0})
+
+    def test_replace(self):
+        hot = pyzor.hotdigests.HotDigests(2)
+        hot.add(["a", "a", "a", "b", "c"])
+        # The digest with the lowest count is replaced.
+        self.assertEqual(hot.top(), [("a", 3, 0), ("c", 2, 1)])
+        hot.add(["b"])
+        self.assertEqual(hot.top(), [("a", 3, 0), ("b", 3, 2)])
+        self.assertEqual(hot.stats()["replaced"], 2)
+
+    def test_bounds(self):
+        rand = random.Random(42)
+        hot = pyzor.hotdigests.HotDigests(20)
+        digests = ["d%d" % min(int(rand.paretovariate(1.2)), 200) for _ in range(5000)]
+        for digest in digests:
+            hot.add([digest])
+        counts = collections.Counter(digests)
+        top = hot.top()
+        self.assertEqual(len(top), 20)
+        # The count of every digest is overestimated by at most its error.
+        for digest, count, error in top:
+            self.assertTrue(count - error <= counts[digest] <= count)
+        # The digests that make up more than 1/capacity of the requests are
+        # always counted.
+        frequent = [d for d, c in counts.items() if c > len(digests) / 20]
+        self.assertTrue(frequent)
+        self.assertTrue(set(frequent) <= set(d for d, _, _ in top))
+        # The heap is kept bounded.
+        self.assertTrue(len(hot._heap) <= 4 * hot.capacity)
+
+    def test_summary(self):
+        hot = pyzor.hotdigests.HotDigests(10)
+        hot.shown = 1
+        hot.add(["a", "a", "b"])
+        self.assertEqual(hot.summary(), ['pyzord_hot_digest_requests{digest="a"} 2'])
+
+    def test_save(self):
+        hot = pyzor.hotdigests.HotDigests(10, self.fn)
+        hot.add(["a", "b", "b"])
+        hot.save()
+        with open(self.fn) as hotf:
+            self.assertEqual(hotf.read(), "b 2\na 1\n")
+        self.assertEqual(os.listdir(self.tmpdir), ["hot-digests"])
+        self.assertEqual(pyzor.hotdigests.HotDigests(10, self.fn).load(), ["b", "a"])
+
+    def test_save_workers(self):
+        for index, digests in enumerate((["a", "b", "b"], ["a", "a", "c"])):
+            hot = pyzor.hotdigests.HotDigests(10, self.fn)
+            hot.set_worker(index)
+            hot.add(digests)
+            hot.save()
+        self.assertEqual(
+            sorted(os.listdir(self.tmpdir)), ["hot-digests.0", "hot-digests.1"]
+        )
+        # The counts of all the workers are added up.
+        self.assertEqual(
+            pyzor.hotdigests.HotDigests(10, self.fn).load(), ["a", "b", "c"]
+        )
+        self.assertEqual(pyzor.hotdigests.HotDigests(2, self.fn).load(), ["a", "b"])
+
+    def test_load_merged(self):
+        with open(self.fn, "w") as hotf:
+            hotf.write("a 1\nb 2\n")
+        with open(self.fn + ".0", "w") as hotf:
+            hotf.write("a 2\n")
+        with open(self.fn + ".old", "w") as hotf:
+            hotf.write("c 10\n")
+        self.assertEqual(pyzor.hotdigests.HotDigests(10, self.fn).load(), ["a", "b"])
+
+    def test_save_empty(self):
+        with open(self.fn, "w") as hotf:
+            hotf.write("a 1\n")
+        pyzor.hotdigests.HotDigests(10, self.fn).save()
+        with open(self.fn) as hotf:
+            self.assertEqual(hotf.read(), "a 1\n")
+
+    def test_load_missing(self):
+        self.assertEqual(pyzor.hotdigests.HotDigests(10, self.fn).load(), [])
+        self.assertEqual(pyzor.hotdigests.HotDigests(10).load(), [])
+
+    def test_prewarm(self):
+        with open(self.fn, "w") as hotf:
+            hotf.write("a 3\nb 2\nc 1\n")
+        hot = pyzor.hotdigests.HotDigests(10, self.fn)
+        hot.prewarm_batch = 2
+        database = Mock()
+        self.assertEqual(hot.prewarm(database), 3)
+        self.assertEqual(
+            [call[0][0] for call in database.get_many.call_args_list],
+            [["a", "b"], ["c"]],
+        )
+
+    def test_prewarm_error(self):
+        with open(self.fn, "w") as hotf:
+            hotf.write("a 3\nb 2\nc 1\n")
+        hot = pyzor.hotdigests.HotDigests(10, self.fn)
+        hot.prewarm_batch = 2
+        database = Mock()
+        database.get_many.side_effect = pyzor.engines.common.DatabaseError()
+        self.assertEqual(hot.prewarm(database), 0)
+        self.assertEqual(database.get_many.call_count, 1)
+
+
+def suite():
+    """Gather all the tests from this module in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(HotDigestsTest))
+    return test_suite
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,235 @@
+"""Test the pyzor.index module"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+import pyzor.index
+import pyzor.config
+
+
+class DigestSetTest(unittest.TestCase):
+    digests = [
+        "2aedaac999d71421c9ee49b9d81f627a7bc570aa",
+        "da39a3ee5e6b4b0d3255bfef95601890afd80709",
+        "975422c090e7a43ab7c9bf0065d5b661259e6d74",
+    ]
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.fp = os.path.join(self.tmpdir, "whitelist")
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def test_create(self):
+        index = pyzor.index.DigestSet.create(self.fp, self.digests)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(list(index), sorted(self.digests))
+        for digest in self.digests:
+            self.assertIn(digest, index)
+        self.assertNotIn("0" * 40, index)
+        self.assertNotIn("invalid", index)
+        index.close()
+
+    def test_create_empty(self):
+        index = pyzor.index.DigestSet.create(self.fp)
+        self.assertEqual(len(index), 0)
+        self.assertNotIn(self.digests[0], index)
+        index.close()
+
+    def test_invalid_digest(self):
+        index = pyzor.index.DigestSet.create(self.fp, self.digests + ["invalid"])
+        self.assertEqual(len(index), 3)
+        index.close()
+
+    def test_add(self):
+        index = pyzor.index.DigestSet.create(self.fp, self.digests[:1])
+        index.add(self.digests[1:] + self.digests[:1])
+        self.assertEqual(list(index), sorted(self.digests))
+        index.close()
+
+    def test_remove(self):
+        index = pyzor.index.DigestSet.create(self.fp, self.digests)
+        index.remove(self.digests[1:2] + ["0" * 40])
+        self.assertEqual(list(index), sorted(self.digests[:1] + self.digests[2:]))
+        self.assertNotIn(self.digests[1], index)
+        index.close()
+
+    def test_many(self):
+        digests = ["%040x" % (i * 7919) for i in range(1000)]
+        index = pyzor.index.DigestSet.create(self.fp, digests[::2])
+        index.add(digests[1::2])
+        index.remove(digests[:10])
+        self.assertEqual(list(index), sorted(digests[10:]))
+        for digest in digests[10:]:
+            self.assertIn(digest, index)
+        for digest in digests[:10]:
+            self.assertNotIn(digest, index)
+        index.close()
+
+    def test_not_index(self):
+        with open(self.fp, "w") as whitelistf:
+            whitelistf.write("\n".join(self.digests))
+        self.assertFalse(pyzor.index.is_index(self.fp))
+        self.assertRaises(ValueError, pyzor.index.DigestSet, self.fp)
+
+    def test_load_local_whitelist(self):
+        with open(self.fp, "w") as whitelistf:
+            whitelistf.write("\n".join(self.digests))
+        whitelist = pyzor.config.load_local_whitelist(self.fp)
+        self.assertEqual(whitelist, set(self.digests))
+
+        pyzor.index.DigestSet.create(self.fp, whitelist).close()
+        self.assertTrue(pyzor.index.is_index(self.fp))
+        whitelist = pyzor.config.load_local_whitelist(self.fp)
+        self.assertIsInstance(whitelist, pyzor.index.DigestSet)
+        self.assertEqual(set(whitelist), set(self.digests))
+        whitelist.close()
+
+
+class DigestSnapshotTest(unittest.TestCase):
+    records = {
+        "2aedaac999d71421c9ee49b9d81f627a7bc570aa": (10, 0),
+        "da39a3ee5e6b4b0d3255bfef95601890afd80709": (0, 3),
+        "975422c090e7a43ab7c9bf0065d5b661259e6d74": (2, 1),
+    }
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.fp = os.path.join(self.tmpdir, "snapshot")
+        self.delta_fp = os.path.join(self.tmpdir, "delta")
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def test_create(self):
+        snapshot = pyzor.index.DigestSnapshot.create(
+            self.fp, self.records.items(), created=1000
+        )
+        self.assertEqual(snapshot.created, 1000)
+        for digest, counts in self.records.items():
+            self.assertEqual(snapshot.get(digest), counts)
+        self.assertIsNone(snapshot.get("0" * 40))
+        snapshot.close()
+
+    def test_create_runs(self):
+        records = [("%040x" % (i * 7919 % 1000), (i, 0)) for i in range(2500)]
+        snapshot = pyzor.index.DigestSnapshot.create(self.fp, records, run_size=100)
+        expected = dict(records)
+        self.assertEqual(len(snapshot), len(expected))
+        self.assertEqual(list(snapshot), sorted(expected))
+        for digest, counts in expected.items():
+            self.assertEqual(snapshot.get(digest), counts)
+        snapshot.close()
+
+    def test_encode_record(self):
+        record = Mock(r_count=2**40, wl_count=-1)
+        self.assertEqual(
+            pyzor.index.DigestSnapshot.encode_record(record), (2**32 - 1, 0)
+        )
+
+    def test_kind(self):
+        pyzor.index.DigestSnapshot.create(self.fp, self.records.items()).close()
+        self.assertRaises(ValueError, pyzor.index.DigestSet, self.fp)
+        self.assertRaises(ValueError, pyzor.index.DigestSnapshotDelta, self.fp)
+
+    def test_apply_delta(self):
+        snapshot = pyzor.index.DigestSnapshot.create(
+            self.fp, self.records.items(), created=1000
+        )
+        new = "0" * 40
+        changed = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+        pyzor.index.DigestSnapshotDelta.create(
+            self.delta_fp, [(changed, (11, 0)), (new, (1, 0))], created=2000, base=1000
+        ).close()
+        delta = pyzor.index.DigestSnapshotDelta(self.delta_fp)
+        self.assertEqual(delta.base, 1000)
+        self.assertEqual(len(delta), 2)
+        snapshot.apply_delta(delta)
+        self.assertEqual(snapshot.created, 2000)
+        self.assertEqual(len(snapshot), 4)
+        self.assertEqual(snapshot.get(changed), (11, 0))
+        self.assertEqual(snapshot.get(new), (1, 0))
+        self.assertEqual(
+            snapshot.get("975422c090e7a43ab7c9bf0065d5b661259e6d74"), (2, 1)
+        )
+        self.assertRaises(ValueError, snapshot.apply_delta, delta)
+        delta.close()
+        snapshot.close()
+
+    def test_apply_delta_removed(self):
+        snapshot = pyzor.index.DigestSnapshot.create(
+            self.fp, self.records.items(), created=1000
+        )
+        # The record was removed from the database after the snapshot.
+        removed = "da39a3ee5e6b4b0d3255bfef95601890afd80709"
+        changed = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+        delta = pyzor.index.DigestSnapshotDelta.create(
+            self.delta_fp,
+            [(changed, (11, 0))],
+            created=2000,
+            removed=[removed],
+            base=1000,
+        )
+        self.assertEqual(delta.get(removed), (0, 0, True))
+        snapshot.apply_delta(delta)
+        self.assertEqual(len(snapshot), 2)
+        self.assertIsNone(snapshot.get(removed))
+        self.assertEqual(snapshot.get(changed), (11, 0))
+        delta.close()
+        snapshot.close()
+
+    def test_apply_delta_wrong_base(self):
+        snapshot = pyzor.index.DigestSnapshot.create(
+            self.fp, self.records.items(), created=1000
+        )
+        changed = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+        # The delta since the snapshot created at 1500 was missed.
+        delta = pyzor.index.DigestSnapshotDelta.create(
+            self.delta_fp, [(changed, (11, 0))], created=2000, base=1500
+        )
+        self.assertRaises(ValueError, snapshot.apply_delta, delta)
+        self.assertEqual(snapshot.created, 1000)
+        self.assertEqual(snapshot.get(changed), (10, 0))
+        delta.close()
+        snapshot.close()
+
+    def test_position(self):
+        snapshot = pyzor.index.DigestSnapshot.create(self.fp, self.records.items())
+        self.assertEqual([snapshot.position(digest) for digest in snapshot], [0, 1, 2])
+        self.assertIsNone(snapshot.position("0" * 40))
+        self.assertIsNone(snapshot.position("invalid"))
+        snapshot.close()
+
+    def test_load_snapshot(self):
+        self.assertIsNone(pyzor.config.load_snapshot(self.fp))
+        with open(self.fp, "w") as snapshotf:
+            snapshotf.write("invalid")
+        self.assertIsNone(pyzor.config.load_snapshot(self.fp))
+        pyzor.index.DigestSnapshot.create(self.fp, self.records.items()).close()
+        snapshot = pyzor.config.load_snapshot(self.fp)
+        self.assertEqual(len(snapshot), 3)
+        snapshot.close()
+
+
+def suite():
+    """Gather all the tests from this module in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(DigestSetTest))
+    test_suite.addTest(unittest.makeSuite(DigestSnapshotTest))
+    return test_suite
+
+
+if __name__ == "__main__":
+    unittest.main()
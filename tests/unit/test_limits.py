@@ -0,0 +1,91 @@
+"""Test the pyzor.limits module
+"""
+
+import unittest
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import pyzor.limits
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst(self):
+        bucket = pyzor.limits.TokenBucket(1, 3, 100.0)
+        self.assertEqual(
+            [bucket.consume(100.0) for _ in range(4)], [True] * 3 + [False]
+        )
+
+    def test_refill(self):
+        bucket = pyzor.limits.TokenBucket(2, 2, 100.0)
+        bucket.consume(100.0)
+        bucket.consume(100.0)
+        self.assertFalse(bucket.consume(100.25))
+        self.assertTrue(bucket.consume(100.5))
+        self.assertFalse(bucket.consume(100.5))
+
+    def test_refill_max(self):
+        bucket = pyzor.limits.TokenBucket(10, 2, 100.0)
+        bucket.consume(100.0)
+        results = [bucket.consume(200.0) for _ in range(3)]
+        self.assertEqual(results, [True, True, False])
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.now = 100.0
+        patch("pyzor.limits.time.monotonic", side_effect=lambda: self.now).start()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def allowed(self, allow, name, count):
+        return sum(1 for _ in range(count) if allow(name))
+
+    def test_address(self):
+        limiter = pyzor.limits.RateLimiter(
+            {"address": {"all": (1, 2), "192.0.2.1": (1, 5), "192.0.2.2": (0, 1)}}
+        )
+        self.assertEqual(self.allowed(limiter.allow_address, "192.0.2.1", 10), 5)
+        self.assertEqual(self.allowed(limiter.allow_address, "192.0.2.2", 10), 10)
+        self.assertEqual(self.allowed(limiter.allow_address, "192.0.2.3", 10), 2)
+        # Each address has its own bucket.
+        self.assertEqual(self.allowed(limiter.allow_address, "192.0.2.4", 10), 2)
+        self.now += 1
+        self.assertEqual(self.allowed(limiter.allow_address, "192.0.2.3", 10), 1)
+
+    def test_mapped_address(self):
+        limiter = pyzor.limits.RateLimiter({"address": {"192.0.2.1": (1, 1)}})
+        self.assertTrue(limiter.allow_address("::ffff:192.0.2.1"))
+        self.assertFalse(limiter.allow_address("192.0.2.1"))
+
+    def test_user(self):
+        limiter = pyzor.limits.RateLimiter({"user": {"anonymous": (1, 3)}})
+        self.assertEqual(self.allowed(limiter.allow_user, "anonymous", 10), 3)
+        self.assertEqual(self.allowed(limiter.allow_user, "alice", 10), 10)
+        self.assertEqual(self.allowed(limiter.allow_address, "192.0.2.1", 10), 10)
+
+    def test_max_buckets(self):
+        limiter = pyzor.limits.RateLimiter({"address": {"all": (1, 1)}}, 2)
+        for address in ("192.0.2.1", "192.0.2.2", "192.0.2.3"):
+            self.assertTrue(limiter.allow_address(address))
+        self.assertEqual(limiter.stats(), {"addresses": 2, "users": 0})
+        # The least recently used bucket was discarded.
+        self.assertTrue(limiter.allow_address("192.0.2.1"))
+        self.assertFalse(limiter.allow_address("192.0.2.3"))
+
+
+def suite():
+    """Gather all the tests from this module in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(TokenBucketTest))
+    test_suite.addTest(unittest.makeSuite(RateLimiterTest))
+    return test_suite
+
+
+if __name__ == "__main__":
+    unittest.main()
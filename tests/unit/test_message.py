@@ -0,0 +1,112 @@
+"""Test the pyzor.message module"""
+
+import time
+import email
+import unittest
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import pyzor
+import pyzor.account
+import pyzor.message
+
+
+class HeadersTest(unittest.TestCase):
+    packets = [
+        b"Op: check\nOp-Digest: a\nOp-Digest: b\nThread: 1234\nPV: 2.1\n\n",
+        b"Op: check\r\nThread: 1234 \r\n\r\n",
+        b"Long: a\n b\n\tc\nThread: 1\n\n",
+        b" continuation\nOp: ping\nno header line\nOp: report\n",
+        b"From someone\nOp: ping\n:no name\nFrom the body\n\nbody\r\n",
+        b"Op: ch\xe9ck\nThread: \xff\n\n",
+        b"",
+    ]
+
+    def test_parse(self):
+        headers = pyzor.message.Headers.parse(
+            b"Op: check\nOp-Digest: a\nop-digest: b\nThread: 1234\n\n"
+        )
+        self.assertEqual(headers["Op"], "check")
+        self.assertEqual(headers["THREAD"], "1234")
+        self.assertEqual(headers.get_all("Op-Digest"), ["a", "b"])
+        self.assertIsNone(headers["User"])
+        self.assertIsNone(headers.get_all("Sig"))
+        self.assertNotIn("PV", headers)
+
+    def test_same_as_email(self):
+        for packet in self.packets:
+            expected = email.message_from_bytes(packet)
+            headers = pyzor.message.Headers.parse(packet)
+            self.assertEqual(headers.as_string(), expected.as_string())
+            self.assertEqual(len(headers), len(expected))
+            for name in ("Op", "Op-Digest", "Thread", "Long"):
+                if expected[name] is None or isinstance(expected[name], str):
+                    self.assertEqual(headers.get_all(name), expected.get_all(name))
+
+    def test_response(self):
+        values = ["200", "x" * 100, "Bad request: \xe9", None, "a\n b"]
+        expected = email.message.Message()
+        headers = pyzor.message.Headers()
+        for value in values:
+            expected["Diag"] = value
+            headers["Diag"] = value
+        self.assertEqual(headers.as_string(), expected.as_string())
+
+    def test_template(self):
+        headers = pyzor.message.Headers(
+            [("Code", "200"), ("Diag", "100% OK"), ("Count", None)]
+        )
+        self.assertEqual(headers.as_string(), "Code: 200\nDiag: 100% OK\nCount: \n\n")
+        names = ("Code", "Diag", "Count")
+        self.assertEqual(
+            pyzor.message.Headers._templates[names], "Code: %s\nDiag: %s\nCount: %s\n\n"
+        )
+        # The values that need encoding don't use the template.
+        headers.replace_header("Diag", "a\n b")
+        self.assertEqual(headers.as_string(), "Code: 200\nDiag: a\n b\nCount: \n\n")
+
+    def test_template_limit(self):
+        with patch.object(pyzor.message.Headers, "_templates", {}):
+            with patch.object(pyzor.message.Headers, "max_templates", 1):
+                for name in ("A", "B"):
+                    headers = pyzor.message.Headers([(name, "1")])
+                    self.assertEqual(headers.as_string(), "%s: 1\n\n" % name)
+                self.assertEqual(list(pyzor.message.Headers._templates), [("A",)])
+
+    def test_replace_header(self):
+        headers = pyzor.message.Headers()
+        headers["Code"] = "200"
+        headers["Diag"] = "OK"
+        headers.replace_header("code", "500")
+        self.assertEqual(headers.as_string(), "Code: 500\nDiag: OK\n\n")
+        self.assertRaises(KeyError, headers.replace_header, "Thread", "1")
+
+    def test_delete(self):
+        headers = pyzor.message.Headers.parse(b"Op: a\nSig: b\nsig: c\nPV: 2.1\n")
+        del headers["Sig"]
+        self.assertEqual(headers.as_string(), "Op: a\nPV: 2.1\n\n")
+
+    def test_verify_signature(self):
+        user_key = "testkey"
+        msg = pyzor.message.PingRequest()
+        msg["User"] = "testuser"
+        msg["Time"] = str(int(time.time()))
+        msg.init_for_sending()
+        hashed_key = pyzor.account.hash_key(user_key, "testuser")
+        msg["Sig"] = pyzor.account.sign_msg(hashed_key, int(msg["Time"]), msg)
+        headers = pyzor.message.Headers.parse(msg.as_string().encode("utf8"))
+        pyzor.account.verify_signature(headers, user_key)
+
+
+def suite():
+    """Gather all the tests from this module in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(HeadersTest))
+    return test_suite
+
+
+if __name__ == "__main__":
+    unittest.main()
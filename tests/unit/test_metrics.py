@@ -0,0 +1,366 @@
+"""Test the pyzor.metrics module"""
+
+import os
+import time
+import signal
+import socket
+import logging
+import threading
+import unittest
+
+try:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, HTTPError
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+import pyzor.metrics
+import pyzor.usagelog
+import pyzor.forwarder
+import pyzor.engines.batch
+import pyzor.engines.cache
+import pyzor.engines.buffer
+import pyzor.engines.common
+
+from tests.unit.test_engines.test_cache import MockEngine
+
+
+class MetricsTest(unittest.TestCase):
+    def test_requests(self):
+        metrics = pyzor.metrics.Metrics()
+        metrics.request_started()
+        metrics.request_started()
+        metrics.request_finished("check", "200", 0.002)
+        metrics.request_finished("nonexistent", "999", 0.2)
+        text = metrics.render()
+        self.assertIn('pyzord_requests_total{op="check",code="200"} 1\n', text)
+        self.assertIn('pyzord_requests_total{op="other",code="other"} 1\n', text)
+        self.assertIn("pyzord_requests_in_flight 0\n", text)
+        self.assertIn("# TYPE pyzord_request_duration_seconds histogram\n", text)
+        self.assertIn(
+            'pyzord_request_duration_seconds_bucket{op="check",le="0.001"} 0\n', text
+        )
+        self.assertIn(
+            'pyzord_request_duration_seconds_bucket{op="check",le="0.0025"} 1\n', text
+        )
+        self.assertIn(
+            'pyzord_request_duration_seconds_bucket{op="check",le="+Inf"} 1\n', text
+        )
+        self.assertIn('pyzord_request_duration_seconds_sum{op="check"} 0.002\n', text)
+        self.assertIn('pyzord_request_duration_seconds_count{op="check"} 1\n', text)
+        # Only the operations that were requested are included.
+        self.assertNotIn('op="ping"', text)
+
+    def test_in_flight(self):
+        metrics = pyzor.metrics.Metrics()
+        metrics.request_started()
+        self.assertIn("pyzord_requests_in_flight 1\n", metrics.render())
+
+    def test_engine_calls(self):
+        metrics = pyzor.metrics.Metrics()
+        metrics.engine_call("get", 0.0003)
+        metrics.engine_call("report", 0.01, error=True)
+        text = metrics.render()
+        self.assertIn('pyzord_engine_call_duration_seconds_count{call="get"} 1\n', text)
+        self.assertIn('pyzord_engine_errors_total{call="report"} 1\n', text)
+        self.assertNotIn('pyzord_engine_errors_total{call="get"}', text)
+
+    def test_phases(self):
+        metrics = pyzor.metrics.Metrics()
+        metrics.request_phases({"parse": 0.00002, "engine": 0.003})
+        metrics.request_phases({"parse": 0.00003, "response": 0.0001})
+        text = metrics.render()
+        self.assertIn(
+            'pyzord_request_phase_duration_seconds_count{phase="parse"} 2\n', text
+        )
+        self.assertIn(
+            'pyzord_request_phase_duration_seconds_bucket{phase="engine",le="0.005"} 1\n',
+            text,
+        )
+        self.assertNotIn('{phase="signature"', text)
+        # The phases are left out of the summary.
+        self.assertFalse([line for line in metrics.summary() if "phase" in line])
+
+    def test_gauges(self):
+        metrics = pyzor.metrics.Metrics()
+        metrics.set_gauges({"cache_entries": 12, "nonexistent": 1})
+        text = metrics.render()
+        self.assertIn("# TYPE pyzord_cache_entries gauge\n", text)
+        self.assertIn("pyzord_cache_entries 12\n", text)
+        self.assertIn("pyzord_pool_dropped_total 0\n", text)
+
+    def test_summary(self):
+        metrics = pyzor.metrics.Metrics()
+        for _ in range(10):
+            metrics.request_started()
+            metrics.request_finished("check", "200", 0.002)
+        lines = metrics.summary()
+        self.assertIn('pyzord_requests_total{op="check",code="200"} 10', lines)
+        self.assertIn(
+            'pyzord_request_duration_seconds{op="check",quantile="0.5"} 0.00175',
+            lines,
+        )
+        self.assertFalse([line for line in lines if "_bucket" in line])
+        self.assertFalse([line for line in lines if line.startswith("#")])
+        self.assertFalse([line for line in lines if "cache_" in line])
+        metrics.set_gauges({"cache_entries": 3})
+        self.assertIn("pyzord_cache_entries 3", metrics.summary())
+
+    def test_quantile(self):
+        counts = [0] * (len(pyzor.metrics.BUCKETS) + 1)
+        self.assertEqual(pyzor.metrics.quantile(counts, 0.5), 0.0)
+        counts[0] = 2
+        counts[-1] = 2
+        self.assertEqual(pyzor.metrics.quantile(counts, 0.25), 0.00005)
+        self.assertEqual(pyzor.metrics.quantile(counts, 0.99), 5.0)
+
+    def test_workers(self):
+        metrics = pyzor.metrics.Metrics(2)
+        metrics.set_worker(1)
+        metrics.request_started()
+        metrics.request_finished("ping", "200", 0.001)
+        metrics.set_worker(0)
+        metrics.request_started()
+        metrics.request_finished("ping", "200", 0.001)
+        metrics.request_started()
+        metrics.request_finished("check", "200", 0.001)
+        text = metrics.render()
+        self.assertIn('pyzord_requests_total{op="ping",code="200"} 2\n', text)
+        self.assertIn('pyzord_worker_requests_total{worker="0"} 2\n', text)
+        self.assertIn('pyzord_worker_requests_total{worker="1"} 1\n', text)
+        self.assertIn('pyzord_worker_requests_in_flight{worker="1"} 0\n', text)
+
+    def test_worker_gauges(self):
+        metrics = pyzor.metrics.Metrics(2)
+        for index in range(2):
+            metrics.set_worker(index)
+            metrics.set_gauges({"pool_workers": 4, "cache_hits_total": index + 1})
+        text = metrics.render()
+        # The gauges are reported for each worker, the counters added up.
+        self.assertIn("pyzord_pool_workers 0\n", text)
+        self.assertIn('pyzord_pool_workers{worker="0"} 4\n', text)
+        self.assertIn('pyzord_pool_workers{worker="1"} 4\n', text)
+        self.assertIn("pyzord_cache_hits_total 3\n", text)
+        # The summary only has the totals.
+        lines = metrics.summary()
+        self.assertIn("pyzord_pool_workers 8", lines)
+        self.assertFalse([line for line in lines if "worker=" in line])
+
+    def test_shared(self):
+        metrics = pyzor.metrics.Metrics(2, shared=True)
+        pids = []
+        for index in range(2):
+            pid = os.fork()
+            if not pid:
+                metrics.set_worker(index)
+                for _ in range(index + 1):
+                    metrics.request_started()
+                    metrics.request_finished("report", "200", 0.001)
+                os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        text = metrics.render()
+        self.assertIn('pyzord_requests_total{op="report",code="200"} 3\n', text)
+        self.assertIn('pyzord_worker_requests_total{worker="1"} 2\n', text)
+
+    def test_shared_lock(self):
+        metrics = pyzor.metrics.Metrics(1, shared=True)
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            with metrics.lock:
+                locked.set()
+                release.wait(10)
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        locked.wait(5)
+        # The workers don't wait for the lock held in the other processes.
+        pid = os.fork()
+        if not pid:
+            signal.alarm(5)
+            metrics.set_worker(0)
+            metrics.request_started()
+            metrics.request_finished("ping", "200", 0.001)
+            os._exit(0)
+        _, status = os.waitpid(pid, 0)
+        release.set()
+        thread.join()
+        self.assertEqual(status, 0)
+        self.assertIn(
+            'pyzord_requests_total{op="ping",code="200"} 1\n', metrics.render()
+        )
+
+
+class CollectStatsTest(unittest.TestCase):
+    def test_wrappers(self):
+        engine = MockEngine()
+        cache = pyzor.engines.cache.CachedEngine(engine, 10)
+        buffered = pyzor.engines.buffer.BufferedEngine(cache, 60)
+        metrics = pyzor.metrics.Metrics()
+        database = pyzor.metrics.MeasuredEngine(buffered, metrics)
+        database.report(["a", "b"])
+        self.assertRaises(KeyError, database.__getitem__, "c")
+        stats = pyzor.metrics.collect_stats(database)
+        self.assertEqual(stats["buffer_pending"], 2)
+        self.assertEqual(stats["buffer_increments_total"], 2)
+        self.assertEqual(stats["cache_misses_total"], 1)
+        self.assertEqual(stats["cache_negative_hits_total"], 0)
+        self.assertNotIn("forwarder_queue_depth", stats)
+        self.assertNotIn("read_batch_lookups_total", stats)
+
+    def test_read_batch(self):
+        engine = MockEngine()
+        batched = pyzor.engines.batch.BatchedEngine(engine, 0)
+        cache = pyzor.engines.cache.CachedEngine(batched, 10)
+        self.assertRaises(KeyError, cache.__getitem__, "a")
+        self.assertRaises(KeyError, cache.__getitem__, "a")
+        stats = pyzor.metrics.collect_stats(cache)
+        self.assertEqual(stats["read_batch_lookups_total"], 1)
+        self.assertEqual(stats["read_batch_calls_total"], 1)
+        self.assertEqual(stats["read_batch_keys_total"], 1)
+
+    def test_forwarder(self):
+        forwarder = pyzor.forwarder.Forwarder(Mock(), [], max_queue_size=1)
+        forwarder.queue_forward_request("a")
+        forwarder.queue_forward_request("b")
+        stats = pyzor.metrics.collect_stats({}, forwarder)
+        self.assertEqual(stats["forwarder_queue_depth"], 1)
+        self.assertEqual(stats["forwarder_dropped_total"], 1)
+
+    def test_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.bind(("127.0.0.1", 0))
+        stats = pyzor.metrics.collect_stats({}, None, None, sock)
+        self.assertGreater(stats["socket_receive_buffer_bytes"], 0)
+        self.assertNotIn("socket_receive_buffer_bytes", pyzor.metrics.collect_stats({}))
+
+    @unittest.skipUnless(os.path.exists("/proc/net/udp"), "requires /proc/net/udp")
+    def test_socket_drops(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024)
+        sock.bind(("127.0.0.1", 0))
+        self.assertEqual(
+            pyzor.metrics.socket_stats(sock)["drops"],
+            0,
+        )
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        for _ in range(100):
+            client.sendto(b"x" * 1000, sock.getsockname())
+        stats = pyzor.metrics.socket_stats(sock)
+        self.assertGreater(stats["receive_queue"], 0)
+        self.assertGreater(stats["drops"], 0)
+
+    def test_socket_closed(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.close()
+        self.assertEqual(pyzor.metrics.socket_stats(sock), {})
+
+    def test_usage_log(self):
+        usage_log = logging.getLogger("pyzord-usage-test")
+        self.addCleanup(usage_log.handlers.clear)
+        usage_log.addHandler(logging.StreamHandler())
+        self.assertNotIn("usage_log_written_total", pyzor.metrics.collect_stats({}))
+        self.assertNotIn(
+            "usage_log_written_total", pyzor.metrics.collect_stats({}, None, usage_log)
+        )
+        handler = Mock(spec=pyzor.usagelog.AsyncFileHandler)
+        handler.stats.return_value = {"queue_depth": 3, "written": 2, "dropped": 1}
+        usage_log.addHandler(handler)
+        stats = pyzor.metrics.collect_stats({}, None, usage_log)
+        self.assertEqual(stats["usage_log_queue_depth"], 3)
+        self.assertEqual(stats["usage_log_written_total"], 2)
+        self.assertEqual(stats["usage_log_dropped_total"], 1)
+
+
+class MeasuredEngineTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.metrics = pyzor.metrics.Metrics()
+        self.engine = MockEngine({"a": pyzor.engines.common.Record(1)})
+        self.database = pyzor.metrics.MeasuredEngine(self.engine, self.metrics)
+
+    def test_calls(self):
+        self.assertEqual(self.database["a"].r_count, 1)
+        self.assertRaises(KeyError, self.database.__getitem__, "b")
+        self.database.get_many(["a", "b"])
+        self.database["b"] = pyzor.engines.common.Record()
+        text = self.metrics.render()
+        self.assertIn('pyzord_engine_call_duration_seconds_count{call="get"} 2\n', text)
+        self.assertIn(
+            'pyzord_engine_call_duration_seconds_count{call="get_many"} 1\n', text
+        )
+        self.assertIn('pyzord_engine_call_duration_seconds_count{call="set"} 1\n', text)
+        self.assertNotIn("pyzord_engine_errors_total{", text)
+
+    def test_error(self):
+        self.engine.get_many = Mock(
+            side_effect=pyzor.engines.common.DatabaseError("unavailable")
+        )
+        self.assertRaises(
+            pyzor.engines.common.DatabaseError, self.database.get_many, ["a"]
+        )
+        self.assertIn(
+            'pyzord_engine_errors_total{call="get_many"} 1\n', self.metrics.render()
+        )
+
+    def test_attributes(self):
+        self.assertFalse(self.database.handles_one_step)
+        self.assertIs(self.database.records, self.engine.records)
+
+
+class MetricsServerTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        logging.getLogger("pyzord").addHandler(logging.NullHandler())
+        self.server = Mock()
+        self.server.metrics = pyzor.metrics.Metrics()
+        self.metrics_server = pyzor.metrics.MetricsServer(("127.0.0.1", 0), self.server)
+        self.metrics_server.start()
+        self.url = "http://127.0.0.1:%s" % self.metrics_server.server_address[1]
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.metrics_server.shutdown()
+        self.metrics_server.server_close()
+
+    def test_metrics(self):
+        self.server.metrics.request_started()
+        response = urlopen(self.url + "/metrics", timeout=5)
+        self.assertEqual(response.getcode(), 200)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+        text = response.read().decode("utf8")
+        self.assertIn("pyzord_requests_in_flight 1\n", text)
+        self.server.update_metrics.assert_called_with()
+
+    def test_not_found(self):
+        try:
+            urlopen(self.url + "/", timeout=5)
+        except HTTPError as e:
+            self.assertEqual(e.code, 404)
+        else:
+            self.fail("The request should fail.")
+
+
+def suite():
+    """Gather all the tests from this module in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(MetricsTest))
+    test_suite.addTest(unittest.makeSuite(CollectStatsTest))
+    test_suite.addTest(unittest.makeSuite(MeasuredEngineTest))
+    test_suite.addTest(unittest.makeSuite(MetricsServerTest))
+    return test_suite
+
+
+if __name__ == "__main__":
+    unittest.main()
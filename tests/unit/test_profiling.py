@@ -0,0 +1,94 @@
+"""Test the pyzor.profiling module
+"""
+
+import os
+import time
+import pstats
+import shutil
+import tempfile
+import unittest
+import threading
+
+import pyzor.profiling
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=busy_loop, args=(self.stop,))
+        self.thread.start()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.stop.set()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def get_files(self, extension):
+        return [
+            os.path.join(self.tmpdir, fn)
+            for fn in os.listdir(self.tmpdir)
+            if fn.endswith(extension)
+        ]
+
+    def test_profile(self):
+        profiler = pyzor.profiling.Profiler(self.tmpdir, 0.2, interval=0.001)
+        self.assertTrue(profiler.start())
+        profiler._thread.join(5)
+        (prof_fn,) = self.get_files(".prof")
+        stats = pstats.Stats(prof_fn)
+        functions = dict((name, value) for (_, _, name), value in stats.stats.items())
+        self.assertIn("busy_loop", functions)
+        # The samples of the busy loop are attributed to it, and to the
+        # functions that called it.
+        cc, nc, tt, ct, callers = functions["busy_loop"]
+        self.assertGreater(tt, 0)
+        self.assertLessEqual(tt, ct)
+        self.assertEqual([name for _, _, name in callers], ["run"])
+        self.assertEqual(len(self.get_files(".mem")), 1)
+
+    def test_already_started(self):
+        profiler = pyzor.profiling.Profiler(self.tmpdir, 10)
+        self.assertTrue(profiler.start())
+        self.assertFalse(profiler.start())
+        profiler.stop()
+        self.assertEqual(len(self.get_files(".prof")), 1)
+
+    def test_stop(self):
+        profiler = pyzor.profiling.Profiler(self.tmpdir, 60)
+        profiler.start()
+        start = time.monotonic()
+        profiler.stop()
+        self.assertLess(time.monotonic() - start, 30)
+        self.assertTrue(profiler.start())
+        profiler.stop()
+        self.assertEqual(len(self.get_files(".prof")), 2)
+
+    def test_stop_not_started(self):
+        profiler = pyzor.profiling.Profiler(self.tmpdir, 60)
+        profiler.stop()
+        self.assertEqual(self.get_files(".prof"), [])
+
+    def test_write_error(self):
+        profiler = pyzor.profiling.Profiler(os.path.join(self.tmpdir, "missing"), 0.01)
+        profiler.start()
+        profiler.stop()
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "missing")))
+
+
+def suite():
+    """Gather all the tests from this module in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(ProfilerTest))
+    return test_suite
+
+
+if __name__ == "__main__":
+    unittest.main()
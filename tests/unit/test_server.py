@@ -1,10 +1,18 @@
-"""Test the pyzor.server module
-"""
+"""Test the pyzor.server module"""
+
 import io
+import os
 import sys
 import time
+import errno
+import signal
+import socket
 import logging
+import shutil
+import tempfile
 import unittest
+import itertools
+import threading
 
 try:
     import socketserver as SocketServer
@@ -14,17 +22,37 @@ except ImportError:
 from datetime import datetime, timedelta
 
 try:
-    from unittest.mock import patch
+    from unittest.mock import patch, Mock
+except ImportError:
+    from mock import patch, Mock
+
+try:
+    import gevent
+    import gevent.event
+    import gevent.socket
 except ImportError:
-    from mock import patch
+    gevent = None
 
+import pyzor.client
 import pyzor.server
+import pyzor.limits
+import pyzor.account
+import pyzor.message
+import pyzor.metrics
+import pyzor.stream
+import pyzor.hotdigests
+import pyzor.engines.cache
 import pyzor.engines.common
 
 
 class MockServer:
     """Mocks the pyzor.server.Server class"""
 
+    slow_request_time = 0
+    lookups = None
+    hot_digests = None
+    max_packet_size = pyzor.server.Server.max_packet_size
+
     def __init__(self):
         self.log = logging.getLogger("pyzord")
         self.usage_log = logging.getLogger("pyzord-usage")
@@ -32,15 +60,21 @@ class MockServer:
         self.usage_log.addHandler(logging.NullHandler())
         self.forwarder = None
         self.one_step = False
+        self.hashed_keys = {}
+        self.metrics = pyzor.metrics.Metrics()
+        self.limiter = None
+
+    def update_metrics(self):
+        pass
 
 
 class MockDatagramRequestHandler:
     """Mock the SocketServer.DatagramRequestHand."""
 
-    def __init__(self, headers, database=None, acl=None, accounts=None):
+    def __init__(self, headers, database=None, acl=None, accounts=None, limiter=None):
         """Initiates an request handler and set's the data in `headers` as
-        the request. Also set's the database, acl and accounts for the
-        MockServer.
+        the request. Also set's the database, acl, accounts and rate limiter
+        for the MockServer.
 
         This will be set as base class for RequestHandler.
         """
@@ -69,6 +103,7 @@ class MockDatagramRequestHandler:
                 )
             }
         self.server.accounts = accounts
+        self.server.limiter = limiter
 
         self.handle()
 
@@ -161,6 +196,22 @@ class RequestHandlerTest(unittest.TestCase):
 
         self.check_response(handler)
 
+    def test_check_coalesced(self):
+        """Tests the check command handler with coalesced lookups"""
+        digest = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+        database = {digest: pyzor.engines.common.Record(24, 42)}
+        lookups = pyzor.server.Singleflight()
+        patch.object(MockServer, "lookups", lookups).start()
+
+        self.request["Op"] = "check"
+        self.request["Op-Digest"] = digest
+        handler = pyzor.server.RequestHandler(self.request, database)
+        self.expected_response["Count"] = "24"
+        self.expected_response["WL-Count"] = "42"
+
+        self.check_response(handler)
+        self.assertEqual(lookups.stats(), {"calls": 1, "coalesced": 0, "in_flight": 0})
+
     def test_check_new(self):
         """Tests the check command handler with a new record"""
         digest = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
@@ -227,6 +278,23 @@ class RequestHandlerTest(unittest.TestCase):
         self.check_response(handler)
         self.assertEqual(database[digest].r_count, 25)
 
+    def test_report_cached(self):
+        """Tests that the reported records are not read from the cache"""
+        digest = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+        engine = MockEngine({digest: pyzor.engines.common.Record(24, 42)})
+        database = pyzor.engines.cache.CachedEngine(engine, 10)
+        database[digest]
+        # Another process increments the record.
+        engine.records[digest] = pyzor.engines.common.Record(30, 50)
+
+        self.request["Op-Digest"] = digest
+        for op in ("report", "whitelist"):
+            self.request["Op"] = op
+            handler = pyzor.server.RequestHandler(self.request, database)
+            self.check_response(handler)
+        self.assertEqual(engine.records[digest].r_count, 31)
+        self.assertEqual(engine.records[digest].wl_count, 51)
+
     def test_report_new(self):
         """Tests the report command handler with a new record"""
         digest = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
@@ -303,6 +371,152 @@ class RequestHandlerTest(unittest.TestCase):
         self.expected_response["Diag"] = "Forbidden"
         self.check_response(handler)
 
+    def test_stats(self):
+        """Tests the stats command handler"""
+        self.request["Op"] = "stats"
+        acl = {pyzor.anonymous_user: ("stats",)}
+        handler = pyzor.server.RequestHandler(self.request, acl=acl)
+        self.assertEqual(handler.response["Code"], "200")
+        stats = handler.response.get_all("Stat")
+        self.assertIn("pyzord_requests_in_flight 1", stats)
+        self.assertIn(
+            'pyzord_requests_total{op="stats",code="200"} 1',
+            handler.server.metrics.summary(),
+        )
+
+    def test_stats_size(self):
+        """Tests that the stats response fits in a datagram with many workers"""
+
+        def update_metrics(server):
+            metrics = server.metrics = pyzor.metrics.Metrics(32)
+            for index in range(32):
+                metrics.set_worker(index)
+                for op in pyzor.metrics.OPERATIONS:
+                    for code in pyzor.metrics.CODES:
+                        metrics.request_started()
+                        metrics.request_finished(op, code, 0.001 * index)
+                for call in pyzor.metrics.ENGINE_CALLS:
+                    metrics.engine_call(call, 0.01, error=True)
+                for reason in pyzor.metrics.REJECTIONS:
+                    metrics.request_rejected(reason)
+                metrics.set_gauges(
+                    dict((gauge[0], 123456789) for gauge in pyzor.metrics.GAUGES)
+                )
+
+        patch.object(MockServer, "update_metrics", update_metrics).start()
+        self.request["Op"] = "stats"
+        acl = {pyzor.anonymous_user: ("stats",)}
+        handler = pyzor.server.RequestHandler(self.request, acl=acl)
+        self.assertEqual(handler.response["Code"], "200")
+        response = handler.wfile.getvalue()
+        self.assertLessEqual(len(response), MockServer.max_packet_size)
+        stats = handler.response.get_all("Stat")
+        self.assertEqual(stats[0], 'pyzord_requests_total{op="ping",code="200"} 32')
+        self.assertFalse([line for line in stats if "worker=" in line])
+
+    def test_hot_digests(self):
+        """Tests counting the hot digests and returning them with stats"""
+        digest = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+        hot_digests = pyzor.hotdigests.HotDigests(10)
+        patch.object(MockServer, "hot_digests", hot_digests).start()
+        self.request["Op-Digest"] = digest
+        for op in ("check", "report", "info", "check"):
+            self.request["Op"] = op
+            pyzor.server.RequestHandler(self.request, {})
+        self.assertEqual(hot_digests.top(), [(digest, 3, 0)])
+
+        del self.request["Op-Digest"]
+        self.request["Op"] = "stats"
+        acl = {pyzor.anonymous_user: ("stats",)}
+        handler = pyzor.server.RequestHandler(self.request, acl=acl)
+        self.assertIn(
+            'pyzord_hot_digest_requests{digest="%s"} 3' % digest,
+            handler.response.get_all("Stat"),
+        )
+
+    def test_stats_unauthorized(self):
+        """Tests that the stats command is not allowed by default"""
+        self.request["Op"] = "stats"
+        handler = pyzor.server.RequestHandler(self.request)
+        self.expected_response["Code"] = "403"
+        self.expected_response["Diag"] = "Forbidden"
+        self.check_response(handler)
+        self.assertIn(
+            'pyzord_requests_total{op="stats",code="403"} 1',
+            handler.server.metrics.summary(),
+        )
+
+    def test_user_rate_limit(self):
+        """Tests handling a request from a user over its rate limit"""
+        self.request["Op"] = "ping"
+        limiter = pyzor.limits.RateLimiter({"user": {"anonymous": (1, 1)}})
+        handler = pyzor.server.RequestHandler(self.request, limiter=limiter)
+        self.check_response(handler)
+
+        handler = pyzor.server.RequestHandler(self.request, limiter=limiter)
+        self.expected_response["Code"] = "429"
+        self.expected_response["Diag"] = "Too Many Requests"
+        self.check_response(handler)
+        self.assertIn(
+            'pyzord_requests_rejected_total{reason="user"} 1',
+            handler.server.metrics.summary(),
+        )
+
+    def test_usage(self):
+        """Tests the user, address and operation of the usage records"""
+        usage_handler = Mock(level=logging.NOTSET)
+        usage_log = logging.getLogger("pyzord-usage")
+        usage_log.addHandler(usage_handler)
+        self.addCleanup(usage_log.removeHandler, usage_handler)
+        self.addCleanup(usage_log.setLevel, usage_log.level)
+        usage_log.setLevel(logging.INFO)
+        self.request["Op"] = "ping"
+        pyzor.server.RequestHandler(self.request)
+        self.request["Op"] = "stats"
+        pyzor.server.RequestHandler(self.request)
+        records = [call[0][0] for call in usage_handler.handle.call_args_list]
+        self.assertEqual(
+            [(record.levelno, record.usage) for record in records],
+            [
+                (logging.INFO, ("anonymous", "127.0.0.1", "ping")),
+                (logging.ERROR, ("anonymous", "127.0.0.1", "stats")),
+            ],
+        )
+
+    def test_phases(self):
+        """Tests the time spent in each phase of the request"""
+        digest = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+        self.request["Op"] = "check"
+        self.request["Op-Digest"] = digest
+        handler = pyzor.server.RequestHandler(self.request, {})
+        self.assertEqual(
+            sorted(handler.phases), ["acl", "engine", "log", "parse", "response"]
+        )
+        self.assertIn(
+            'pyzord_request_phase_duration_seconds_count{phase="engine"} 1',
+            handler.server.metrics.render(),
+        )
+
+    def test_slow_request(self):
+        """Tests logging the slow requests"""
+        patch.object(MockServer, "slow_request_time", 1e-9).start()
+        log = logging.getLogger("pyzord")
+        with patch.object(log, "warning") as warning:
+            self.request["Op"] = "ping"
+            pyzor.server.RequestHandler(self.request)
+        self.assertEqual(warning.call_count, 1)
+        args = warning.call_args[0]
+        self.assertEqual(args[1:4], ("ping", "127.0.0.1", 0))
+        self.assertTrue(args[5].startswith("parse "))
+
+    def test_not_slow_request(self):
+        """Tests that the requests are not logged by default"""
+        log = logging.getLogger("pyzord")
+        with patch.object(log, "warning") as warning:
+            self.request["Op"] = "ping"
+            pyzor.server.RequestHandler(self.request)
+        self.assertFalse(warning.called)
+
     def test_handle_account(self):
         """Tests handling an request where user is not anonymous"""
         self.request["Op"] = "ping"
@@ -393,6 +607,150 @@ class RequestHandlerTest(unittest.TestCase):
         self.check_response(handler)
 
 
+class SingleflightTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.lookups = pyzor.server.Singleflight()
+        self.release = threading.Event()
+        self.called = []
+
+    def lookup(self, key):
+        self.called.append(key)
+        self.release.wait()
+        if key == "missing":
+            raise KeyError(key)
+        return [key]
+
+    def start(self, key, results):
+        def run():
+            try:
+                results.append(self.lookups.do(key, self.lookup, key))
+            except KeyError as e:
+                results.append(e)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertTrue(condition())
+
+    def test_coalesce(self):
+        results = []
+        threads = [self.start("key", results)]
+        self.wait_for(lambda: self.called)
+        threads.extend(self.start("key", results) for _ in range(3))
+        threads.append(self.start("other", results))
+        self.wait_for(lambda: self.lookups.stats()["coalesced"] == 3)
+        self.wait_for(lambda: len(self.called) == 2)
+        self.assertEqual(self.lookups.stats()["in_flight"], 2)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(self.called), ["key", "other"])
+        # The waiting threads got the result of the first call.
+        shared = [result for result in results if result == ["key"]]
+        self.assertEqual(len(shared), 4)
+        self.assertTrue(all(result is shared[0] for result in shared))
+        self.assertEqual(
+            self.lookups.stats(), {"calls": 2, "coalesced": 3, "in_flight": 0}
+        )
+
+    def test_error(self):
+        results = []
+        threads = [self.start("missing", results)]
+        self.wait_for(lambda: self.called)
+        threads.append(self.start("missing", results))
+        self.wait_for(lambda: self.lookups.stats()["coalesced"] == 1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(isinstance(result, KeyError) for result in results))
+        self.assertEqual(self.called, ["missing"])
+
+    def test_sequential(self):
+        self.release.set()
+        self.assertEqual(self.lookups.do("key", self.lookup, "key"), ["key"])
+        self.assertEqual(self.lookups.do("key", self.lookup, "key"), ["key"])
+        self.assertEqual(self.called, ["key", "key"])
+        self.assertEqual(
+            self.lookups.stats(), {"calls": 2, "coalesced": 0, "in_flight": 0}
+        )
+
+
+class VerifySignatureTest(unittest.TestCase):
+    """Test the verification of the signatures of authenticated requests,
+    with a real client message.
+    """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = MockServer()
+        self.server.accounts = {"testuser": "testkey"}
+        self.server.hashed_keys = pyzor.server.hash_keys(self.server.accounts)
+        msg = pyzor.message.CheckRequest("2aedaac999d71421c9ee49b9d81f627a7bc570aa")
+        msg["User"] = "testuser"
+        msg["Time"] = str(int(time.time()))
+        msg.init_for_sending()
+        hashed_key = pyzor.account.hash_key("testkey", "testuser")
+        msg["Sig"] = pyzor.account.sign_msg(hashed_key, int(msg["Time"]), msg)
+        self.data = msg.as_string().encode("utf8")
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def verify(self, data):
+        handler = pyzor.server.RequestHandler.__new__(pyzor.server.RequestHandler)
+        handler.server = self.server
+        request = pyzor.message.Headers.parse(data)
+        handler.verify_signature("testuser", request, data)
+
+    def test_raw_signature(self):
+        slow = patch("pyzor.account.verify_signature").start()
+        self.verify(self.data)
+        self.assertFalse(slow.called)
+
+    def test_fallback(self):
+        # Not the way the client serializes the request, but signed content
+        # is the same.
+        data = self.data.replace(b"Op: check", b"Op:  check")
+        self.verify(data)
+
+    def test_invalid_signature(self):
+        slow = patch("pyzor.account.verify_signature").start()
+        data = self.data.replace(b"Op: check", b"Op: report")
+        self.assertRaises(pyzor.SignatureError, self.verify, data)
+        # The request is not serialized again.
+        self.assertFalse(slow.called)
+
+    def test_invalid_signature_fallback(self):
+        data = self.data.replace(b"Op: check", b"Op:  report")
+        self.assertRaises(pyzor.SignatureError, self.verify, data)
+
+    def test_canonical(self):
+        self.assertTrue(pyzor.account.is_canonical(self.data))
+        self.assertTrue(pyzor.account.is_canonical(b"Op: ping\nCount: \n"))
+        for data in (
+            b"Op:  check\n\n",
+            b"Op: check\r\n\r\n",
+            b"Long: a\n b\n\n",
+            b"Op: ch\xe9ck\n\n",
+            b"Op: check\n\nbody",
+            b"From someone\nOp: check\n\n",
+            b"",
+        ):
+            self.assertFalse(pyzor.account.is_canonical(data), data)
+
+    def test_unknown_user(self):
+        self.server.accounts = {}
+        self.assertRaises(pyzor.SignatureError, self.verify, self.data)
+
+
 class ServerTest(unittest.TestCase):
     def setUp(self):
         unittest.TestCase.setUp(self)
@@ -405,12 +763,998 @@ class ServerTest(unittest.TestCase):
     def test_server(self):
         pyzor.server.Server(("127.0.0.1", 24441), {}, "passwd_fn", "access_fn", None)
 
+    def test_hot_digests(self):
+        hot_digests = Mock()
+        patch.object(pyzor.server.Server, "hot_digests", hot_digests).start()
+        server = pyzor.server.Server(("127.0.0.1", 0), {}, "passwd_fn", "access_fn")
+        self.assertFalse(hot_digests.prewarm.called)
+        hot_digests.stats.return_value = {"digests": 2, "requests": 5, "replaced": 1}
+        server.update_metrics()
+        self.assertIn("pyzord_hot_digests_requests_total 5", server.metrics.summary())
+        server.server_close()
+        hot_digests.save.assert_called_once_with()
+
+    def test_prewarm(self):
+        hot_digests = Mock()
+        patch.object(pyzor.server.Server, "hot_digests", hot_digests).start()
+        patch.object(pyzor.server.Server, "prewarm_cache", True).start()
+        server = pyzor.server.Server(("127.0.0.1", 0), {}, "passwd_fn", "access_fn")
+        self.addCleanup(server.server_close)
+        hot_digests.prewarm.assert_called_once_with(server.database)
+
+    def test_buffer_sizes(self):
+        patch.object(pyzor.server.Server, "receive_buffer", 65536).start()
+        patch.object(pyzor.server.Server, "send_buffer", 32768).start()
+        server = pyzor.server.Server(("127.0.0.1", 0), {}, "passwd_fn", "access_fn")
+        self.addCleanup(server.server_close)
+        sock = server.socket
+        self.assertGreaterEqual(
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), 65536
+        )
+        self.assertGreaterEqual(
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), 32768
+        )
+
+    def test_buffer_sizes_capped(self):
+        sock = Mock()
+        sock.getsockopt.return_value = 1024
+        with patch("pyzor.server.sys.platform", "freebsd"):
+            with patch.object(logging.getLogger("pyzord"), "warning") as warning:
+                pyzor.server.set_buffer_sizes(sock, 4096)
+        sock.setsockopt.assert_called_once_with(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, 4096
+        )
+        self.assertEqual(warning.call_args[0][1:], (1024, 4096, "net.core.rmem_max"))
+
+    def test_socket_drops(self):
+        server = pyzor.server.Server(("127.0.0.1", 0), {}, "passwd_fn", "access_fn")
+        self.addCleanup(server.server_close)
+        server.log = Mock()
+        stats = patch("pyzor.metrics.socket_stats").start()
+        for drops in (2, 2, 5):
+            stats.return_value = {"receive_queue": 100, "drops": drops}
+            server.update_metrics()
+        server.log.warning.assert_called_once_with(
+            "%s datagrams dropped because the receive queue was full, "
+            "%s bytes queued.",
+            3,
+            100,
+        )
+        self.assertIn("pyzord_socket_drops_total 5", server.metrics.summary())
+        stats.assert_called_with(server.socket)
+
+    def test_set_worker(self):
+        server = pyzor.server.Server(("127.0.0.1", 0), {}, "passwd_fn", "access_fn")
+        self.addCleanup(server.server_close)
+        server.metrics = pyzor.metrics.Metrics(2)
+        server.hot_digests = pyzor.hotdigests.HotDigests()
+        server.set_worker(1)
+        self.assertEqual(server.metrics.offset, 2 * pyzor.metrics.SLOT_SIZE)
+        self.assertEqual(server.hot_digests.worker, 1)
+
+    def test_update_metrics_lock(self):
+        server = pyzor.server.Server(("127.0.0.1", 0), {}, "passwd_fn", "access_fn")
+        self.addCleanup(server.server_close)
+        acquired = []
+
+        def set_gauges(values):
+            # The other threads can't update the metrics meanwhile.
+            thread = threading.Thread(
+                target=lambda: acquired.append(server.metrics.lock.acquire(False))
+            )
+            thread.start()
+            thread.join()
+
+        server.metrics.set_gauges = set_gauges
+        server.update_metrics()
+        self.assertEqual(acquired, [False])
+
+    def test_profile(self):
+        server = pyzor.server.Server(("127.0.0.1", 0), {}, "passwd_fn", "access_fn")
+        self.addCleanup(server.server_close)
+        server.profiler = Mock()
+        server.profile_handler()
+        server.profiler.start.assert_called_with()
+
+    def test_profile_disabled(self):
+        server = pyzor.server.Server(("127.0.0.1", 0), {}, "passwd_fn", "access_fn")
+        self.addCleanup(server.server_close)
+        server.log = Mock()
+        server.profile_handler()
+        server.log.warning.assert_called_with("Profiling is not enabled.")
+
+    def test_prefork_profile(self):
+        server = pyzor.server.PreForkServer(
+            ("127.0.0.1", 0), iter([]), "passwd_fn", "access_fn", prefork=2
+        )
+        self.addCleanup(server.server_close)
+        server.profiler = Mock()
+        server.pids = [101, 102]
+        with patch("pyzor.server.os.kill") as kill:
+            server.profile_handler()
+        self.assertEqual(
+            kill.call_args_list,
+            [((101, signal.SIGUSR2),), ((102, signal.SIGUSR2),)],
+        )
+        self.assertFalse(server.profiler.start.called)
+        # The workers start their own profiler.
+        server.pids = None
+        server.profile_handler()
+        server.profiler.start.assert_called_with()
+
+
+class AdmissionTest(unittest.TestCase):
+    """Test the rejection of the requests over the rate limits, or when the
+    server is busy.
+    """
+
+    packet = b"Op: check\nPV: 2.1\nThread: 1234\nOp-Digest: abc\n"
+    client = ("192.0.2.1", 24442)
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        patch("pyzor.config").start()
+        self.server = None
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        if self.server is not None:
+            self.server.server_close()
+        patch.stopall()
+
+    def get_server(self, server_class=pyzor.server.Server, *args, **kwargs):
+        self.server = server_class(
+            ("127.0.0.1", 0), {}, "passwd_fn", "access_fn", *args, **kwargs
+        )
+        self.server.log.addHandler(logging.NullHandler())
+        self.server.usage_log.addHandler(logging.NullHandler())
+        return self.server
+
+    def get_replier(self):
+        # Answers the requests of the other listeners.
+        return Mock(spec=["sendto", "request_done"])
+
+    def get_response(self, sock):
+        response, address = sock.sendto.call_args[0]
+        self.assertEqual(address, self.client)
+        return pyzor.message.Headers.parse(response)
+
+    def test_address_rate_limit(self):
+        server = self.get_server()
+        server.limiter = pyzor.limits.RateLimiter({"address": {"all": (1, 1)}})
+        sock = Mock()
+        self.assertTrue(server.verify_request((self.packet, sock), self.client))
+        self.assertFalse(sock.sendto.called)
+        self.assertFalse(server.verify_request((self.packet, sock), self.client))
+        response = self.get_response(sock)
+        self.assertEqual(response["Code"], "429")
+        self.assertEqual(response["Thread"], "1234")
+        summary = server.metrics.summary()
+        self.assertIn('pyzord_requests_rejected_total{reason="address"} 1', summary)
+        self.assertIn('pyzord_requests_total{op="check",code="429"} 1', summary)
+
+    def test_busy(self):
+        server = self.get_server(max_pending=2)
+        server.pending_requests = Mock(return_value=2)
+        sock = Mock()
+        self.assertFalse(server.verify_request((self.packet, sock), self.client))
+        self.assertEqual(self.get_response(sock)["Code"], "503")
+        self.assertIn(
+            'pyzord_requests_rejected_total{reason="busy"} 1',
+            server.metrics.summary(),
+        )
+
+    def test_no_max_pending(self):
+        server = self.get_server()
+        server.pending_requests = Mock(return_value=2)
+        self.assertTrue(server.verify_request((self.packet, Mock()), self.client))
+
+    def test_threading_pending(self):
+        server = self.get_server(pyzor.server.ThreadingServer, max_pending=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def finish_request(request, client_address):
+            started.set()
+            release.wait(5)
+
+        server.finish_request = finish_request
+        server.process_request((self.packet, Mock()), self.client)
+        started.wait(5)
+        self.assertEqual(server.pending_requests(), 1)
+        self.assertFalse(server.verify_request((self.packet, Mock()), self.client))
+        release.set()
+        server.server_close()
+        self.server = None
+        self.assertEqual(server.pending_requests(), 0)
+
+    def test_bounded_threading_busy(self):
+        server = self.get_server(pyzor.server.BoundedThreadingServer, 1, None, None, 10)
+        server.semaphore.acquire()
+        sock = Mock()
+        server.process_request((self.packet, sock), self.client)
+        self.assertEqual(self.get_response(sock)["Code"], "503")
+
+    def test_bounded_threading_release(self):
+        server = self.get_server(pyzor.server.BoundedThreadingServer, 1, None, None, 10)
+        server.finish_request = Mock(side_effect=Exception("handler failed"))
+        server.handle_error = Mock(side_effect=Exception("error handler failed"))
+        self.assertRaises(
+            Exception,
+            server.process_request_thread,
+            (self.packet, Mock()),
+            self.client,
+        )
+        # The slot is released even if the handler raised.
+        self.assertTrue(server.semaphore.acquire(False))
+
+    def test_dispatch(self):
+        server = self.get_server()
+        server.acl = {pyzor.anonymous_user: ("check",)}
+        sock = self.get_replier()
+        server.dispatch_request((self.packet, sock), self.client)
+        self.assertEqual(self.get_response(sock)["Code"], "200")
+        sock.request_done.assert_called_once_with()
+
+    def test_dispatch_busy(self):
+        server = self.get_server(pyzor.server.BoundedThreadingServer, 1, max_pending=1)
+        server.semaphore.acquire()
+        sock = self.get_replier()
+        server.dispatch_request((self.packet, sock), self.client)
+        self.assertEqual(self.get_response(sock)["Code"], "503")
+        self.assertTrue(sock.request_done.called)
+
+    def test_dispatch_pool(self):
+        server = self.get_server(pyzor.server.ThreadPoolServer, 0, 1)
+        server.acl = {pyzor.anonymous_user: ("check",)}
+        sock = self.get_replier()
+        server.dispatch_request((self.packet, sock), self.client)
+        # The request waits in the queue of the pool.
+        self.assertFalse(sock.request_done.called)
+        other = self.get_replier()
+        server.dispatch_request((self.packet, other), self.client)
+        self.assertEqual(self.get_response(other)["Code"], "503")
+        other.request_done.assert_called_once_with()
+        server.handle_queued_request(*server.queue.get_nowait())
+        self.assertEqual(self.get_response(sock)["Code"], "200")
+        sock.request_done.assert_called_once_with()
+
+    def test_bounded_threading_start_failed(self):
+        server = self.get_server(pyzor.server.BoundedThreadingServer, 1, None, None, 10)
+        with patch(
+            "pyzor.server.SocketServer.ThreadingMixIn.process_request",
+            side_effect=RuntimeError("can't start new thread"),
+        ):
+            self.assertRaises(
+                RuntimeError,
+                server.process_request,
+                (self.packet, Mock()),
+                self.client,
+            )
+        self.assertTrue(server.semaphore.acquire(False))
+        self.assertEqual(server.pending_requests(), 0)
+
+
+@unittest.skipIf(gevent is None, "gevent library not available")
+class GeventServerTest(unittest.TestCase):
+    packet = b"Op: ping\nPV: 2.1\nThread: %d\n\n"
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        patch("pyzor.config").start()
+        self.server = pyzor.server.GeventServer(
+            ("127.0.0.1", 0), {}, "passwd_fn", "access_fn", 10, max_pending=1
+        )
+        self.server.log.addHandler(logging.NullHandler())
+        self.server.usage_log.addHandler(logging.NullHandler())
+        self.greenlet = gevent.spawn(self.server.serve_forever, 0.01)
+        self.client = gevent.socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.server.shutdown()
+        self.greenlet.join(5)
+        self.server.server_close()
+        self.client.close()
+        patch.stopall()
+
+    def request(self, thread):
+        self.client.sendto(self.packet % thread, self.server.socket.getsockname())
+
+    def get_response(self):
+        with gevent.Timeout(5):
+            return pyzor.message.Headers.parse(self.client.recv(8192))
+
+    def test_serve(self):
+        self.request(1234)
+        self.assertEqual(self.get_response()["Thread"], "1234")
+        self.assertEqual(self.server.pending_requests(), 0)
+
+    def test_busy(self):
+        release = gevent.event.Event()
+        finish_request = self.server.finish_request
+
+        def slow_finish_request(request, client_address):
+            release.wait(5)
+            finish_request(request, client_address)
+
+        self.server.finish_request = slow_finish_request
+        self.request(1)
+        self.request(2)
+        response = self.get_response()
+        self.assertEqual((response["Thread"], response["Code"]), ("2", "503"))
+        release.set()
+        response = self.get_response()
+        self.assertEqual(response["Thread"], "1")
+        self.assertNotEqual(response["Code"], "503")
+
+    def test_shutdown(self):
+        self.server.shutdown()
+        self.greenlet.join(5)
+        self.assertTrue(self.greenlet.dead)
+
+    def test_dispatch(self):
+        sock = Mock(spec=["sendto", "request_done"])
+        self.server.dispatch_request((self.packet % 1, sock), ("127.0.0.1", 24442))
+        self.server.pool.join(5)
+        response = pyzor.message.Headers.parse(sock.sendto.call_args[0][0])
+        self.assertEqual(response["Thread"], "1")
+        sock.request_done.assert_called_once_with()
+        self.assertEqual(self.server.pending_requests(), 0)
+
+
+class StreamServerTest(unittest.TestCase):
+    packet = b"Op: check\nPV: 2.1\nThread: %d\nOp-Digest: abc\n"
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        patch("pyzor.config").start()
+        self.server = pyzor.server.Server(
+            ("127.0.0.1", 0), {}, "passwd_fn", "access_fn"
+        )
+        self.server.acl = {pyzor.anonymous_user: ("check",)}
+        self.server.log.addHandler(logging.NullHandler())
+        self.server.usage_log.addHandler(logging.NullHandler())
+        self.tmpdir = tempfile.mkdtemp()
+        self.stream_servers = []
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        for stream_server in self.stream_servers:
+            stream_server.shutdown()
+            stream_server.server_close()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+        patch.stopall()
+
+    def connect(self, address=("127.0.0.1", 0)):
+        stream_server = pyzor.server.StreamServer(address, self.server)
+        stream_server.start()
+        self.stream_servers.append(stream_server)
+        if isinstance(address, tuple):
+            sock = socket.create_connection(stream_server.server_address, 5)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(5)
+            sock.connect(address)
+        self.addCleanup(sock.close)
+        return sock, sock.makefile("rb")
+
+    def read_response(self, rfile):
+        return pyzor.message.Headers.parse(pyzor.stream.read_message(rfile))
+
+    def test_pipeline(self):
+        sock, rfile = self.connect()
+        sock.sendall(
+            pyzor.stream.pack(self.packet % 1) + pyzor.stream.pack(self.packet % 2)
+        )
+        for thread in ("1", "2"):
+            response = self.read_response(rfile)
+            self.assertEqual(response["Thread"], thread)
+            self.assertEqual(response["Code"], "200")
+            self.assertEqual(response["Count"], "0")
+
+    def test_unix(self):
+        path = os.path.join(self.tmpdir, "pyzord.sock")
+        sock, rfile = self.connect(path)
+        sock.sendall(pyzor.stream.pack(self.packet % 1))
+        self.assertEqual(self.read_response(rfile)["Code"], "200")
+        stream_server = self.stream_servers.pop()
+        stream_server.shutdown()
+        stream_server.server_close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_too_large(self):
+        patch.object(pyzor.server.StreamServer, "max_message_size", 10).start()
+        sock, rfile = self.connect()
+        sock.sendall(pyzor.stream.pack(self.packet % 1))
+        # The connection is closed.
+        self.assertEqual(rfile.read(), b"")
+
+    def test_close(self):
+        sock, rfile = self.connect()
+        sock.sendall(pyzor.stream.pack(self.packet % 1))
+        self.assertEqual(self.read_response(rfile)["Code"], "200")
+        stream_server = self.stream_servers.pop()
+        stream_server.shutdown()
+        stream_server.server_close()
+        # The open connections are closed too.
+        self.assertEqual(rfile.read(), b"")
+        self.assertEqual(stream_server.connections, {})
+
+    def test_no_response(self):
+        patch.object(pyzor.server.StreamServer, "idle_timeout", 0.5).start()
+        patch.object(self.server, "dispatch_request").start()
+        sock, rfile = self.connect()
+        with self.assertLogs("pyzord", logging.WARNING):
+            sock.sendall(pyzor.stream.pack(self.packet % 1))
+            # The connection is closed instead of waiting forever.
+            self.assertEqual(rfile.read(), b"")
+
+    def test_pool(self):
+        self.server.server_close()
+        self.server = pyzor.server.ThreadPoolServer(
+            ("127.0.0.1", 0), {}, "passwd_fn", "access_fn", 2, 8
+        )
+        self.server.acl = {pyzor.anonymous_user: ("check",)}
+        sock, rfile = self.connect()
+        sock.sendall(
+            pyzor.stream.pack(self.packet % 1) + pyzor.stream.pack(self.packet % 2)
+        )
+        for thread in ("1", "2"):
+            self.assertEqual(self.read_response(rfile)["Thread"], thread)
+        # The requests were handled by the workers of the pool, which count
+        # them after sending the response.
+        deadline = time.time() + 5
+        while self.server.stats()["handled"] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.stats()["handled"], 2)
+
+    def test_rate_limit(self):
+        self.server.limiter = pyzor.limits.RateLimiter({"address": {"all": (1, 1)}})
+        sock, rfile = self.connect()
+        sock.sendall(
+            pyzor.stream.pack(self.packet % 1) + pyzor.stream.pack(self.packet % 2)
+        )
+        self.assertEqual(self.read_response(rfile)["Code"], "200")
+        response = self.read_response(rfile)
+        self.assertEqual((response["Thread"], response["Code"]), ("2", "429"))
+
+
+class UnixDatagramServerTest(unittest.TestCase):
+    packet = b"Op: check\nPV: 2.1\nThread: %d\nOp-Digest: abc\n"
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        patch("pyzor.config").start()
+        self.server = pyzor.server.Server(
+            ("127.0.0.1", 0), {}, "passwd_fn", "access_fn"
+        )
+        self.server.acl = {pyzor.anonymous_user: ("check",)}
+        self.server.log.addHandler(logging.NullHandler())
+        self.server.usage_log.addHandler(logging.NullHandler())
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "pyzord.sock")
+        self.unix_server = None
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        if self.unix_server is not None:
+            self.unix_server.shutdown()
+            self.unix_server.server_close()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+        patch.stopall()
+
+    def listen(self, **kwargs):
+        self.unix_server = pyzor.server.UnixDatagramServer(
+            self.path, self.server, **kwargs
+        )
+        self.unix_server.start()
+
+    def request(self, thread=1):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.settimeout(5)
+        sock.bind("")
+        sock.sendto(self.packet % thread, self.path)
+        return pyzor.message.Headers.parse(sock.recv(8192))
+
+    def test_check(self):
+        self.listen()
+        response = self.request()
+        self.assertEqual(response["Thread"], "1")
+        self.assertEqual(response["Code"], "200")
+        self.assertEqual(response["Count"], "0")
+
+    def test_user(self):
+        self.server.acl = {pyzor.anonymous_user: (), "local": ("check",)}
+        self.listen()
+        self.assertEqual(self.request()["Code"], "403")
+        self.unix_server.user = "local"
+        self.assertEqual(self.request()["Code"], "200")
+
+    def test_user_rate_limit(self):
+        self.server.acl = {"local": ("check",)}
+        self.server.limiter = pyzor.limits.RateLimiter({"user": {"local": (1, 1)}})
+        self.listen(user="local")
+        self.assertEqual(self.request(1)["Code"], "200")
+        self.assertEqual(self.request(2)["Code"], "429")
+
+    def test_permissions(self):
+        self.listen(mode=0o620, gid=os.getgid())
+        info = os.stat(self.path)
+        self.assertEqual(info.st_mode & 0o777, 0o620)
+        self.assertEqual(info.st_gid, os.getgid())
+        self.unix_server.shutdown()
+        self.unix_server.server_close()
+        self.unix_server = None
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_stale_socket(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(self.path)
+        stale.close()
+        self.listen()
+        self.assertEqual(self.request()["Code"], "200")
+
+    def test_pool(self):
+        self.server.server_close()
+        self.server = pyzor.server.ThreadPoolServer(
+            ("127.0.0.1", 0), {}, "passwd_fn", "access_fn", 2, 8
+        )
+        self.server.acl = {pyzor.anonymous_user: ("check",)}
+        self.listen()
+        self.assertEqual(self.request()["Code"], "200")
+        # The workers count the requests after sending the response.
+        deadline = time.time() + 5
+        while not self.server.stats()["handled"] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.stats()["handled"], 1)
+
+    def test_busy(self):
+        self.server.server_close()
+        self.server = pyzor.server.BoundedThreadingServer(
+            ("127.0.0.1", 0), {}, "passwd_fn", "access_fn", 1, max_pending=1
+        )
+        self.server.acl = {pyzor.anonymous_user: ("check",)}
+        self.listen()
+        self.server.semaphore.acquire()
+        # The requests are rejected like the datagrams.
+        self.assertEqual(self.request(1)["Code"], "503")
+        self.server.semaphore.release()
+        self.assertEqual(self.request(2)["Code"], "200")
+
+    def test_unbound_client(self):
+        self.listen()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.sendto(self.packet % 1, self.path)
+        sock.close()
+        # The request can't be answered, the next ones still are.
+        self.assertEqual(self.request(2)["Thread"], "2")
+
+
+class MockEngine(pyzor.engines.common.BaseEngine):
+    """A dictionary based engine that counts the database calls."""
+
+    def __init__(self, records=None, one_step=False):
+        self.records = records or {}
+        self.handles_one_step = one_step
+        self.calls = []
+
+    def __getitem__(self, key):
+        self.calls.append(("get", key))
+        return self.records[key]
+
+    def get_many(self, keys):
+        self.calls.append(("get_many", sorted(keys)))
+        return [self.records.get(key) for key in keys]
+
+    def __setitem__(self, key, value):
+        self.calls.append(("set", key))
+        self.records[key] = value
+
+    def report(self, keys):
+        self.calls.append(("report", list(keys)))
+
+
+class BatchServerTest(unittest.TestCase):
+    digest1 = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+    digest2 = "da39a3ee5e6b4b0d3255bfef95601890afd80709"
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        patch("pyzor.config").start()
+        self.thread = 1000
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.real_socket.close()
+        patch.stopall()
+
+    def get_server(self, database):
+        server = pyzor.server.BatchServer(
+            ("127.0.0.1", 0), database, "passwd_fn", "access_fn", None
+        )
+        server.acl = {pyzor.anonymous_user: ("check", "info", "report", "ping")}
+        server.log.addHandler(logging.NullHandler())
+        server.usage_log.addHandler(logging.NullHandler())
+        self.real_socket = server.socket
+        server.socket = Mock()
+        return server
+
+    def packet(self, op, *digests):
+        self.thread += 1
+        lines = ["Op: %s" % op, "PV: %s" % pyzor.proto_version]
+        lines.append("Thread: %s" % self.thread)
+        lines.extend("Op-Digest: %s" % digest for digest in digests)
+        return ("\n".join(lines) + "\n").encode("utf8")
+
+    def get_responses(self, server):
+        responses = []
+        for call_args in server.socket.sendto.call_args_list:
+            response, address = call_args[0]
+            self.assertEqual(address, ("127.0.0.1", 24442))
+            result = {}
+            for line in response.decode("utf8").splitlines():
+                if line:
+                    key, value = line.split(":", 1)
+                    result[key] = value.strip()
+            responses.append(result)
+        return responses
+
+    def test_drain(self):
+        server = self.get_server(MockEngine())
+        client = ("127.0.0.1", 24442)
+        server.socket.recvfrom.side_effect = [
+            (self.packet("ping"), client),
+            (self.packet("ping"), client),
+            socket.error(errno.EAGAIN, "Resource temporarily unavailable"),
+        ]
+        server._handle_request_noblock()
+        self.assertEqual(server.socket.recvfrom.call_count, 3)
+        self.assertEqual(len(self.get_responses(server)), 2)
+
+    def test_drain_max_batch(self):
+        server = self.get_server(MockEngine())
+        server.max_batch = 2
+        server.process_batch = Mock()
+        client = ("127.0.0.1", 24442)
+        server.socket.recvfrom.return_value = (self.packet("ping"), client)
+        server._handle_request_noblock()
+        self.assertEqual(server.socket.recvfrom.call_count, 2)
+        self.assertEqual(len(server.process_batch.call_args[0][0]), 2)
+
+    def test_lookups(self):
+        database = MockEngine({self.digest1: pyzor.engines.common.Record(24, 42)})
+        server = self.get_server(database)
+        client = ("127.0.0.1", 24442)
+        server.process_batch(
+            [
+                (self.packet("check", self.digest1), client),
+                (self.packet("info", self.digest1), client),
+                (self.packet("check", self.digest2), client),
+                (self.packet("ping"), client),
+            ]
+        )
+        self.assertEqual(
+            database.calls, [("get_many", sorted([self.digest1, self.digest2]))]
+        )
+        responses = self.get_responses(server)
+        self.assertEqual(
+            [r["Thread"] for r in responses], ["1001", "1002", "1003", "1004"]
+        )
+        self.assertEqual(responses[0]["Count"], "24")
+        self.assertEqual(responses[1]["WL-Count"], "42")
+        self.assertEqual(responses[2]["Count"], "0")
+        self.assertEqual(responses[3]["Code"], "200")
+
+    def test_report(self):
+        database = MockEngine({self.digest1: pyzor.engines.common.Record(24, 42)})
+        server = self.get_server(database)
+        client = ("127.0.0.1", 24442)
+        server.process_batch(
+            [
+                (self.packet("report", self.digest1, self.digest2), client),
+                (self.packet("report", self.digest1), client),
+            ]
+        )
+        self.assertEqual(
+            database.calls[0], ("get_many", sorted([self.digest1, self.digest2]))
+        )
+        self.assertEqual(len(database.calls), 3)
+        self.assertEqual(database.records[self.digest1].r_count, 26)
+        self.assertEqual(database.records[self.digest2].r_count, 1)
+
+    def test_report_one_step(self):
+        database = MockEngine(one_step=True)
+        server = self.get_server(database)
+        client = ("127.0.0.1", 24442)
+        server.process_batch(
+            [
+                (self.packet("report", self.digest1, self.digest2), client),
+                (self.packet("report", self.digest1), client),
+            ]
+        )
+        self.assertEqual(
+            database.calls, [("report", [self.digest1, self.digest2, self.digest1])]
+        )
+
+    def test_errors(self):
+        database = MockEngine()
+        database.get_many = Mock(side_effect=pyzor.engines.common.DatabaseError("down"))
+        server = self.get_server(database)
+        client = ("127.0.0.1", 24442)
+        server.process_batch(
+            [
+                (self.packet("check", self.digest1), client),
+                (self.packet("whitelist", self.digest1), client),
+                (self.packet("ping"), client),
+            ]
+        )
+        codes = [r["Code"] for r in self.get_responses(server)]
+        self.assertEqual(codes, ["500", "403", "200"])
+
+    def test_drain_rate_limit(self):
+        server = self.get_server(MockEngine())
+        server.limiter = pyzor.limits.RateLimiter({"address": {"all": (1, 2)}})
+        server.process_batch = Mock()
+        client = ("127.0.0.1", 24442)
+        server.socket.recvfrom.side_effect = [
+            (self.packet("ping"), client),
+            (self.packet("ping"), client),
+            (self.packet("ping"), client),
+            socket.error(errno.EAGAIN, "Resource temporarily unavailable"),
+        ]
+        server._handle_request_noblock()
+        self.assertEqual(len(server.process_batch.call_args[0][0]), 2)
+        self.assertEqual([r["Code"] for r in self.get_responses(server)], ["429"])
+
+    def test_metrics(self):
+        database = MockEngine({self.digest1: pyzor.engines.common.Record(24, 42)})
+        server = self.get_server(database)
+        client = ("127.0.0.1", 24442)
+        server.process_batch(
+            [
+                (self.packet("check", self.digest1), client),
+                (self.packet("check", self.digest2), client),
+                (self.packet("whitelist", self.digest1), client),
+            ]
+        )
+        summary = server.metrics.summary()
+        self.assertIn('pyzord_requests_total{op="check",code="200"} 2', summary)
+        self.assertIn('pyzord_requests_total{op="whitelist",code="403"} 1', summary)
+        self.assertIn("pyzord_requests_in_flight 0", summary)
+        self.assertIn(
+            'pyzord_engine_call_duration_seconds_count{call="get_many"} 1', summary
+        )
+        self.assertIn(
+            'pyzord_request_phase_duration_seconds_count{phase="engine"} 2',
+            server.metrics.render(),
+        )
+
+
+class MultiWorkerServerTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        patch("pyzor.server.signal.signal").start()
+        patch("pyzor.server.time.sleep").start()
+        patch("pyzor.server.MultiWorkerServer._check_address").start()
+        self.fork = patch("pyzor.server.os.fork").start()
+        self.wait = patch("pyzor.server.os.wait").start()
+        self.databases = iter([Mock(), Mock(), Mock()])
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def get_server(self, **kwargs):
+        server = pyzor.server.MultiWorkerServer(
+            ("127.0.0.1", 24441),
+            self.databases,
+            "passwd_fn",
+            "access_fn",
+            workers=2,
+            **kwargs
+        )
+        server.log = Mock()
+        return server
+
+    def test_restart(self):
+        self.fork.side_effect = [101, 102, 103]
+        server = self.get_server()
+        statuses = [(101, 9), (103, 0), (102, 0)]
+
+        def wait():
+            pid, status = statuses.pop(0)
+            if pid == 103:
+                server.stopping = True
+            return pid, status
+
+        self.wait.side_effect = wait
+        server.serve_forever()
+        self.assertEqual(self.fork.call_count, 3)
+        self.assertEqual(server.pids, {})
+
+    def test_no_restart_when_stopping(self):
+        self.fork.side_effect = [101, 102]
+        self.wait.side_effect = [(101, 0), (102, 0)]
+        server = self.get_server()
+        server.stopping = True
+        server.serve_forever()
+        self.assertEqual(self.fork.call_count, 2)
+
+    def test_databases(self):
+        server = self.get_server()
+        self.assertEqual(len(server.databases), 2)
+        self.assertEqual(len(list(self.databases)), 1)
+
+    def test_worker(self):
+        server_class = Mock()
+        forwarder = Mock()
+        server = self.get_server(
+            server_class=server_class,
+            forwarder_factory=lambda: forwarder,
+            cpus=[2, 3],
+            server_kwargs={"max_batch": 10},
+        )
+        with patch("pyzor.server.os.sched_setaffinity", create=True) as affinity:
+            server._run_worker(1, 0.5)
+        affinity.assert_called_with(0, {3})
+        server_class.assert_called_with(
+            ("127.0.0.1", 24441),
+            None,
+            "passwd_fn",
+            "access_fn",
+            forwarder,
+            max_batch=10,
+        )
+        worker = server_class.return_value
+        self.assertIs(worker.metrics, server.metrics)
+        worker.set_database.assert_called_with(server.databases[1].return_value)
+        worker.set_worker.assert_called_with(1)
+        forwarder.start_forwarding.assert_called_with()
+        forwarder.stop_forwarding.assert_called_with()
+        server_class.return_value.serve_forever.assert_called_with(poll_interval=0.5)
+        server_class.return_value.server_close.assert_called_with()
+
+    def test_shutdown(self):
+        server = self.get_server()
+        server.pids = {101: 0, 102: 1}
+        with patch("pyzor.server.os.kill") as kill:
+            server.shutdown()
+        self.assertTrue(server.stopping)
+        self.assertEqual(kill.call_count, 2)
+
+    def test_profile(self):
+        server = self.get_server()
+        server.pids = {101: 0, 102: 1}
+        with patch("pyzor.server.os.kill") as kill:
+            server.profile_handler()
+        self.assertEqual(
+            sorted(kill.call_args_list),
+            [((101, signal.SIGUSR2),), ((102, signal.SIGUSR2),)],
+        )
+
+
+class PoolServerTest(unittest.TestCase):
+    digest = "2aedaac999d71421c9ee49b9d81f627a7bc570aa"
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        patch("pyzor.config").start()
+        self.server = None
+        self.thread = None
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join(5)
+        if self.server is not None:
+            self.server.server_close()
+        patch.stopall()
+
+    def start(self, server_class, database, workers=2, queue_size=8):
+        self.server = server_class(
+            ("127.0.0.1", 0), database, "passwd_fn", "access_fn", workers, queue_size
+        )
+        self.server.acl = {pyzor.anonymous_user: ("check", "report", "ping", "stats")}
+        self.server.log.addHandler(logging.NullHandler())
+        self.server.usage_log.addHandler(logging.NullHandler())
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.1}
+        )
+        self.thread.start()
+        return self.server.server_address
+
+    def wait_handled(self, count):
+        # The counters are updated after the response is sent.
+        deadline = time.time() + 5
+        while self.server.stats()["handled"] < count and time.time() < deadline:
+            time.sleep(0.01)
+        return self.server.stats()
+
+    def test_thread_pool(self):
+        engine = MockEngine()
+        address = self.start(pyzor.server.ThreadPoolServer, engine)
+        client = pyzor.client.Client(timeout=5)
+        self.assertTrue(client.ping(address).is_ok())
+        client.report(self.digest, address)
+        self.assertEqual(client.check(self.digest, address)["Count"], "1")
+        stats = self.wait_handled(3)
+        self.assertEqual(stats["handled"], 3)
+        self.assertEqual(stats["workers"], 2)
+        self.assertEqual(stats["queue_size"], 8)
+        self.assertEqual(stats["dropped"], 0)
+
+    def test_process_pool(self):
+        address = self.start(pyzor.server.ProcessPoolServer, itertools.repeat(dict))
+        client = pyzor.client.Client(timeout=5)
+        for _ in range(4):
+            self.assertTrue(client.ping(address).is_ok())
+        self.assertEqual(len(self.server.pids), 2)
+        self.assertEqual(self.wait_handled(4)["handled"], 4)
+
+    def test_process_pool_stats(self):
+        address = self.start(pyzor.server.ProcessPoolServer, itertools.repeat(dict))
+        client = pyzor.client.Client(timeout=5)
+        for _ in range(4):
+            self.assertTrue(client.ping(address).is_ok())
+        self.wait_handled(4)
+        # The workers record the metrics in shared memory.
+        stats = client.stats(address).get_all("Stat")
+        self.assertIn('pyzord_requests_total{op="ping",code="200"} 4', stats)
+        # The samples of each worker are only in the Prometheus metrics.
+        self.assertNotIn("worker=", " ".join(stats))
+        self.assertIn(
+            'pyzord_worker_requests_total{worker="1"}', self.server.metrics.render()
+        )
+
+    def test_queue_full(self):
+        server = pyzor.server.ThreadPoolServer(
+            ("127.0.0.1", 0), MockEngine(), "passwd_fn", "access_fn", 0, 1
+        )
+        self.server = server
+        sock = Mock()
+        packet = b"Op: ping\nPV: 2.1\nThread: 1234\n"
+        server.process_request((packet, sock), ("127.0.0.1", 24442))
+        self.assertFalse(sock.sendto.called)
+        server.process_request((packet, sock), ("127.0.0.1", 24442))
+        stats = server.stats()
+        self.assertEqual(stats["queue_depth"], 1)
+        self.assertEqual(stats["dropped"], 1)
+        # The dropped request is answered straight away.
+        response = pyzor.message.Headers.parse(sock.sendto.call_args[0][0])
+        self.assertEqual(response["Code"], "503")
+        self.assertEqual(response["Thread"], "1234")
+        self.assertEqual(server.pending_requests(), 1)
+
+    def test_utilization(self):
+        server = pyzor.server.ThreadPoolServer(
+            ("127.0.0.1", 0), MockEngine(), "passwd_fn", "access_fn", 0, 1
+        )
+        self.server = server
+        server.workers = 2
+        server._last_stats = time.time() - 10
+        server._counters[1] = 5.0
+        self.assertAlmostEqual(server.stats()["utilization"], 0.25, 2)
+
 
 def suite():
     """Gather all the tests from this module in a test suite."""
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(RequestHandlerTest))
+    test_suite.addTest(unittest.makeSuite(SingleflightTest))
+    test_suite.addTest(unittest.makeSuite(VerifySignatureTest))
     test_suite.addTest(unittest.makeSuite(ServerTest))
+    test_suite.addTest(unittest.makeSuite(AdmissionTest))
+    test_suite.addTest(unittest.makeSuite(GeventServerTest))
+    test_suite.addTest(unittest.makeSuite(StreamServerTest))
+    test_suite.addTest(unittest.makeSuite(UnixDatagramServerTest))
+    test_suite.addTest(unittest.makeSuite(BatchServerTest))
+    test_suite.addTest(unittest.makeSuite(MultiWorkerServerTest))
+    test_suite.addTest(unittest.makeSuite(PoolServerTest))
     return test_suite
 
 
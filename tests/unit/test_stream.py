@@ -0,0 +1,46 @@
+"""Test the pyzor.stream module
+"""
+
+import io
+import unittest
+
+import pyzor
+import pyzor.stream
+
+
+class StreamTest(unittest.TestCase):
+    def test_pack(self):
+        self.assertEqual(pyzor.stream.pack(b"abc"), b"\x00\x00\x00\x03abc")
+
+    def test_read_messages(self):
+        rfile = io.BytesIO(pyzor.stream.pack(b"abc") + pyzor.stream.pack(b""))
+        self.assertEqual(pyzor.stream.read_message(rfile), b"abc")
+        self.assertEqual(pyzor.stream.read_message(rfile), b"")
+        # The connection was closed between two messages.
+        self.assertIsNone(pyzor.stream.read_message(rfile))
+
+    def test_large_message(self):
+        data = b"x" * 100000
+        rfile = io.BytesIO(pyzor.stream.pack(data))
+        self.assertEqual(pyzor.stream.read_message(rfile), data)
+
+    def test_too_large(self):
+        rfile = io.BytesIO(pyzor.stream.pack(b"abc"))
+        self.assertRaises(pyzor.ProtocolError, pyzor.stream.read_message, rfile, 2)
+
+    def test_truncated(self):
+        for data in (b"\x00\x00", pyzor.stream.pack(b"abc")[:-1]):
+            self.assertRaises(
+                pyzor.ProtocolError, pyzor.stream.read_message, io.BytesIO(data)
+            )
+
+
+def suite():
+    """Gather all the tests from this module in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(StreamTest))
+    return test_suite
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,286 @@
+"""Test the pyzor.usagelog module
+"""
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+import threading
+
+try:
+    from unittest.mock import patch, Mock
+except ImportError:
+    from mock import patch, Mock
+
+import pyzor.usagelog
+
+
+def make_record(usage, level=logging.INFO):
+    record = logging.LogRecord("pyzord-usage", level, "", 0, "request", None, None)
+    record.usage = usage
+    return record
+
+
+class CSVFormatterTest(unittest.TestCase):
+    def record(self, msg, args):
+        return logging.LogRecord("pyzord-usage", logging.INFO, "", 0, msg, args, None)
+
+    def test_format(self):
+        formatter = pyzor.usagelog.CSVFormatter()
+        formatter.formatTime = lambda record: "2014-01-01 00:00:00,000"
+        record = self.record(
+            "%s,%s,%s,%r,%s", ("anonymous", "192.0.2.1", "check", ["d1", "d2"], 200)
+        )
+        self.assertEqual(
+            formatter.format(record),
+            '"2014-01-01 00:00:00,000",%s,INFO,anonymous,192.0.2.1,check,'
+            "d1 d2,200" % record.process,
+        )
+
+    def test_format_quote(self):
+        formatter = pyzor.usagelog.CSVFormatter()
+        formatter.formatTime = lambda record: "now"
+        record = self.record("%s", ('a "b", c',))
+        self.assertEqual(
+            formatter.format(record), 'now,%s,INFO,"a ""b"", c"' % record.process
+        )
+
+    def test_format_no_args(self):
+        formatter = pyzor.usagelog.CSVFormatter()
+        formatter.formatTime = lambda record: "now"
+        record = self.record("message", None)
+        self.assertEqual(
+            formatter.format(record), "now,%s,INFO,message" % record.process
+        )
+
+
+class AsyncFileHandlerTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, "usage.log")
+        self.handler = None
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        if self.handler is not None:
+            self.handler.close()
+        shutil.rmtree(self.tmpdir)
+
+    def emit(self, msg):
+        self.handler.handle(
+            logging.LogRecord("pyzord-usage", logging.INFO, "", 0, msg, None, None)
+        )
+
+    def read(self):
+        with open(self.fn) as logf:
+            return logf.read().splitlines()
+
+    def test_write(self):
+        self.handler = pyzor.usagelog.AsyncFileHandler(self.fn, 100, 10)
+        for i in range(25):
+            self.emit("record %s" % i)
+        self.handler.close()
+        self.assertEqual(self.read(), ["record %s" % i for i in range(25)])
+        self.assertEqual(self.handler.stats()["written"], 25)
+        self.assertEqual(self.handler.stats()["dropped"], 0)
+
+    def test_batch(self):
+        self.handler = pyzor.usagelog.AsyncFileHandler(self.fn, 100, 10)
+        batches = []
+        write = self.handler._write
+        # Block the writer until all the records are queued.
+        event = threading.Event()
+
+        def _write(records):
+            event.wait()
+            batches.append(len(records))
+            write(records)
+
+        self.handler._write = _write
+        for i in range(25):
+            self.emit("record %s" % i)
+        event.set()
+        self.handler.close()
+        self.assertEqual(sum(batches), 25)
+        self.assertTrue(max(batches) <= 10)
+        self.assertTrue(len(batches) >= 3)
+
+    def test_dropped(self):
+        self.handler = pyzor.usagelog.AsyncFileHandler(self.fn, 2, 10)
+        event = threading.Event()
+        write = self.handler._write
+
+        def _write(records):
+            event.wait()
+            write(records)
+
+        self.handler._write = _write
+        self.emit("first")
+        # Wait for the writer to take the first record from the queue.
+        while self.handler.queue_depth():
+            event.wait(0.01)
+        for i in range(5):
+            self.emit("record %s" % i)
+        self.assertEqual(self.handler.stats()["queue_depth"], 2)
+        self.assertEqual(self.handler.stats()["dropped"], 3)
+        event.set()
+        self.handler.close()
+        self.assertEqual(self.read(), ["first", "record 0", "record 1"])
+        self.assertEqual(self.handler.stats()["written"], 3)
+
+    def test_stats_not_started(self):
+        self.handler = pyzor.usagelog.AsyncFileHandler(self.fn)
+        self.assertEqual(
+            self.handler.stats(), {"queue_depth": 0, "written": 0, "dropped": 0}
+        )
+
+    def test_close_not_started(self):
+        self.handler = pyzor.usagelog.AsyncFileHandler(self.fn)
+        self.handler.close()
+
+
+class SampleFilterTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.random = patch("pyzor.usagelog.random.random").start()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def test_sample(self):
+        sample = pyzor.usagelog.SampleFilter(0.25)
+        record = make_record(("anonymous", "192.0.2.1", "check"))
+        self.random.return_value = 0.1
+        self.assertTrue(sample.filter(record))
+        self.random.return_value = 0.5
+        self.assertFalse(sample.filter(record))
+
+    def test_errors(self):
+        sample = pyzor.usagelog.SampleFilter(0)
+        self.random.return_value = 0.5
+        record = make_record(("anonymous", "192.0.2.1", "check"), logging.ERROR)
+        self.assertTrue(sample.filter(record))
+        self.assertFalse(
+            sample.filter(make_record(("anonymous", "192.0.2.1", "check")))
+        )
+
+    def test_not_request(self):
+        sample = pyzor.usagelog.SampleFilter(0)
+        self.random.return_value = 0.5
+        self.assertTrue(sample.filter(make_record(None)))
+
+
+class UsageStatsHandlerTest(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.now = 100.0
+        patch("pyzor.usagelog.time.monotonic", side_effect=lambda: self.now).start()
+        self.target = Mock()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def rows(self):
+        rows = [call[0][0].args for call in self.target.handle.call_args_list]
+        self.target.reset_mock()
+        return rows
+
+    def test_interval(self):
+        handler = pyzor.usagelog.UsageStatsHandler(self.target, 60)
+        handler.handle(make_record(("anonymous", "192.0.2.1", "check")))
+        handler.handle(make_record(("anonymous", "192.0.2.2", "check")))
+        handler.handle(make_record(("alice", "192.0.2.1", "report"), logging.ERROR))
+        self.assertEqual(self.rows(), [])
+        self.now += 60
+        handler.handle(make_record(("anonymous", "192.0.2.1", "check")))
+        self.assertEqual(
+            sorted(self.rows()),
+            [
+                ("stats", 60, "address", "192.0.2.1", 3, 1),
+                ("stats", 60, "address", "192.0.2.2", 1, 0),
+                ("stats", 60, "op", "check", 3, 0),
+                ("stats", 60, "op", "report", 1, 1),
+                ("stats", 60, "user", "alice", 1, 1),
+                ("stats", 60, "user", "anonymous", 3, 0),
+            ],
+        )
+        # A new interval was started.
+        self.now += 10
+        handler.close()
+        self.assertEqual(len(self.rows()), 0)
+
+    def test_close(self):
+        handler = pyzor.usagelog.UsageStatsHandler(self.target, 60)
+        handler.handle(make_record((None, "192.0.2.1", None), logging.ERROR))
+        handler.handle(make_record(None))
+        self.now += 5
+        handler.close()
+        self.assertEqual(self.rows(), [("stats", 5, "address", "192.0.2.1", 1, 1)])
+
+    def test_timer(self):
+        patch.stopall()
+        handler = pyzor.usagelog.UsageStatsHandler(self.target, 0.1)
+        handler.handle(make_record(("anonymous", "192.0.2.1", "check")))
+        # The totals are written without another request.
+        deadline = time.time() + 5
+        while not self.target.handle.called and time.time() < deadline:
+            time.sleep(0.01)
+        handler.close()
+        self.assertEqual(
+            sorted(self.rows()),
+            [
+                ("stats", 0, "address", "192.0.2.1", 1, 0),
+                ("stats", 0, "op", "check", 1, 0),
+                ("stats", 0, "user", "anonymous", 1, 0),
+            ],
+        )
+
+    def test_fork(self):
+        handler = pyzor.usagelog.UsageStatsHandler(self.target, 60)
+        handler.handle(make_record(("anonymous", "192.0.2.1", "check")))
+        # A forked process only writes its own counts.
+        with patch("pyzor.usagelog.os.getpid", return_value=-1):
+            handler.handle(make_record(("alice", "192.0.2.2", "report")))
+            handler.close()
+        self.assertEqual(
+            sorted(self.rows()),
+            [
+                ("stats", 0, "address", "192.0.2.2", 1, 0),
+                ("stats", 0, "op", "report", 1, 0),
+                ("stats", 0, "user", "alice", 1, 0),
+            ],
+        )
+
+    def test_max_names(self):
+        handler = pyzor.usagelog.UsageStatsHandler(self.target, 60, 2)
+        for address in ("192.0.2.1", "192.0.2.2", "192.0.2.3", "192.0.2.4"):
+            handler.handle(make_record((None, address, None)))
+        handler.handle(make_record((None, "192.0.2.1", None)))
+        handler.close()
+        self.assertEqual(
+            self.rows(),
+            [
+                ("stats", 0, "address", "192.0.2.1", 2, 0),
+                ("stats", 0, "address", "192.0.2.2", 1, 0),
+                ("stats", 0, "address", "other", 2, 0),
+            ],
+        )
+
+
+def suite():
+    """Gather all the tests from this module in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(CSVFormatterTest))
+    test_suite.addTest(unittest.makeSuite(AsyncFileHandlerTest))
+    test_suite.addTest(unittest.makeSuite(SampleFilterTest))
+    test_suite.addTest(unittest.makeSuite(UsageStatsHandlerTest))
+    return test_suite
+
+
+if __name__ == "__main__":
+    unittest.main()